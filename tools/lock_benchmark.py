@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Coordination lock acquire/release benchmark.
+
+Acquires and releases coordination.Lock instances over a few lock names
+from many green threads, optionally spread over several processes, and
+reports for every backend:
+
+ * lock cycles per second
+ * p50 and p99 latency of acquire, and of a full acquire + release cycle
+
+The local backends used when backend_url is unset are always benchmarked,
+the ipc one only if sysv_ipc is installed.  Networked backends can be
+added with --backend to compare against a local stand-in server, for
+example:
+
+    python tools/lock_benchmark.py \\
+        --backend redis://127.0.0.1:6379?timeout=5 \\
+        --backend memcached://127.0.0.1:11211 \\
+        --processes 4 --concurrency 16
+"""
+
+from __future__ import print_function
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from oslo_config import cfg
+from oslo_utils import importutils
+
+from waterfall import coordination
+
+CONF = cfg.CONF
+
+
+def configure(state_path, backend):
+    CONF([], project='waterfall', default_config_files=[])
+    CONF.set_override('state_path', state_path)
+    if backend in ('file', 'ipc'):
+        CONF.set_override('local_backend', backend, group='coordination')
+    else:
+        CONF.set_override('backend_url', backend, group='coordination')
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def run_worker(args, seed):
+    """Run the green threads of one process and return their latencies."""
+    coordinator = coordination.Coordinator(prefix='bench-')
+    coordinator.start()
+    stats = {'acquire': [], 'cycle': [], 'errors': 0}
+
+    def cycle(n):
+        start = time.time()
+        try:
+            lock = coordination.Lock('lock-{n}',
+                                     {'n': (seed + n) % args.locks},
+                                     coordinator)
+            lock.acquire()
+            acquired = time.time()
+            if args.hold:
+                eventlet.sleep(args.hold)
+            lock.release()
+        except Exception:
+            stats['errors'] += 1
+            return
+        stats['acquire'].append(acquired - start)
+        stats['cycle'].append(time.time() - start)
+
+    pool = eventlet.GreenPool(args.concurrency)
+    for n in range(args.iterations):
+        pool.spawn_n(cycle, n)
+    pool.waitall()
+    coordinator.stop()
+    return stats
+
+
+def run_backend(args, backend, state_path):
+    configure(state_path, backend)
+    url = coordination.get_backend_url()
+
+    start = time.time()
+    if args.processes > 1:
+        workers = []
+        for seed in range(args.processes):
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   '--worker', backend, '--state-path', state_path,
+                   '--seed', str(seed)] + worker_args(args)
+            workers.append(subprocess.Popen(cmd, stdout=subprocess.PIPE))
+        results = []
+        for worker in workers:
+            out, _err = worker.communicate()
+            if worker.returncode:
+                raise RuntimeError('Benchmark worker failed')
+            results.append(json.loads(out.decode('utf-8')))
+    else:
+        results = [run_worker(args, 0)]
+    elapsed = time.time() - start
+
+    acquire = sum((r['acquire'] for r in results), [])
+    cycles = sum((r['cycle'] for r in results), [])
+    return {
+        'backend': url.split('?')[0],
+        'rate': len(cycles) / elapsed if elapsed else 0.0,
+        'acquire_p50': percentile(acquire, 50) * 1000,
+        'acquire_p99': percentile(acquire, 99) * 1000,
+        'cycle_p50': percentile(cycles, 50) * 1000,
+        'cycle_p99': percentile(cycles, 99) * 1000,
+        'errors': sum(r['errors'] for r in results),
+    }
+
+
+def worker_args(args):
+    return ['--locks', str(args.locks), '--hold', str(args.hold),
+            '--iterations', str(args.iterations),
+            '--concurrency', str(args.concurrency)]
+
+
+def report(results):
+    header = ('%-36s %10s %11s %11s %10s %10s %7s' %
+              ('backend', 'cycles/s', 'acq p50 ms', 'acq p99 ms',
+               'p50 ms', 'p99 ms', 'errors'))
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print('%-36s %10.1f %11.3f %11.3f %10.3f %10.3f %7d' %
+              (r['backend'], r['rate'], r['acquire_p50'], r['acquire_p99'],
+               r['cycle_p50'], r['cycle_p99'], r['errors']))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', action='append', default=[],
+                        help='Additional tooz backend URL to benchmark, '
+                             'may be given several times.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes.')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Green threads per process.')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='Lock cycles per process.')
+    parser.add_argument('--locks', type=int, default=4,
+                        help='Number of lock names the cycles are spread '
+                             'over.')
+    parser.add_argument('--hold', type=float, default=0.0,
+                        help='Seconds each lock is held.')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--state-path', help=argparse.SUPPRESS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.worker:
+        configure(args.state_path, args.worker)
+        print(json.dumps(run_worker(args, args.seed)))
+        return 0
+
+    backends = ['file']
+    if importutils.try_import('sysv_ipc'):
+        backends.append('ipc')
+    backends.extend(args.backend)
+
+    state_path = tempfile.mkdtemp(prefix='waterfall-lock-bench-')
+    try:
+        results = [run_backend(args, backend, state_path)
+                   for backend in backends]
+    finally:
+        shutil.rmtree(state_path, ignore_errors=True)
+    report(results)
+    return 1 if any(r['errors'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
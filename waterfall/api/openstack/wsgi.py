@@ -33,6 +33,7 @@ import webob.exc
 
 from waterfall.api.openstack import api_version_request as api_version
 from waterfall.api.openstack import versioned_method
+from waterfall.common import metrics
 from waterfall import exception
 from waterfall import i18n
 from waterfall.i18n import _, _LE, _LI
@@ -47,6 +48,9 @@ XML_WARNING = False
 
 LOG = logging.getLogger(__name__)
 
+# Requests served per route, "<method> <controller>.<action>"
+REQUEST_TIMINGS = metrics.timings('api.requests')
+
 SUPPORTED_CONTENT_TYPES = (
     'application/json',
     'application/vnd.openstack.workflow+json',
@@ -1057,8 +1061,11 @@ class Resource(wsgi.Application):
         #            function.  If we try to audit __call__(), we can
         #            run into troubles due to the @webob.dec.wsgify()
         #            decorator.
-        return self._process_stack(request, action, action_args,
-                                   content_type, body, accept)
+        route = '%s %s.%s' % (request.method,
+                              self.controller.__class__.__name__, action)
+        with REQUEST_TIMINGS.time(route):
+            return self._process_stack(request, action, action_args,
+                                       content_type, body, accept)
 
     def _is_legacy_endpoint(self, request):
         version_str = request.api_version_request.get_string()
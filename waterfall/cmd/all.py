@@ -41,8 +41,11 @@ i18n.enable_lazy()
 # Need to register global_opts
 from waterfall.cmd import workflow as workflow_cmd
 from waterfall.common import config   # noqa
+from waterfall.common import metrics
+from waterfall.common import startup
+from waterfall import coordination
 from waterfall.db import api as session
-from waterfall.i18n import _LE
+from waterfall.i18n import _LE, _LI
 from waterfall import objects
 from waterfall import rpc
 from waterfall import service
@@ -55,54 +58,85 @@ CONF = cfg.CONF
 
 # TODO(e0ne): get a rid of code duplication in waterfall.cmd module in Mitaka
 def main():
+    startup.mark('imports')
     objects.register_all()
+    startup.mark('objects')
     gmr_opts.set_defaults(CONF)
     CONF(sys.argv[1:], project='waterfall',
          version=version.version_string())
     config.set_middleware_defaults()
+    startup.mark('config')
     logging.setup(CONF, "waterfall")
     LOG = logging.getLogger('waterfall.all')
 
     utils.monkey_patch()
 
     gmr.TextGuruMeditation.setup_autorun(version, conf=CONF)
+    metrics.register_report_section()
+    startup.mark('logging')
 
     rpc.init(CONF)
+    startup.mark('rpc')
 
-    launcher = service.process_launcher()
+    # All the services run on this host, so without a backend_url they
+    # coordinate through a local backend instead of a networked one.
+    LOG.info(_LI('Using coordination backend %s.'),
+             coordination.get_backend_url())
+
+    # The services are all created before any is launched, so the startup
+    # can be profiled without forking the service processes.
+    servers = []
     # waterfall-api
     try:
-        server = service.WSGIService('osapi_workflow')
-        launcher.launch_service(server, workers=server.workers or 1)
+        server = service.WSGIService('osapi_workflow',
+                                     metrics_port=CONF.metrics_api_port)
+        servers.append((server, server.workers or 1))
     except (Exception, SystemExit):
         LOG.exception(_LE('Failed to load osapi_workflow'))
+    startup.mark('osapi_workflow')
 
     for binary in ['waterfall-scheduler', 'waterfall-backup']:
         try:
-            launcher.launch_service(service.Service.create(binary=binary))
+            servers.append((service.Service.create(binary=binary), 1))
         except (Exception, SystemExit):
             LOG.exception(_LE('Failed to load %s'), binary)
+        startup.mark(binary)
 
     # waterfall-workflow
+    # The processes of all the backends share the metrics ports
+    metrics_port_count = (CONF.workflow_workers *
+                          max(len(CONF.enabled_backends or []), 1))
     try:
         if CONF.enabled_backends:
             for backend in CONF.enabled_backends:
                 CONF.register_opt(workflow_cmd.host_opt, group=backend)
                 backend_host = getattr(CONF, backend).backend_host
                 host = "%s@%s" % (backend_host or CONF.host, backend)
-                server = service.Service.create(host=host,
-                                                service_name=backend,
-                                                binary='waterfall-workflow')
-                # Dispose of the whole DB connection pool here before
-                # starting another process.  Otherwise we run into cases
-                # where child processes share DB connections which results
-                # in errors.
-                session.dispose_engine()
-                launcher.launch_service(server)
+                server = service.Service.create(
+                    host=host,
+                    service_name=backend,
+                    binary='waterfall-workflow',
+                    coordination=True,
+                    metrics_port=CONF.metrics_port,
+                    metrics_port_count=metrics_port_count)
+                servers.append((server, CONF.workflow_workers))
         else:
-            server = service.Service.create(binary='waterfall-workflow')
-            launcher.launch_service(server)
+            server = service.Service.create(
+                binary='waterfall-workflow',
+                coordination=True,
+                metrics_port=CONF.metrics_port,
+                metrics_port_count=metrics_port_count)
+            servers.append((server, CONF.workflow_workers))
     except (Exception, SystemExit):
         LOG.exception(_LE('Failed to load conder-workflow'))
+    startup.mark('waterfall-workflow')
+    startup.ready()
 
+    # Dispose of the whole DB connection pool here before starting the
+    # service processes.  Otherwise we run into cases where child processes
+    # share DB connections which results in errors.
+    session.dispose_engine()
+    launcher = service.process_launcher()
+    for server, workers in servers:
+        launcher.launch_service(server, workers=workers)
     launcher.wait()
@@ -35,6 +35,8 @@ i18n.enable_lazy()
 
 # Need to register global_opts
 from waterfall.common import config
+from waterfall.common import metrics
+from waterfall.common import startup
 from waterfall import rpc
 from waterfall import service
 from waterfall import utils
@@ -45,19 +47,28 @@ CONF = cfg.CONF
 
 
 def main():
+    startup.mark('imports')
     objects.register_all()
+    startup.mark('objects')
     gmr_opts.set_defaults(CONF)
     CONF(sys.argv[1:], project='waterfall',
          version=version.version_string())
     config.set_middleware_defaults()
+    startup.mark('config')
     logging.setup(CONF, "waterfall")
     python_logging.captureWarnings(True)
     utils.monkey_patch()
 
     gmr.TextGuruMeditation.setup_autorun(version, conf=CONF)
+    metrics.register_report_section()
+    startup.mark('logging')
 
     rpc.init(CONF)
+    startup.mark('rpc')
     launcher = service.process_launcher()
-    server = service.WSGIService('osapi_workflow')
+    server = service.WSGIService('osapi_workflow',
+                                 metrics_port=CONF.metrics_api_port)
+    startup.mark('osapi_workflow')
+    startup.ready()
     launcher.launch_service(server, workers=server.workers)
     launcher.wait()
@@ -55,9 +55,12 @@
 from __future__ import print_function
 
 
+import json
 import logging as python_logging
 import os
+import subprocess
 import sys
+import tempfile
 
 from oslo_config import cfg
 from oslo_db.sqlalchemy import migration
@@ -70,6 +73,7 @@ i18n.enable_lazy()
 
 # Need to register global_opts
 from waterfall.common import config  # noqa
+from waterfall.common import startup
 from waterfall import context
 from waterfall import db
 from waterfall.db import migration as db_migration
@@ -429,6 +433,54 @@ class BackupCommands(object):
             bk.save()
 
 
+class ProfileCommands(object):
+    """Methods for profiling the services."""
+
+    @args('binary', choices=sorted(startup.BINARIES),
+          help='Binary whose startup is profiled')
+    @args('--imports', dest='imports', type=int, default=20,
+          help='Number of slowest imports listed (default: %(default)d)')
+    def startup(self, binary, imports=20):
+        """Report the wall time of the startup phases and imports.
+
+        The binary is started in a child process with the configuration of
+        this command, and stops once its services are created instead of
+        serving.
+        """
+        fd, output = tempfile.mkstemp(prefix='waterfall-startup-',
+                                      suffix='.json')
+        os.close(fd)
+        cmd = [sys.executable, '-c',
+               'import sys; from waterfall.common import startup; '
+               'sys.exit(startup.profile_main())', output, binary]
+        for config_file in CONF.config_file:
+            cmd.extend(['--config-file', config_file])
+        if CONF.config_dir:
+            cmd.extend(['--config-dir', CONF.config_dir])
+
+        try:
+            if subprocess.call(cmd):
+                print(_("%s failed to start.") % binary)
+                return 1
+            with open(output) as f:
+                report = json.load(f)
+        finally:
+            os.unlink(output)
+
+        print(_("Startup of %(binary)s: %(total).3fs") %
+              {'binary': binary, 'total': report['total']})
+        print()
+        print("%-30s %10s" % (_('Phase'), _('Seconds')))
+        for phase, seconds in report['phases']:
+            print("%-30s %10.3f" % (phase, seconds))
+        print()
+        print("%-60s %10s %10s" % (_('Import'), _('Cumulative'), _('Self')))
+        for entry in report['imports'][:int(imports)]:
+            print("%-60s %10.3f %10.3f" % (entry['module'],
+                                           entry['cumulative'],
+                                           entry['self']))
+
+
 class ServiceCommands(object):
     """Methods for managing services."""
     def list(self):
@@ -486,6 +538,7 @@ CATEGORIES = {
     'db': DbCommands,
     'host': HostCommands,
     'logs': GetLogCommands,
+    'profile': ProfileCommands,
     'service': ServiceCommands,
     'shell': ShellCommands,
     'version': VersionCommands,
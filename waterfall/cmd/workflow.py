@@ -33,24 +33,37 @@ i18n.enable_lazy()
 
 # Need to register global_opts
 from waterfall.common import config  # noqa
-#from waterfall import objects
+from waterfall.common import metrics
+from waterfall.common import startup
+from waterfall import objects
 from waterfall import service
 from waterfall import utils
 from waterfall import version
 
 
 CONF = cfg.CONF
+CONF.import_opt('workflow_workers', 'waterfall.workflow.manager')
 
 
 def main():
-    #objects.register_all()
+    startup.mark('imports')
+    objects.register_all()
+    startup.mark('objects')
     gmr_opts.set_defaults(CONF)
     CONF(sys.argv[1:], project='waterfall',
          version=version.version_string())
+    startup.mark('config')
     logging.setup(CONF, "waterfall")
     python_logging.captureWarnings(True)
     utils.monkey_patch()
     gmr.TextGuruMeditation.setup_autorun(version, conf=CONF)
-    server = service.Service.create(binary='waterfall-workflow')
-    service.serve(server)
+    metrics.register_report_section()
+    startup.mark('logging')
+    server = service.Service.create(binary='waterfall-workflow',
+                                    coordination=True,
+                                    metrics_port=CONF.metrics_port,
+                                    metrics_port_count=CONF.workflow_workers)
+    startup.mark('waterfall-workflow')
+    startup.ready()
+    service.serve(server, workers=CONF.workflow_workers)
     service.wait()
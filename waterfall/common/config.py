@@ -128,6 +128,13 @@ global_opts = [
     cfg.StrOpt('scheduler_manager',
                default='waterfall.scheduler.manager.SchedulerManager',
                help='Full class name for the Manager for scheduler'),
+    cfg.IntOpt('capabilities_full_sync_interval',
+               default=600,
+               min=0,
+               help='Seconds between two full capability updates sent by a '
+                    'service to the schedulers. In between only the '
+                    'changed capabilities are sent, 0 always sends all '
+                    'of them.'),
     cfg.StrOpt('host',
                default=socket.gethostname(),
                help='Name of this node.  This can be an opaque identifier. '
@@ -0,0 +1,233 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Process level metrics.
+
+Modules register named sources, callables returning a dictionary with
+their current figures.  All the sources are reported in a section of the
+guru meditation report and, when `metrics_port` or `metrics_api_port` is
+set, served as JSON over HTTP by every process of the workflow or API
+service.
+
+Timings sources count the operations of the hot paths, API requests per
+route, RPC messages per method, driver calls..., and report their
+latency percentiles over the most recent ones.
+"""
+
+import collections
+import contextlib
+import errno
+import socket
+import time
+
+from eventlet.green import socket as green_socket
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_reports import guru_meditation_report as gmr
+from oslo_reports.models import with_default_views as mwdv
+from oslo_reports.views.text import generic as text_views
+from oslo_serialization import jsonutils
+
+from waterfall.i18n import _LE, _LI, _LW
+from waterfall.wsgi import eventlet_server
+
+LOG = logging.getLogger(__name__)
+
+metrics_opts = [
+    cfg.StrOpt('metrics_listen',
+               default='127.0.0.1',
+               help='IP address on which the metrics endpoint listens.'),
+    cfg.IntOpt('metrics_port',
+               default=0,
+               min=0,
+               max=65535,
+               help='Port on which the metrics endpoint of the workflow '
+                    'service listens, 0 disables it. With several workers, '
+                    'each process takes the first free port from this one '
+                    'on, up to the number of workers.'),
+    cfg.IntOpt('metrics_api_port',
+               default=0,
+               min=0,
+               max=65535,
+               help='Port on which the metrics endpoint of the API service '
+                    'listens, 0 disables it. With several workers, each '
+                    'process takes the first free port from this one on, '
+                    'up to the number of workers.'),
+    cfg.IntOpt('metrics_samples',
+               default=1000,
+               min=1,
+               help='Number of most recent durations of an operation the '
+                    'latency percentiles are computed over.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metrics_opts)
+
+_SOURCES = collections.OrderedDict()
+
+
+def register_source(name, source):
+    """Register a metrics source.
+
+    :param name: Name of the source, used as its key in the reports.
+    :param source: Callable with no arguments returning a dictionary.
+    """
+    _SOURCES[name] = source
+
+
+def collect():
+    """Return the current figures of all the registered sources."""
+    result = collections.OrderedDict()
+    for name, source in list(_SOURCES.items()):
+        try:
+            result[name] = source()
+        except Exception:
+            LOG.exception(_LE('Error collecting %s metrics.'), name)
+    return result
+
+
+def _percentile(values, percent):
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+class Timings(object):
+    """Count and duration of named operations."""
+
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, key, duration=None, error=False):
+        """Record an operation, its duration in seconds if it has one."""
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {
+                'count': 0, 'errors': 0, 'timed': 0, 'total': 0.0,
+                'max': 0.0,
+                'recent': collections.deque(maxlen=CONF.metrics_samples)}
+        stats['count'] += 1
+        if error:
+            stats['errors'] += 1
+        if duration is not None:
+            stats['timed'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            stats['recent'].append(duration)
+
+    @contextlib.contextmanager
+    def time(self, key):
+        """Context manager recording the duration of its block."""
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(key, time.time() - start, error=True)
+            raise
+        self.record(key, time.time() - start)
+
+    def report(self):
+        result = {}
+        for key, stats in list(self._stats.items()):
+            report = {'count': stats['count'], 'errors': stats['errors']}
+            recent = sorted(stats['recent'])
+            if recent:
+                report.update(avg=stats['total'] / stats['timed'],
+                              max=stats['max'],
+                              p50=_percentile(recent, 50),
+                              p90=_percentile(recent, 90),
+                              p99=_percentile(recent, 99))
+            result[key] = report
+        return result
+
+
+def timings(name):
+    """Return a new Timings registered as the `name` source."""
+    source = Timings()
+    register_source(name, source.report)
+    return source
+
+
+class MetricsReportGenerator(object):
+    """Guru meditation report generator for the registered sources."""
+
+    def __call__(self):
+        return mwdv.ModelWithDefaultViews(
+            collect(), text_view=text_views.KeyValueView())
+
+
+class MetricsApp(object):
+    """WSGI application serving the registered sources as JSON."""
+
+    def __call__(self, environ, start_response):
+        body = jsonutils.dump_as_bytes(collect())
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def register_report_section():
+    """Add the metrics section to the guru meditation report."""
+    gmr.TextGuruMeditation.register_section('Metrics',
+                                            MetricsReportGenerator())
+
+
+class _Server(eventlet_server.Server):
+    """Server whose port is not shared with other processes."""
+
+    def _get_socket(self, host, port, backlog):
+        # eventlet.listen() sets SO_REUSEPORT, every worker would bind the
+        # same port and the requests would go to any of them.
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        sock = green_socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(backlog)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+
+def start_server(port=None, count=1):
+    """Serve the metrics of this process over HTTP, if enabled.
+
+    The processes of a service launched with several workers each take
+    the first free port among the `count` ports from `port` on.
+
+    :param port: First port, defaults to `metrics_port`.
+    :param count: Number of ports the processes of the service use.
+    :returns: the server, or None if the port is not set or all the ports
+              are taken.
+    """
+    if port is None:
+        port = CONF.metrics_port
+    if not port:
+        return None
+
+    for offset in range(count):
+        try:
+            server = _Server(CONF, 'metrics', MetricsApp(),
+                             host=CONF.metrics_listen, port=port + offset)
+        except socket.error as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            continue
+        server.start()
+        LOG.info(_LI('Metrics endpoint listening on %(host)s:%(port)s.'),
+                 {'host': server.host, 'port': server.port})
+        return server
+
+    LOG.warning(_LW('Ports %(first)d to %(last)d are all taken, the '
+                    'metrics of this process are not served.'),
+                {'first': port, 'last': port + count - 1})
+    return None
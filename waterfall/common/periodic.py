@@ -0,0 +1,137 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Scheduler for the periodic tasks of a manager.
+
+Instead of running all the tasks one after the other from a single timer,
+every task gets its own timer following its spacing, so a slow task
+doesn't delay the others.  A run is skipped while the previous one of the
+same task is still executing, and the duration, overruns and failures of
+every task are reported as metrics.
+"""
+
+import random
+import time
+
+import eventlet
+from eventlet import greenpool
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+from waterfall.common import metrics
+from waterfall.i18n import _LE, _LW
+
+LOG = logging.getLogger(__name__)
+
+periodic_opts = [
+    cfg.FloatOpt('periodic_task_jitter',
+                 default=0.1,
+                 min=0,
+                 max=1,
+                 help='Fraction of its spacing by which every run of a '
+                      'periodic task is randomly delayed or advanced, so '
+                      'the tasks of several services spread out.'),
+    cfg.IntOpt('periodic_task_workers',
+               default=0,
+               min=0,
+               help='Number of green threads of a pool shared by the '
+                    'periodic tasks of a service, so only that many run at '
+                    'once. 0 runs every task in its own green thread.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(periodic_opts)
+
+
+class PeriodicScheduler(object):
+    """Run the periodic tasks of a manager, each on its own spacing.
+
+    :param manager: The manager, a oslo.service PeriodicTasks.
+    :param get_context: Callable returning the context the tasks get.
+    """
+
+    def __init__(self, manager, get_context):
+        self.manager = manager
+        self.get_context = get_context
+        self.timers = []
+        self.stats = {}
+        self._running = set()
+        self._pool = None
+        if CONF.periodic_task_workers:
+            self._pool = greenpool.GreenPool(CONF.periodic_task_workers)
+
+    def start(self, initial_delay=None):
+        """Start the timers of the enabled tasks.
+
+        :param initial_delay: Added to the first delay of every task, to
+            stagger the services started at the same time.
+        """
+        for name, task in self.manager._periodic_tasks:
+            if (task._periodic_external_ok and
+                    not CONF.run_external_periodic_tasks):
+                continue
+            spacing = self.manager._periodic_spacing[name]
+            self.stats[name] = {'spacing': spacing, 'runs': 0,
+                                'failures': 0, 'overruns': 0,
+                                'running': False, 'last_run': None,
+                                'last_duration': None, 'max_duration': 0.0}
+
+            delay = initial_delay or 0
+            if not task._periodic_immediate:
+                delay += self._next_delay(spacing)
+            timer = loopingcall.DynamicLoopingCall(self._tick, name, task,
+                                                   spacing)
+            timer.start(initial_delay=delay)
+            self.timers.append(timer)
+        metrics.register_source(self._metrics_name(), self.report)
+
+    def _metrics_name(self):
+        return 'periodic_tasks.%s' % self.manager.__class__.__name__
+
+    @staticmethod
+    def _next_delay(spacing):
+        jitter = spacing * CONF.periodic_task_jitter
+        return max(0, spacing + random.uniform(-jitter, jitter))
+
+    def _tick(self, name, task, spacing):
+        if name in self._running:
+            self.stats[name]['overruns'] += 1
+            LOG.warning(_LW('Skipping run of periodic task %s, the previous '
+                            'one is still running.'), name)
+        else:
+            self._running.add(name)
+            self.stats[name]['running'] = True
+            spawn = self._pool.spawn_n if self._pool else eventlet.spawn_n
+            spawn(self._run, name, task)
+        return self._next_delay(spacing)
+
+    def _run(self, name, task):
+        stats = self.stats[name]
+        start = time.time()
+        LOG.debug('Running periodic task %s', name)
+        try:
+            task(self.manager, self.get_context())
+        except Exception:
+            stats['failures'] += 1
+            LOG.exception(_LE('Error during periodic task %s'), name)
+        finally:
+            duration = time.time() - start
+            stats['runs'] += 1
+            stats['last_run'] = start
+            stats['last_duration'] = duration
+            stats['max_duration'] = max(stats['max_duration'], duration)
+            stats['running'] = False
+            self._running.discard(name)
+
+    def report(self):
+        return {name: dict(stats) for name, stats in self.stats.items()}
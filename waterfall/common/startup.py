@@ -0,0 +1,150 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Startup profiling of the service entry points.
+
+The entry points call mark() at the end of every phase of their startup,
+starting with their imports, and ready() once their services are created,
+before serving.
+
+`waterfall-manage profile startup <binary>` runs profile_main() in a child
+process: the imports done by the entry point are timed, and instead of
+serving the entry point stops at ready() and the phase and import timings
+are written to a file as JSON.
+
+Only the standard library and six are imported here, so the module can be
+imported before anything else is.
+"""
+
+import json
+import sys
+import time
+
+from six.moves import builtins
+
+# Entry point module of every binary whose startup can be profiled
+BINARIES = {
+    'waterfall-all': 'waterfall.cmd.all',
+    'waterfall-api': 'waterfall.cmd.api',
+    'waterfall-workflow': 'waterfall.cmd.workflow',
+}
+
+
+class StartupComplete(Exception):
+    """Raised by ready() to stop an entry point being profiled."""
+
+
+class StartupProfile(object):
+    """Wall time of the startup phases and imports of a process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.started_at = time.time()
+        self.phases = []
+        self.imports = {}
+        self._last_mark = self.started_at
+        self._import_stack = []
+        self._import = None
+
+    def mark(self, phase):
+        """Record the end of a startup phase."""
+        now = time.time()
+        self.phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    def ready(self):
+        """Record the end of the startup, stop here when profiling."""
+        self.mark('ready')
+        if self.enabled:
+            raise StartupComplete()
+
+    def time_imports(self):
+        """Time the modules imported from now on."""
+        if self._import is None:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def stop_timing_imports(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        module = name
+        if level == 0 and name in sys.modules:
+            # "from package import module" imports the submodules too
+            missing = ['%s.%s' % (name, item) for item in fromlist or ()
+                       if ('%s.%s' % (name, item)) not in sys.modules]
+            if not missing:
+                return self._import(name, globals, locals, fromlist, level)
+            module = missing[0]
+
+        start = time.time()
+        self._import_stack.append(0.0)
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            children = self._import_stack.pop()
+            elapsed = time.time() - start
+            if self._import_stack:
+                self._import_stack[-1] += elapsed
+            if module not in self.imports:
+                self.imports[module] = {'cumulative': elapsed,
+                                        'self': elapsed - children}
+
+    def report(self):
+        imports = [dict(times, module=module)
+                   for module, times in self.imports.items()]
+        imports.sort(key=lambda entry: entry['cumulative'], reverse=True)
+        return {'total': self._last_mark - self.started_at,
+                'phases': list(self.phases),
+                'imports': imports}
+
+
+PROFILE = StartupProfile()
+
+
+def mark(phase):
+    PROFILE.mark(phase)
+
+
+def ready():
+    PROFILE.ready()
+
+
+def profile_main():
+    """Profile the startup of a binary, in a process of its own.
+
+    Called as `profile_main()` with the arguments: path of the JSON report
+    to write, binary name, then the arguments of the binary.
+    """
+    output, binary = sys.argv[1:3]
+    sys.argv = [binary] + sys.argv[3:]
+
+    PROFILE.enabled = True
+    PROFILE.time_imports()
+    # Through __import__, so the entry point module is timed too
+    __import__(BINARIES[binary])
+    try:
+        sys.modules[BINARIES[binary]].main()
+    except StartupComplete:
+        pass
+    else:
+        raise RuntimeError('%s returned before being ready' % binary)
+    finally:
+        PROFILE.stop_timing_imports()
+
+    report = dict(PROFILE.report(), binary=binary)
+    with open(output, 'w') as f:
+        json.dump(report, f)
+    return 0
@@ -0,0 +1,163 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Bounded green thread pool.
+
+At most `size` tasks run at once, the others wait in a queue of at most
+`queue_size` entries.  When the queue is full the rejection policy decides
+whether the caller blocks until there is room, runs the task itself or
+gets a ThreadPoolFull error.  A task submitting to its own full pool runs
+the new task itself instead of blocking, the workers it would wait for
+may all be waiting too.  The number of active, queued, completed and
+rejected tasks and the time tasks waited in the queue are reported as
+metrics.
+"""
+
+import time
+
+import eventlet
+from eventlet import queue
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from waterfall import exception
+from waterfall.i18n import _LE, _LW
+
+LOG = logging.getLogger(__name__)
+
+BLOCK = 'block'
+CALLER_RUNS = 'caller_runs'
+REJECT = 'reject'
+
+threadpool_opts = [
+    cfg.IntOpt('manager_thread_pool_size',
+               default=64,
+               min=1,
+               help='Number of tasks the thread pool of a manager runs at '
+                    'once.'),
+    cfg.IntOpt('manager_thread_pool_queue_size',
+               default=1000,
+               min=1,
+               help='Number of tasks waiting for a free green thread of '
+                    'the thread pool of a manager.'),
+    cfg.StrOpt('manager_thread_pool_rejection',
+               default=BLOCK,
+               choices=[BLOCK, CALLER_RUNS, REJECT],
+               help='What happens to a task submitted to the thread pool of '
+                    'a manager while its queue is full: the caller waits '
+                    'for room in the queue (block), runs the task itself '
+                    '(caller_runs) or gets an error (reject).'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(threadpool_opts)
+
+
+class BoundedGreenPool(object):
+    """Green thread pool with a bounded queue.
+
+    :param name: Name of the pool, used in logs and errors.
+    :param size: Maximum number of tasks running at once.
+    :param queue_size: Maximum number of tasks waiting to run.
+    :param rejection: Policy applied when the queue is full, one of
+        'block', 'caller_runs' or 'reject'.
+    """
+
+    def __init__(self, name, size=None, queue_size=None, rejection=None):
+        self.name = name
+        self.size = size or CONF.manager_thread_pool_size
+        self.queue_size = queue_size or CONF.manager_thread_pool_queue_size
+        self.rejection = rejection or CONF.manager_thread_pool_rejection
+        self._queue = queue.LightQueue(self.queue_size)
+        self._workers = 0
+        # Green threads of the workers, to spot tasks submitting tasks
+        self._threads = set()
+        self.stats = {'active': 0, 'completed': 0, 'failed': 0,
+                      'rejected': 0, 'caller_runs': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0}
+
+    def spawn_n(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a green thread of the pool.
+
+        :raises ThreadPoolFull: if the queue is full and the rejection
+            policy is 'reject'.
+        """
+        task = (func, args, kwargs, time.time())
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            if self.rejection == REJECT:
+                self.stats['rejected'] += 1
+                LOG.warning(_LW('Rejecting task %(func)s, the queue of '
+                                'thread pool %(name)s is full.'),
+                            {'func': func, 'name': self.name})
+                raise exception.ThreadPoolFull(name=self.name,
+                                               queued=self.queue_size)
+            if (self.rejection == CALLER_RUNS or
+                    eventlet.getcurrent() in self._threads):
+                self.stats['caller_runs'] += 1
+                self._run(task)
+                return
+            self._queue.put(task)
+
+        # Tasks are only taken from the queue by workers, one is started
+        # as long as the pool has room for it.
+        if self._workers < self.size:
+            self._workers += 1
+            eventlet.spawn_n(self._work)
+
+    def _work(self):
+        current = eventlet.getcurrent()
+        self._threads.add(current)
+        try:
+            while True:
+                try:
+                    task = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+                self._run(task)
+        finally:
+            self._threads.discard(current)
+            self._workers -= 1
+
+    def _run(self, task):
+        func, args, kwargs, enqueued = task
+        wait = time.time() - enqueued
+        self.stats['wait_total'] += wait
+        self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+        self.stats['active'] += 1
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            self.stats['failed'] += 1
+            LOG.exception(_LE('Error running task %(func)s in thread pool '
+                              '%(name)s.'), {'func': func, 'name': self.name})
+        finally:
+            self.stats['active'] -= 1
+            self.stats['completed'] += 1
+
+    def queued(self):
+        """Return the number of tasks waiting to run."""
+        return self._queue.qsize()
+
+    def load(self):
+        """Return the figures the schedulers use to spot a busy host."""
+        return {'active': self.stats['active'], 'queued': self.queued(),
+                'size': self.size, 'queue_size': self.queue_size}
+
+    def report(self):
+        report = dict(self.stats, queued=self.queued(), size=self.size,
+                      queue_size=self.queue_size, rejection=self.rejection)
+        started = self.stats['completed'] + self.stats['active']
+        report['wait_avg'] = (self.stats['wait_total'] / started
+                              if started else 0.0)
+        return report
@@ -42,6 +42,13 @@ CONF.register_opts(context_opts)
 
 LOG = logging.getLogger(__name__)
 
+# Fields of the context sent over RPC in its compact form, the ones the
+# managers use.  The auth token is needed by the quota code talking to
+# Keystone, the service catalog is left out.
+RPC_FIELDS = ('user_id', 'project_id', 'project_name', 'is_admin',
+              'read_deleted', 'roles', 'remote_address', 'request_id',
+              'quota_class', 'auth_token')
+
 
 class RequestContext(context.RequestContext):
     """Security context and request information.
@@ -83,8 +90,7 @@ class RequestContext(context.RequestContext):
         self.remote_address = remote_address
         if not timestamp:
             timestamp = timeutils.utcnow()
-        elif isinstance(timestamp, six.string_types):
-            timestamp = timeutils.parse_isotime(timestamp)
+        # A string timestamp is only parsed when it is used
         self.timestamp = timestamp
         self.quota_class = quota_class
 
@@ -120,6 +126,22 @@ class RequestContext(context.RequestContext):
     read_deleted = property(_get_read_deleted, _set_read_deleted,
                             _del_read_deleted)
 
+    def _get_timestamp(self):
+        if isinstance(self._timestamp, six.string_types):
+            self._timestamp = timeutils.parse_isotime(self._timestamp)
+        return self._timestamp
+
+    def _set_timestamp(self, timestamp):
+        self._timestamp = timestamp
+
+    timestamp = property(_get_timestamp, _set_timestamp)
+
+    def __setattr__(self, name, value):
+        # The compact form cached by the RPC serializer is stale once an
+        # attribute changes
+        self.__dict__.pop('rpc_cache', None)
+        super(RequestContext, self).__setattr__(name, value)
+
     def to_dict(self):
         result = super(RequestContext, self).to_dict()
         result['user_id'] = self.user_id
@@ -135,6 +157,17 @@ class RequestContext(context.RequestContext):
         result['request_id'] = self.request_id
         return result
 
+    def to_rpc_dict(self):
+        """Return the compact form of the context sent over RPC."""
+        result = {field: getattr(self, field) for field in RPC_FIELDS}
+        result['roles'] = list(self.roles)
+        if isinstance(self._timestamp, six.string_types):
+            # Received as is, no need to parse it to send it again
+            result['timestamp'] = self._timestamp
+        else:
+            result['timestamp'] = self._timestamp.isoformat()
+        return result
+
     @classmethod
     def from_dict(cls, values):
         return cls(**values)
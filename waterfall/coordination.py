@@ -15,20 +15,32 @@
 
 """Coordination and locking utilities."""
 
+import bisect
+import collections
+import functools
+import hashlib
 import inspect
+import math
+import os
 import random
 import threading
+import time
 import uuid
 
 import eventlet
 from eventlet import tpool
 import itertools
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import encodeutils
+from oslo_utils import excutils
 import six
+import tooz
 from tooz import coordination
 from tooz import locking
 
+from waterfall.common import metrics
 from waterfall import exception
 from waterfall.i18n import _, _LE, _LI, _LW
 
@@ -36,8 +48,16 @@ LOG = log.getLogger(__name__)
 
 coordination_opts = [
     cfg.StrOpt('backend_url',
-               default='file://$state_path',
-               help='The backend URL to use for distributed coordination.'),
+               help='The backend URL to use for distributed coordination. '
+                    'If unset, the local_backend is used, which only '
+                    'coordinates the services running on this host.'),
+    cfg.StrOpt('local_backend',
+               default='file',
+               choices=['file', 'ipc'],
+               help='Backend used when backend_url is unset. The ipc '
+                    'backend has faster locks but no group membership, so '
+                    'leadership is decided by a lock and workflows are not '
+                    'partitioned across managers.'),
     cfg.FloatOpt('heartbeat',
                  default=1.0,
                  help='Number of seconds between heartbeats for distributed '
@@ -50,11 +70,82 @@ coordination_opts = [
                  default=60.0,
                  help='Maximum number of seconds between sequential '
                       'reconnection retries.'),
-
+    cfg.FloatOpt('lock_hold_warning_threshold',
+                 default=30.0,
+                 help='Log a warning when a coordination lock is released '
+                      'after being held for longer than this number of '
+                      'seconds. 0 disables the warning.'),
+    cfg.FloatOpt('lease_renew_interval',
+                 default=5.0,
+                 help='Number of seconds between renewals of the lease '
+                      'locks being held. Must be well below the lock '
+                      'timeout of the backend, e.g. the timeout parameter '
+                      'of a redis or memcached backend_url.'),
+    cfg.IntOpt('hash_ring_replicas',
+               default=100,
+               min=1,
+               help='Number of points each member is given on the hash '
+                    'rings used to partition resources across the members '
+                    'of a group.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(coordination_opts, group='coordination')
+CONF.import_opt('state_path', 'waterfall.common.config')
+
+
+def get_backend_url():
+    """Return the URL of the coordination backend.
+
+    That is `coordination.backend_url` when set, otherwise a configuration
+    of `coordination.local_backend` tuned for the processes of a single
+    host.
+    """
+    url = CONF.coordination.backend_url
+    if url:
+        return url
+    if CONF.coordination.local_backend == 'ipc':
+        return 'ipc://'
+    # Members missing three heartbeats are dropped from the groups, instead
+    # of the 10 seconds default of the file driver.
+    timeout = max(1, int(math.ceil(3 * CONF.coordination.heartbeat)))
+    return 'file://%s?timeout=%d' % (
+        os.path.join(CONF.state_path, 'coordination'), timeout)
+
+
+class HashRing(object):
+    """Consistent hash ring.
+
+    Each node is placed at `replicas` points of the ring and a key belongs
+    to the node of the first point following the hash of the key.  Adding
+    or removing a node only moves the keys of the points it owns, about
+    1/N of them, every other key stays with its node.
+
+    :param nodes: The nodes on the ring.
+    :param int replicas: Points per node, defaults to
+        `coordination.hash_ring_replicas`.
+    """
+
+    def __init__(self, nodes, replicas=None):
+        if replicas is None:
+            replicas = CONF.coordination.hash_ring_replicas
+        self.nodes = frozenset(nodes)
+        points = sorted((self._hash('%s-%d' % (node, replica)), node)
+                        for node in self.nodes
+                        for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._points = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(encodeutils.safe_encode(key)).hexdigest(), 16)
+
+    def get_node(self, key):
+        """Return the node a key belongs to, None if the ring is empty."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._points[index % len(self._points)]
 
 
 class Coordinator(object):
@@ -63,7 +154,8 @@ class Coordinator(object):
     Coordination member id is created from concatenated
     `prefix` and `agent_id` parameters.
 
-    :param str agent_id: Agent identifier
+    :param str agent_id: Agent identifier, a random one is generated for
+        each process if not given.
     :param str prefix: Used to provide member identifier with a
         meaningful prefix.
     """
@@ -71,10 +163,14 @@ class Coordinator(object):
     def __init__(self, agent_id=None, prefix=''):
         self.coordinator = None
         self.agent_id = agent_id or str(uuid.uuid4())
+        # Process the agent id was generated in, None if it was given
+        self._agent_pid = None if agent_id else os.getpid()
         self.started = False
         self.prefix = prefix
         self._ev = None
         self._dead = None
+        self._groups = collections.OrderedDict()
+        self._rings = {}
 
     def is_active(self):
         return self.coordinator is not None
@@ -82,13 +178,20 @@ class Coordinator(object):
     def start(self):
         """Connect to coordination backend and start heartbeat."""
         if not self.started:
+            # Workers forked from the process that created the coordinator
+            # must not join as the same member
+            if self._agent_pid not in (None, os.getpid()):
+                self.agent_id = str(uuid.uuid4())
+                self._agent_pid = os.getpid()
             try:
                 self._dead = threading.Event()
                 self._start()
                 self.started = True
                 # NOTE(bluex): Start heartbeat in separate thread to avoid
-                # being blocked by long coroutines.
-                if self.coordinator and self.coordinator.requires_beating:
+                # being blocked by long coroutines.  It also runs the group
+                # leader elections, so it's needed even by the backends
+                # that don't require beating.
+                if self.coordinator:
                     self._ev = eventlet.spawn(
                         lambda: tpool.execute(self.heartbeat))
             except coordination.ToozError:
@@ -99,12 +202,14 @@ class Coordinator(object):
     def stop(self):
         """Disconnect from coordination backend and stop heartbeat."""
         if self.started:
-            self.coordinator.stop()
             self._dead.set()
+            self._stand_down()
+            self.coordinator.stop()
             if self._ev is not None:
                 self._ev.wait()
             self._ev = None
             self.coordinator = None
+            self._rings = {}
             self.started = False
 
     def get_lock(self, name):
@@ -114,10 +219,185 @@ class Coordinator(object):
             across all nodes.
         """
         if self.coordinator is not None:
-            return self.coordinator.get_lock(self.prefix + name)
+            return self.coordinator.get_lock(
+                encodeutils.safe_encode(self.prefix + name))
         else:
             raise exception.LockCreationFailed(_('Coordinator uninitialized.'))
 
+    def join_group(self, group_id, capabilities=None):
+        """Join a group and run for its leadership.
+
+        Membership is kept across reconnections to the backend.  Use
+        :meth:`is_leader` to know whether this member leads the group.
+
+        :param str group_id: The group name, prefixed like the lock names.
+        :param dict capabilities: Capabilities published with the
+            membership, a `host` key puts the member on the hash ring of
+            the group.
+        """
+        if group_id in self._groups:
+            return
+        self._groups[group_id] = {'leader': False, 'since': None,
+                                  'elections': 0, 'lock': None,
+                                  'capabilities': capabilities}
+        if self.coordinator is not None:
+            self._join_group(group_id)
+
+    def is_leader(self, group_id):
+        """Return whether this member currently leads the group."""
+        state = self._groups.get(group_id)
+        return bool(state and state['leader'])
+
+    def get_hash_ring(self, group_id):
+        """Return a HashRing of the hosts of the members of a group.
+
+        Members are read at most once per heartbeat interval and the ring
+        is only rebuilt when they changed.  Returns None when the
+        coordinator is not started or no member of the group published its
+        host.
+        """
+        if self.coordinator is None:
+            return None
+        now = time.time()
+        cached = self._rings.get(group_id)
+        if cached and now - cached['checked'] < CONF.coordination.heartbeat:
+            return cached['ring']
+
+        name = self._group_name(group_id)
+        try:
+            members = frozenset(self.coordinator.get_members(name).get())
+        except coordination.GroupNotCreated:
+            members = frozenset()
+        except tooz.NotImplemented:
+            return None
+        except coordination.ToozError:
+            LOG.exception(_LE('Error getting the members of group %s.'),
+                          group_id)
+            return cached['ring'] if cached else None
+
+        if cached and cached['members'] == members:
+            cached['checked'] = now
+            return cached['ring']
+
+        hosts = {}
+        if cached:
+            hosts = {member: host for member, host in cached['hosts'].items()
+                     if member in members}
+        for member in members.difference(hosts):
+            try:
+                capabilities = self.coordinator.get_member_capabilities(
+                    name, member).get()
+            except coordination.MemberNotJoined:
+                continue
+            if isinstance(capabilities, dict) and capabilities.get('host'):
+                hosts[member] = encodeutils.safe_decode(capabilities['host'])
+
+        ring = HashRing(hosts.values()) if hosts else None
+        self._rings[group_id] = {'members': members, 'hosts': hosts,
+                                 'ring': ring, 'checked': now}
+        LOG.info(_LI('Hash ring of group %(group)s now has hosts: '
+                     '%(hosts)s.'),
+                 {'group': group_id, 'hosts': sorted(set(hosts.values()))})
+        return ring
+
+    def leadership_report(self):
+        """Return the groups joined by this member and who leads them."""
+        now = time.time()
+        groups = {}
+        for group_id, state in list(self._groups.items()):
+            groups[group_id] = {
+                'leader': state['leader'],
+                'leader_for': now - state['since'] if state['leader'] else 0,
+                'elections': state['elections'],
+                'method': 'lock' if state['lock'] is not None else 'election',
+            }
+        rings = {group_id: sorted(set(ring['hosts'].values()))
+                 for group_id, ring in list(self._rings.items())}
+        return {'member_id': self.prefix + self.agent_id,
+                'active': self.is_active(),
+                'groups': groups,
+                'hash_rings': rings}
+
+    def _group_name(self, group_id):
+        return encodeutils.safe_encode(self.prefix + group_id)
+
+    def _join_group(self, group_id):
+        name = self._group_name(group_id)
+        state = self._groups[group_id]
+        try:
+            try:
+                self.coordinator.create_group(name).get()
+            except coordination.GroupAlreadyExist:
+                pass
+            try:
+                self.coordinator.join_group(
+                    name, capabilities=state['capabilities'] or b'').get()
+            except coordination.MemberAlreadyExist:
+                pass
+            self.coordinator.watch_elected_as_leader(
+                name, functools.partial(self._elected, group_id))
+        except tooz.NotImplemented:
+            # Backends without leader election, like the file one, or
+            # without groups at all, like the ipc one, elect whichever
+            # member holds the leader lock of the group.
+            state['lock'] = self.coordinator.get_lock(name + b'-leader')
+
+    def _elected(self, group_id, event):
+        self._set_leader(group_id, True)
+
+    def _set_leader(self, group_id, leader):
+        state = self._groups[group_id]
+        if state['leader'] == leader:
+            return
+        state['leader'] = leader
+        if leader:
+            state['since'] = time.time()
+            state['elections'] += 1
+            LOG.info(_LI('Elected leader of group %s.'), group_id)
+        else:
+            LOG.info(_LI('No longer leader of group %s.'), group_id)
+
+    def _run_elections(self):
+        """Run the leader elections of the joined groups.
+
+        Called on every heartbeat, so leadership moves to another member at
+        most a heartbeat after its leader is gone.
+        """
+        if not self._groups:
+            return
+        try:
+            self.coordinator.run_watchers()
+        except tooz.NotImplemented:
+            pass
+
+        for group_id, state in list(self._groups.items()):
+            if state['lock'] is not None:
+                if not state['leader']:
+                    self._set_leader(group_id,
+                                     state['lock'].acquire(blocking=False))
+            elif state['leader']:
+                leader = self.coordinator.get_leader(
+                    self._group_name(group_id)).get()
+                if encodeutils.safe_decode(leader) != (self.prefix +
+                                                       self.agent_id):
+                    self._set_leader(group_id, False)
+
+    def _stand_down(self):
+        """Give up the leadership of every joined group."""
+        for group_id, state in list(self._groups.items()):
+            if not state['leader']:
+                continue
+            self._set_leader(group_id, False)
+            try:
+                if state['lock'] is not None:
+                    state['lock'].release()
+                else:
+                    self.coordinator.stand_down_group_leader(
+                        self._group_name(group_id))
+            except (coordination.ToozError, tooz.NotImplemented):
+                LOG.warning(_LW('Error standing down as leader of group '
+                                '%s.'), group_id)
+
     def heartbeat(self):
         """Coordinator heartbeat.
 
@@ -133,20 +413,31 @@ class Coordinator(object):
         while self.coordinator is not None and not self._dead.is_set():
             try:
                 self._heartbeat()
+                self._run_elections()
             except coordination.ToozConnectionError:
+                # Another member may be elected while we are disconnected,
+                # so stop acting as a leader right away.
+                self._stand_down()
                 self._reconnect()
+            except coordination.ToozError:
+                LOG.exception(_LE('Error running leader elections.'))
+                self._dead.wait(cfg.CONF.coordination.heartbeat)
             else:
                 self._dead.wait(cfg.CONF.coordination.heartbeat)
 
     def _start(self):
         member_id = self.prefix + self.agent_id
         self.coordinator = coordination.get_coordinator(
-            cfg.CONF.coordination.backend_url, member_id)
+            get_backend_url(), member_id)
         self.coordinator.start()
+        for group_id in list(self._groups):
+            self._groups[group_id]['lock'] = None
+            self._join_group(group_id)
 
     def _heartbeat(self):
         try:
-            self.coordinator.heartbeat()
+            if self.coordinator.requires_beating:
+                self.coordinator.heartbeat()
             return True
         except coordination.ToozConnectionError:
             LOG.exception(_LE('Connection error while sending a heartbeat '
@@ -176,6 +467,85 @@ class Coordinator(object):
 
 
 COORDINATOR = Coordinator(prefix='waterfall-')
+metrics.register_source('leadership', COORDINATOR.leadership_report)
+
+
+class LockStats(object):
+    """Wait and hold times of the locks of this process.
+
+    Figures are aggregated by lock name template, so all the locks of a
+    given kind of operation add up, while current holders are listed by
+    rendered lock name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(self._new_stats)
+        self._holders = {}
+
+    @staticmethod
+    def _new_stats():
+        return {'acquired': 0, 'failed': 0, 'held': 0,
+                'wait_total': 0.0, 'wait_max': 0.0,
+                'hold_total': 0.0, 'hold_max': 0.0}
+
+    def acquired(self, lock, waited):
+        with self._lock:
+            stats = self._stats[lock.lock_template]
+            stats['acquired'] += 1
+            stats['held'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            self._holders[id(lock)] = (lock.lock_name,
+                                       threading.current_thread().name,
+                                       time.time())
+
+    def failed(self, lock, waited):
+        with self._lock:
+            stats = self._stats[lock.lock_template]
+            stats['failed'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+
+    def released(self, lock):
+        """Record a release and return how long the lock was held."""
+        with self._lock:
+            holder = self._holders.pop(id(lock), None)
+            if holder is None:
+                return 0.0
+            held = time.time() - holder[2]
+            stats = self._stats[lock.lock_template]
+            stats['held'] -= 1
+            stats['hold_total'] += held
+            stats['hold_max'] = max(stats['hold_max'], held)
+            return held
+
+    def report(self):
+        now = time.time()
+        with self._lock:
+            result = {template: dict(stats)
+                      for template, stats in self._stats.items()}
+            holders = [{'name': name, 'holder': holder,
+                        'held': now - since}
+                       for name, holder, since in self._holders.values()]
+        for stats in result.values():
+            attempts = stats['acquired'] + stats['failed']
+            stats['wait_avg'] = (stats['wait_total'] / attempts
+                                 if attempts else 0.0)
+            released = stats['acquired'] - stats['held']
+            stats['hold_avg'] = (stats['hold_total'] / released
+                                 if released else 0.0)
+        return {'locks': result, 'holders': holders}
+
+
+LOCK_STATS = LockStats()
+metrics.register_source('coordination', LOCK_STATS.report)
+
+# Process local semaphores, by rendered lock name, taken before the
+# backend lock so only one thread per process ever waits on the backend.
+_LOCAL_LOCKS = lockutils.Semaphores()
+# Seconds between attempts to take a local lock with a timeout
+_LOCAL_LOCK_POLL_INTERVAL = 0.01
 
 
 class Lock(locking.Lock):
@@ -197,6 +567,10 @@ class Lock(locking.Lock):
         Lock('foo-{workflow.id}, {'workflow': ...,})
 
     Available field names are keys of lock_data.
+
+    Threads of the same process first queue on a process local semaphore
+    with the same name, so only one of them at a time goes to the
+    coordination backend.
     """
     def __init__(self, lock_name, lock_data=None, coordinator=None):
         super(Lock, self).__init__(str(id(self)))
@@ -208,7 +582,22 @@ class Lock(locking.Lock):
     def _prepare_lock(self, lock_name, lock_data):
         if not isinstance(lock_name, six.string_types):
             raise ValueError(_('Not a valid string: %s') % lock_name)
-        return self.coordinator.get_lock(lock_name.format(**lock_data))
+        self.lock_template = lock_name
+        self.lock_name = lock_name.format(**lock_data)
+        self.local_lock = _LOCAL_LOCKS.get(self.lock_name)
+        return self.coordinator.get_lock(self.lock_name)
+
+    def _acquire_local(self, blocking):
+        if blocking is True or blocking is False:
+            return self.local_lock.acquire(blocking)
+        # Semaphore.acquire() takes no timeout on python 2.7
+        deadline = time.time() + blocking
+        while not self.local_lock.acquire(False):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            eventlet.sleep(min(remaining, _LOCAL_LOCK_POLL_INTERVAL))
+        return True
 
     def acquire(self, blocking=None):
         """Attempts to acquire lock.
@@ -220,7 +609,26 @@ class Lock(locking.Lock):
         :rtype: bool
         """
         blocking = self.blocking if blocking is None else blocking
-        return self.lock.acquire(blocking=blocking)
+        start = time.time()
+        if not self._acquire_local(blocking):
+            LOCK_STATS.failed(self, time.time() - start)
+            return False
+
+        if blocking is not True and blocking is not False:
+            # Whatever is left of the timeout goes to the backend
+            blocking = max(0, blocking - (time.time() - start))
+        try:
+            acquired = self.lock.acquire(blocking=blocking)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.local_lock.release()
+                LOCK_STATS.failed(self, time.time() - start)
+        if acquired:
+            LOCK_STATS.acquired(self, time.time() - start)
+        else:
+            self.local_lock.release()
+            LOCK_STATS.failed(self, time.time() - start)
+        return acquired
 
     def release(self):
         """Attempts to release lock.
@@ -230,7 +638,95 @@ class Lock(locking.Lock):
         :return: returns true if released (false if not)
         :rtype: bool
         """
-        self.lock.release()
+        try:
+            self.lock.release()
+        finally:
+            self.local_lock.release()
+            held = LOCK_STATS.released(self)
+            threshold = CONF.coordination.lock_hold_warning_threshold
+            if threshold and held > threshold:
+                LOG.warning(_LW('Lock %(name)s was held for %(held).2f '
+                                'seconds.'),
+                            {'name': self.lock_name, 'held': held})
+
+
+class LeaseLock(Lock):
+    """Lock whose lease is renewed for as long as it is held.
+
+    Backends with expiring locks, like redis or memcached, release the
+    locks of crashed holders after their timeout.  Once acquired, a lease
+    lock renews itself every `coordination.lease_renew_interval` seconds
+    from a green thread, so the backend timeout can be kept short without
+    long running holders losing the lock.
+
+    If a renewal fails the lock is considered lost: renewals stop and the
+    lease loss callbacks are called with the lock, from the renewal green
+    thread.  Holders should stop working on the protected resource as soon
+    as possible when that happens::
+
+        lock = LeaseLock('workflow-{id}', {'id': workflow.id},
+                         on_lost=[lambda lock: driver.abort()])
+
+    :param on_lost: Callables called with the lock when its lease is lost.
+    :param renew_interval: Seconds between renewals, defaults to
+        `coordination.lease_renew_interval`.
+    """
+    def __init__(self, lock_name, lock_data=None, coordinator=None,
+                 on_lost=None, renew_interval=None):
+        super(LeaseLock, self).__init__(lock_name, lock_data, coordinator)
+        self.renew_interval = (renew_interval or
+                               CONF.coordination.lease_renew_interval)
+        self.lost = False
+        self._on_lost = list(on_lost or [])
+        self._renewer = None
+
+    def add_lost_callback(self, callback):
+        """Call `callback` with the lock if its lease gets lost."""
+        self._on_lost.append(callback)
+
+    def acquire(self, blocking=None):
+        acquired = super(LeaseLock, self).acquire(blocking)
+        if acquired:
+            self.lost = False
+            self._renewer = eventlet.spawn(self._renew_until_lost)
+        return acquired
+
+    def release(self):
+        renewer, self._renewer = self._renewer, None
+        if renewer is not None:
+            renewer.kill()
+        return super(LeaseLock, self).release()
+
+    def _renew(self):
+        heartbeat = getattr(self.lock, 'heartbeat', None)
+        if heartbeat is not None:
+            # Older tooz releases return None on success
+            return heartbeat() is not False
+        try:
+            return self.lock.is_still_owner()
+        except tooz.NotImplemented:
+            return True
+
+    def _renew_until_lost(self):
+        while True:
+            eventlet.sleep(self.renew_interval)
+            try:
+                if not self._renew():
+                    break
+            except Exception:
+                LOG.exception(_LE('Error renewing the lease of lock %s.'),
+                              self.lock_name)
+                break
+
+        self._renewer = None
+        self.lost = True
+        LOG.warning(_LW('Lease of lock %s lost.'), self.lock_name)
+        for callback in self._on_lost:
+            try:
+                callback(self)
+            except Exception:
+                LOG.exception(_LE('Error in lease loss callback of lock '
+                                  '%s.'), self.lock_name)
 
 
 def synchronized(lock_name, blocking=True, coordinator=None):
@@ -280,7 +776,43 @@ def synchronized(lock_name, blocking=True, coordinator=None):
             call_args = inspect.getcallargs(f, *a, **k)
             call_args['f_name'] = f.__name__
             lock = Lock(lock_name, call_args, coordinator)
-            with lock(blocking):
+            if not lock.acquire(blocking):
+                raise coordination.LockAcquireFailed(
+                    _('Acquiring lock %s failed') % lock.lock_name)
+            try:
                 return f(*a, **k)
+            finally:
+                lock.release()
+        return wrapped
+    return wrap
+
+
+def leader_only(group_id, coordinator=None):
+    """Run the decorated periodic task only on the leader of a group.
+
+    :param str group_id: Group whose leader runs the task, the members
+        join it with :meth:`Coordinator.join_group`.
+    :param coordinator: Coordinator class to use to check the leadership.
+        Defaults to the global coordinator.
+
+    Members that don't lead the group skip the task, so it runs on exactly
+    one of them.  A process whose coordinator was never started is assumed
+    to run alone and always runs it::
+
+        @periodic_task.periodic_task(spacing=60)
+        @leader_only('workflow-manager')
+        def _sweep(self, context):
+           ...
+    """
+    def wrap(f):
+        @six.wraps(f)
+        def wrapped(*a, **k):
+            coord = coordinator or COORDINATOR
+            if coord.started and not coord.is_leader(group_id):
+                LOG.debug('Skipping %(task)s, not leader of group '
+                          '%(group)s.', {'task': f.__name__,
+                                         'group': group_id})
+                return
+            return f(*a, **k)
         return wrapped
     return wrap
@@ -40,7 +40,6 @@ from oslo_config import cfg
 from oslo_db import concurrency as db_concurrency
 from oslo_db import options as db_options
 
-from waterfall.api import common
 from waterfall.common import constants
 from waterfall.i18n import _
 
@@ -141,9 +140,394 @@ class Case(object):
         self.value = value
         self.else_ = else_
 
+
+def is_orm_value(obj):
+    """Check if object is an ORM field."""
+    return IMPL.is_orm_value(obj)
+
+
+def conditional_update(context, model, values, expected_values, filters=(),
+                       include_deleted='no', project_only=False):
+    """Compare-and-swap conditional update.
+
+    Update will only occur in the DB if conditions are met.
+
+    We have 4 different condition types we can use in expected_values:
+     - Equality:  {'status': 'available'}
+     - Inequality: {'status': vol_obj.Not('deleting')}
+     - In range: {'status': ['available', 'error']
+     - Not in range: {'status': vol_obj.Not(['in-use', 'attaching'])
+
+    Method accepts additional filters, which are basically anything that can
+    be passed to a sqlalchemy query's filter method, for example:
+    [~sql.exists().where(models.Workflow.id == models.Snapshot.workflow_id)]
+
+    We can select values based on conditions using Case objects in the
+    'values' argument. For example:
+    has_snapshot_filter = sql.exists().where(
+        models.Snapshot.workflow_id == models.Workflow.id)
+    case_values = db.Case([(has_snapshot_filter, 'has-snapshot')],
+                          else_='no-snapshot')
+    db.conditional_update(context, models.Workflow, {'status': case_values},
+                          {'status': 'available'})
+
+    And we can use DB fields for example to store previous status in the
+    corresponding field even though we don't know which value is in the db
+    from those we allowed:
+    db.conditional_update(context, models.Workflow,
+                          {'status': 'deleting',
+                           'previous_status': models.Workflow.status},
+                          {'status': ('available', 'error')})
+
+    :param values: Dictionary of key-values to update in the DB.
+    :param expected_values: Dictionary of conditions that must be met for the
+                            update to be executed.
+    :param filters: Iterable with additional filters.
+    :param include_deleted: Should the update include deleted items, this is
+                            equivalent to read_deleted.
+    :param project_only: Should the query be limited to context's project.
+    :returns number of db rows that were updated.
+    """
+    return IMPL.conditional_update(context, model, values, expected_values,
+                                   filters, include_deleted, project_only)
+
+
+def update_returning_supported():
+    """Check if the backend can return values from an UPDATE statement."""
+    return IMPL.update_returning_supported()
+
+
+def conditional_update_returning(context, model, values, expected_values,
+                                 returning, filters=(), include_deleted='no',
+                                 project_only=False):
+    """Compare-and-swap conditional update returning the stored values.
+
+    Behaves like conditional_update, but issues an UPDATE ... RETURNING so the
+    values the DB ended up storing for the `returning` fields are read in the
+    same round-trip.  Callers must check update_returning_supported first.
+
+    :param returning: Iterable with the names of the fields to return.
+    :returns list with a dictionary of the returned fields for each updated
+             row, so it will be empty if we couldn't update the DB.
+    """
+    return IMPL.conditional_update_returning(context, model, values,
+                                             expected_values, returning,
+                                             filters, include_deleted,
+                                             project_only)
+
+
+def get_model_for_versioned_object(versioned_object):
+    return IMPL.get_model_for_versioned_object(versioned_object)
+
+
+def get_by_id(context, model, id, *args, **kwargs):
+    return IMPL.get_by_id(context, model, id, *args, **kwargs)
+
+
+def get_fields_by_id(context, model, id, fields):
+    """Get only the given fields of the entry with the given id.
+
+    :returns dictionary with the values stored in the DB for the fields.
+    """
+    return IMPL.get_fields_by_id(context, model, id, fields)
+
+
+###################
+
+
+def service_destroy(context, service_id):
+    """Destroy the service or raise if it does not exist."""
+    return IMPL.service_destroy(context, service_id)
+
+
+def service_get(context, service_id):
+    """Get a service or raise if it does not exist."""
+    return IMPL.service_get(context, service_id)
+
+
+def service_get_by_host_and_topic(context, host, topic):
+    """Get a service by host it's on and topic it listens to."""
+    return IMPL.service_get_by_host_and_topic(context, host, topic)
+
+
+def service_get_all(context, filters=None):
+    """Get all services."""
+    return IMPL.service_get_all(context, filters)
+
+
+def service_get_all_by_topic(context, topic, disabled=None):
+    """Get all services for a given topic."""
+    return IMPL.service_get_all_by_topic(context, topic, disabled=disabled)
+
+
+def service_get_all_by_binary(context, binary, disabled=None):
+    """Get all services for a given binary."""
+    return IMPL.service_get_all_by_binary(context, binary, disabled)
+
+
+def service_get_by_args(context, host, binary):
+    """Get the state of a service by node name and binary."""
+    return IMPL.service_get_by_args(context, host, binary)
+
+
+def service_create(context, values):
+    """Create a service from the values dictionary."""
+    return IMPL.service_create(context, values)
+
+
+def service_update(context, service_id, values):
+    """Set the given properties on an service and update it.
+
+    Raises NotFound if service does not exist.
+
+    """
+    return IMPL.service_update(context, service_id, values)
+
+
+def service_heartbeat(context, service_ids, availability_zone=None):
+    """Record a heartbeat of the given services in a single UPDATE.
+
+    Returns the ids of the services that no longer exist.
+    """
+    return IMPL.service_heartbeat(context, service_ids,
+                                  availability_zone=availability_zone)
+
+
+###################
+
+
+def workflow_get(context, workflow_id):
+    """Get a workflow or raise if it does not exist."""
+    return IMPL.workflow_get(context, workflow_id)
+
+
 def workflow_get_all(context, filters=None):
     """Get all workflows"""
     return IMPL.workflow_get_all(context, filters)
 
+
+def workflow_get_all_stale(context, statuses, updated_before):
+    """Get the workflows in one of statuses not updated since a time."""
+    return IMPL.workflow_get_all_stale(context, statuses, updated_before)
+
+
 def workflow_create(context, resource_type, payload):
     return IMPL.workflow_create(context, resource_type, payload)
+
+
+def workflow_update_status(context, workflow_id, status, expected=None):
+    """Set the status of a workflow.
+
+    If `expected` is given, a status or a list of them, the workflow is only
+    updated if it currently has one of them.
+
+    :returns: whether the workflow was updated.
+    """
+    return IMPL.workflow_update_status(context, workflow_id, status,
+                                       expected=expected)
+
+
+###################
+
+
+def quota_create(context, project_id, resource, limit, allocated=0):
+    """Create a quota for the given project and resource."""
+    return IMPL.quota_create(context, project_id, resource, limit,
+                             allocated=allocated)
+
+
+def quota_get(context, project_id, resource):
+    """Retrieve a quota or raise if it does not exist."""
+    return IMPL.quota_get(context, project_id, resource)
+
+
+def quota_get_all_by_project(context, project_id):
+    """Retrieve all quotas associated with a given project."""
+    return IMPL.quota_get_all_by_project(context, project_id)
+
+
+def quota_limits_get(context, project_id, quota_class=None, resources=None,
+                     defaults=True):
+    """Retrieve project, quota class and default limits in one query.
+
+    Returns a dict with 'project', 'class' and 'default' keys, each
+    mapping resource names to hard limits.
+    """
+    return IMPL.quota_limits_get(context, project_id,
+                                 quota_class=quota_class,
+                                 resources=resources, defaults=defaults)
+
+
+def quota_allocated_get_all_by_project(context, project_id):
+    """Retrieve all allocated quotas associated with a given project."""
+    return IMPL.quota_allocated_get_all_by_project(context, project_id)
+
+
+def quota_allocated_update(context, project_id,
+                           resource, allocated):
+    """Update allocated quota to subprojects or raise if it does not exist.
+
+    :raises: waterfall.exception.ProjectQuotaNotFound
+    """
+    return IMPL.quota_allocated_update(context, project_id,
+                                       resource, allocated)
+
+
+def quota_update(context, project_id, resource, limit):
+    """Update a quota or raise if it does not exist."""
+    return IMPL.quota_update(context, project_id, resource, limit)
+
+
+def quota_update_resource(context, old_res, new_res):
+    """Update resource of quotas."""
+    return IMPL.quota_update_resource(context, old_res, new_res)
+
+
+def quota_destroy(context, project_id, resource):
+    """Destroy the quota or raise if it does not exist."""
+    return IMPL.quota_destroy(context, project_id, resource)
+
+
+###################
+
+
+def quota_class_create(context, class_name, resource, limit):
+    """Create a quota class for the given name and resource."""
+    return IMPL.quota_class_create(context, class_name, resource, limit)
+
+
+def quota_class_get(context, class_name, resource):
+    """Retrieve a quota class or raise if it does not exist."""
+    return IMPL.quota_class_get(context, class_name, resource)
+
+
+def quota_class_get_default(context):
+    """Retrieve all default quotas."""
+    return IMPL.quota_class_get_default(context)
+
+
+def quota_class_get_all_by_name(context, class_name):
+    """Retrieve all quotas associated with a given quota class."""
+    return IMPL.quota_class_get_all_by_name(context, class_name)
+
+
+def quota_class_update(context, class_name, resource, limit):
+    """Update a quota class or raise if it does not exist."""
+    return IMPL.quota_class_update(context, class_name, resource, limit)
+
+
+def quota_class_update_resource(context, resource, new_resource):
+    """Update resource name in quota_class."""
+    return IMPL.quota_class_update_resource(context, resource, new_resource)
+
+
+def quota_class_destroy(context, class_name, resource):
+    """Destroy the quota class or raise if it does not exist."""
+    return IMPL.quota_class_destroy(context, class_name, resource)
+
+
+def quota_class_destroy_all_by_name(context, class_name):
+    """Destroy all quotas associated with a given quota class."""
+    return IMPL.quota_class_destroy_all_by_name(context, class_name)
+
+
+###################
+
+
+def quota_usage_get(context, project_id, resource):
+    """Retrieve a quota usage or raise if it does not exist."""
+    return IMPL.quota_usage_get(context, project_id, resource)
+
+
+def quota_usage_get_all_by_project(context, project_id):
+    """Retrieve all usage associated with a given resource."""
+    return IMPL.quota_usage_get_all_by_project(context, project_id)
+
+
+def quota_usage_update_resource(context, old_res, new_res):
+    """Update resource field in quota_usages."""
+    return IMPL.quota_usage_update_resource(context, old_res, new_res)
+
+
+###################
+
+
+def quota_reserve(context, resources, quotas, deltas, expire,
+                  until_refresh, max_age, project_id=None,
+                  is_allocated_reserve=False, stripes=1):
+    """Check quotas and create appropriate reservations.
+
+    With stripes > 1 reservations are spread over that many usage rows
+    per resource when the project is not close to its limits.
+    """
+    return IMPL.quota_reserve(context, resources, quotas, deltas, expire,
+                              until_refresh, max_age, project_id=project_id,
+                              is_allocated_reserve=is_allocated_reserve,
+                              stripes=stripes)
+
+
+def quota_reserve_from_blocks(context, project_id, blocks, deltas, expire):
+    """Create reservations out of blocks of quota already reserved.
+
+    :param blocks: Dictionary mapping resource names to the uuid of the
+                   block reservation each delta is taken from.
+    """
+    return IMPL.quota_reserve_from_blocks(context, project_id, blocks,
+                                          deltas, expire)
+
+
+def quota_usage_flush(context, resources, project_id, blocks, expire,
+                      refresh=None, until_refresh=None, trim=None):
+    """Apply the settled reservations made from blocks to the usages.
+
+    :returns: dictionary mapping the uuids of the blocks still reserved to
+              their size and the part of it pending reservations hold.
+    """
+    return IMPL.quota_usage_flush(context, resources, project_id, blocks,
+                                  expire, refresh=refresh,
+                                  until_refresh=until_refresh, trim=trim)
+
+
+def quota_usage_reconcile(context):
+    """Fold striped usage counts back into a single row."""
+    return IMPL.quota_usage_reconcile(context)
+
+
+def reservation_commit(context, reservations, project_id=None):
+    """Commit quota reservations."""
+    return IMPL.reservation_commit(context, reservations,
+                                   project_id=project_id)
+
+
+def reservation_rollback(context, reservations, project_id=None):
+    """Roll back quota reservations."""
+    return IMPL.reservation_rollback(context, reservations,
+                                     project_id=project_id)
+
+
+def reservation_commit_many(context, reservations):
+    """Commit quota reservations of several projects in one transaction.
+
+    :param reservations: Dictionary mapping project ids to lists of
+                         reservation UUIDs.
+    """
+    return IMPL.reservation_commit_many(context, reservations)
+
+
+def reservation_rollback_many(context, reservations):
+    """Roll back quota reservations of several projects in one transaction.
+
+    :param reservations: Dictionary mapping project ids to lists of
+                         reservation UUIDs.
+    """
+    return IMPL.reservation_rollback_many(context, reservations)
+
+
+def quota_destroy_by_project(context, project_id):
+    """Destroy all quotas associated with a given project."""
+    return IMPL.quota_destroy_by_project(context, project_id)
+
+
+def reservation_expire(context, batch_size=None):
+    """Roll back any expired reservations, batch_size at a time."""
+    return IMPL.reservation_expire(context, batch_size=batch_size)
@@ -38,6 +38,7 @@ from oslo_utils import timeutils
 from oslo_utils import uuidutils
 osprofiler_sqlalchemy = importutils.try_import('osprofiler.sqlalchemy')
 import six
+from six.moves import collections_abc
 import sqlalchemy
 from sqlalchemy import MetaData
 from sqlalchemy import or_, and_, case
@@ -51,7 +52,7 @@ from sqlalchemy.sql.expression import true
 from sqlalchemy.sql import func
 from sqlalchemy.sql import sqltypes
 
-from waterfall.api import common
+from waterfall.common import metrics
 from waterfall.common import sqlalchemyutils
 from waterfall import db
 from waterfall.db.sqlalchemy import models
@@ -89,6 +90,7 @@ def _create_facade_lazily():
                     osprofiler_sqlalchemy.add_tracing(sqlalchemy,
                                                       _FACADE.get_engine(),
                                                       "db")
+            metrics.register_source('db_pool', _pool_stats)
 
         return _FACADE
 
@@ -106,6 +108,19 @@ def get_session(**kwargs):
 def dispose_engine():
     get_engine().dispose()
 
+
+def _pool_stats():
+    """Return the state of the connection pool of the engine."""
+    if _FACADE is None:
+        return {}
+    pool = _FACADE.get_engine().pool
+    stats = {'pool': pool.__class__.__name__, 'status': pool.status()}
+    # Only the queue pools have a size, SQLite uses simpler ones
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
 _DEFAULT_QUOTA_NAME = 'default'
 
 
@@ -222,6 +237,11 @@ def require_snapshot_exists(f):
     return wrapper
 
 
+# Usage rows are only created once per project, resource and stripe, a
+# call racing to create several of them may have to retry once for each
+_DUPLICATE_RETRIES = 3
+
+
 def _retry_on_deadlock(f):
     """Decorator to retry a DB API call if Deadlock was received."""
     @functools.wraps(f)
@@ -240,6 +260,26 @@ def _retry_on_deadlock(f):
     return wrapped
 
 
+def _retry_on_duplicate(f):
+    """Decorator to retry a DB API call that raced to create the same row.
+
+    The other transaction has created the row by then, so the call finds
+    it when retried.
+    """
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        for attempt in range(_DUPLICATE_RETRIES, -1, -1):
+            try:
+                return f(*args, **kwargs)
+            except db_exc.DBDuplicateEntry as e:
+                if not attempt:
+                    raise
+                LOG.debug("Duplicate %(columns)s created concurrently when "
+                          "running '%(func_name)s': Retrying...",
+                          {'columns': e.columns, 'func_name': f.__name__})
+    return wrapped
+
+
 def handle_db_data_error(f):
     def wrapper(*args, **kwargs):
         try:
@@ -288,11 +328,205 @@ def model_query(context, *args, **kwargs):
 ###################
 
 
+@require_admin_context
+def service_destroy(context, service_id):
+    session = get_session()
+    with session.begin():
+        service_ref = _service_get(context, service_id, session=session)
+        service_ref.delete(session)
+
+
+@require_admin_context
+def _service_get(context, service_id, session=None):
+    result = model_query(
+        context,
+        models.Service,
+        session=session).\
+        filter_by(id=service_id).\
+        first()
+    if not result:
+        raise exception.ServiceNotFound(service_id=service_id)
+
+    return result
+
+
+@require_admin_context
+def service_get(context, service_id):
+    return _service_get(context, service_id)
+
+
+@require_admin_context
+def service_get_all(context, filters=None):
+    query = model_query(context, models.Service)
+
+    if filters:
+        filters = dict(filters)
+        try:
+            host = filters.pop('host')
+            host_attr = models.Service.host
+            conditions = or_(host_attr ==
+                             host, host_attr.op('LIKE')(host + '@%'))
+            query = query.filter(conditions)
+        except KeyError:
+            pass
+
+        query = query.filter_by(**filters)
+
+    return query.all()
+
+
+@require_admin_context
+def service_get_all_by_topic(context, topic, disabled=None):
+    query = model_query(
+        context, models.Service, read_deleted="no").\
+        filter_by(topic=topic)
+
+    if disabled is not None:
+        query = query.filter_by(disabled=disabled)
+
+    return query.all()
+
+
+@require_admin_context
+def service_get_all_by_binary(context, binary, disabled=None):
+    query = model_query(
+        context, models.Service, read_deleted="no").filter_by(binary=binary)
+
+    if disabled is not None:
+        query = query.filter_by(disabled=disabled)
+
+    return query.all()
+
+
+@require_admin_context
+def service_get_by_host_and_topic(context, host, topic):
+    result = model_query(
+        context, models.Service, read_deleted="no").\
+        filter_by(disabled=False).\
+        filter_by(host=host).\
+        filter_by(topic=topic).\
+        first()
+    if not result:
+        raise exception.ServiceNotFound(service_id=topic,
+                                        host=host)
+    return result
+
+
+@require_admin_context
+def service_get_by_args(context, host, binary):
+    results = model_query(context, models.Service).\
+        filter_by(host=host).\
+        filter_by(binary=binary).\
+        all()
+
+    for result in results:
+        if host == result['host']:
+            return result
+
+    raise exception.ServiceNotFound(service_id=binary,
+                                    host=host)
+
+
+@require_admin_context
+def service_create(context, values):
+    service_ref = models.Service()
+    service_ref.update(values)
+    if not CONF.enable_new_services:
+        service_ref.disabled = True
+
+    session = get_session()
+    with session.begin():
+        service_ref.save(session)
+        return service_ref
+
+
+@require_admin_context
+@_retry_on_deadlock
+def service_update(context, service_id, values):
+    session = get_session()
+    with session.begin():
+        service_ref = _service_get(context, service_id, session=session)
+        if ('disabled' in values):
+            service_ref['modified_at'] = timeutils.utcnow()
+            service_ref['updated_at'] = literal_column('updated_at')
+        service_ref.update(values)
+        return service_ref
+
+
+@require_admin_context
+@_retry_on_deadlock
+def service_heartbeat(context, service_ids, availability_zone=None):
+    """Bump report_count and updated_at of the services.
+
+    The counter is incremented by the database, so all the services of a
+    process are reported with one UPDATE and without reading them first.
+    The rows are only read back if fewer than expected were updated, to
+    find which services are gone.
+    """
+    service_ids = set(service_ids)
+    if not service_ids:
+        return set()
+
+    values = {'report_count': models.Service.report_count + 1,
+              'updated_at': timeutils.utcnow()}
+    if availability_zone is not None:
+        values['availability_zone'] = availability_zone
+
+    session = get_session()
+    with session.begin():
+        count = model_query(context, models.Service, session=session,
+                            read_deleted="no").\
+            filter(models.Service.id.in_(service_ids)).\
+            update(values, synchronize_session=False)
+        if count == len(service_ids):
+            return set()
+
+        rows = model_query(context, models.Service.id, session=session,
+                           read_deleted="no").\
+            filter(models.Service.id.in_(service_ids)).\
+            all()
+    return service_ids - set(row[0] for row in rows)
+
+
+###################
+
+
+@require_context
+def _workflow_get(context, workflow_id, session=None):
+    result = model_query(context, models.Workflow, session=session,
+                         project_only=True).\
+        filter_by(id=workflow_id).\
+        first()
+
+    if not result:
+        raise exception.WorkflowNotFound(workflow_id=workflow_id)
+
+    return result
+
+
+@require_context
+def workflow_get(context, workflow_id):
+    return _workflow_get(context, workflow_id)
+
+
 #@require_admin_context
 def workflow_get_all(context, filters=None):
     query = model_query(context, models.Workflow)
     return query.all()
 
+
+@require_admin_context
+def workflow_get_all_stale(context, statuses, updated_before):
+    """Get the workflows in one of statuses not updated since a time."""
+    return model_query(context, models.Workflow, read_deleted="no").\
+        filter(models.Workflow.status.in_(statuses)).\
+        filter(or_(models.Workflow.updated_at < updated_before,
+                   and_(models.Workflow.updated_at.is_(None),
+                        models.Workflow.created_at < updated_before))).\
+        order_by(models.Workflow.id.asc()).\
+        all()
+
+
 def workflow_create(context, resource_type, payload):
     workflow_ref = models.Workflow()
     workflow_ref.project_id = context.project_id
@@ -304,3 +538,1349 @@ def workflow_create(context, resource_type, payload):
     with session.begin():
         workflow_ref.save(session)
         return workflow_ref
+
+
+@require_context
+def workflow_update_status(context, workflow_id, status, expected=None):
+    expected_values = {}
+    if expected is not None:
+        expected_values['status'] = expected
+    expected_values['id'] = workflow_id
+    return conditional_update(context, models.Workflow,
+                              {'status': status,
+                               'updated_at': timeutils.utcnow()},
+                              expected_values)
+
+
+###################
+
+
+def _sync_workflows(context, project_id, session, workflow_type_id=None,
+                    workflow_type_name=None):
+    query = model_query(context, func.count(models.Workflow.id),
+                        read_deleted="no", session=session).\
+        filter_by(project_id=project_id)
+    key = 'workflows'
+    if workflow_type_name:
+        key += '_' + workflow_type_name
+    return {key: query.scalar() or 0}
+
+
+QUOTA_SYNC_FUNCTIONS = {
+    '_sync_workflows': _sync_workflows,
+}
+
+
+###################
+
+
+@require_context
+def _quota_get(context, project_id, resource, session=None):
+    result = model_query(context, models.Quota, session=session,
+                         read_deleted="no").\
+        filter_by(project_id=project_id).\
+        filter_by(resource=resource).\
+        first()
+
+    if not result:
+        raise exception.ProjectQuotaNotFound(project_id=project_id)
+
+    return result
+
+
+@require_context
+def quota_get(context, project_id, resource):
+    return _quota_get(context, project_id, resource)
+
+
+@require_context
+def quota_get_all_by_project(context, project_id):
+    authorize_project_context(context, project_id)
+
+    rows = model_query(context, models.Quota, read_deleted="no").\
+        filter_by(project_id=project_id).\
+        all()
+
+    result = {'project_id': project_id}
+    for row in rows:
+        result[row.resource] = row.hard_limit
+
+    return result
+
+
+@require_context
+def quota_limits_get(context, project_id, quota_class=None,
+                     resources=None, defaults=True):
+    authorize_project_context(context, project_id)
+    if quota_class:
+        authorize_quota_class_context(context, quota_class)
+
+    # NOTE: Project, class and default limits are fetched with a single
+    # UNION ALL so that checking any number of resources is one round trip
+    project_query = model_query(context, models.Quota.resource,
+                                models.Quota.hard_limit,
+                                literal_column("0").label('source'),
+                                read_deleted="no").\
+        filter(models.Quota.project_id == project_id)
+    if resources is not None:
+        project_query = project_query.filter(
+            models.Quota.resource.in_(resources))
+    queries = []
+
+    class_names = []
+    if quota_class:
+        class_names.append(quota_class)
+    if defaults:
+        class_names.append(_DEFAULT_QUOTA_NAME)
+    if class_names:
+        class_query = model_query(
+            context, models.QuotaClass.resource, models.QuotaClass.hard_limit,
+            case([(models.QuotaClass.class_name == _DEFAULT_QUOTA_NAME, 2)],
+                 else_=1).label('source'),
+            read_deleted="no").\
+            filter(models.QuotaClass.class_name.in_(class_names))
+        if resources is not None:
+            class_query = class_query.filter(
+                models.QuotaClass.resource.in_(resources))
+        queries.append(class_query)
+
+    if queries:
+        project_query = project_query.union_all(*queries)
+
+    result = {'project': {}, 'class': {}, 'default': {}}
+    sources = ('project', 'class', 'default')
+    for resource, hard_limit, source in project_query.all():
+        result[sources[source]][resource] = hard_limit
+
+    # Rows of the default class were all tagged as defaults above
+    if quota_class == _DEFAULT_QUOTA_NAME:
+        result['class'] = result['default']
+        if not defaults:
+            result['default'] = {}
+    return result
+
+
+@require_context
+def quota_allocated_get_all_by_project(context, project_id, session=None):
+    rows = model_query(context, models.Quota, read_deleted='no',
+                       session=session).\
+        filter_by(project_id=project_id).\
+        all()
+    result = {'project_id': project_id}
+    for row in rows:
+        result[row.resource] = row.allocated
+    return result
+
+
+@require_context
+def _quota_get_by_resource(context, resource, session=None):
+    rows = model_query(context, models.Quota,
+                       session=session,
+                       read_deleted='no').\
+        filter_by(resource=resource).\
+        all()
+    return rows
+
+
+@handle_db_data_error
+@require_admin_context
+def quota_create(context, project_id, resource, limit, allocated=0,
+                 session=None):
+    quota_ref = models.Quota()
+    quota_ref.project_id = project_id
+    quota_ref.resource = resource
+    quota_ref.hard_limit = limit
+    if allocated:
+        quota_ref.allocated = allocated
+
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        quota_ref.save(session)
+        return quota_ref
+
+
+@handle_db_data_error
+@require_admin_context
+def quota_update(context, project_id, resource, limit):
+    session = get_session()
+    with session.begin():
+        quota_ref = _quota_get(context, project_id, resource, session=session)
+        quota_ref.hard_limit = limit
+        return quota_ref
+
+
+@require_context
+def quota_update_resource(context, old_res, new_res):
+    session = get_session()
+    with session.begin():
+        quotas = _quota_get_by_resource(context, old_res, session=session)
+        for quota in quotas:
+            quota.resource = new_res
+
+
+@require_admin_context
+def quota_allocated_update(context, project_id, resource, allocated,
+                           session=None):
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        quota_ref = _quota_get(context, project_id, resource, session=session)
+        quota_ref.allocated = allocated
+        return quota_ref
+
+
+@require_admin_context
+def quota_destroy(context, project_id, resource):
+    session = get_session()
+    with session.begin():
+        quota_ref = _quota_get(context, project_id, resource, session=session)
+        return quota_ref.delete(session=session)
+
+
+###################
+
+
+@require_context
+def _quota_class_get(context, class_name, resource, session=None):
+    result = model_query(context, models.QuotaClass, session=session,
+                         read_deleted="no").\
+        filter_by(class_name=class_name).\
+        filter_by(resource=resource).\
+        first()
+
+    if not result:
+        raise exception.QuotaClassNotFound(class_name=class_name)
+
+    return result
+
+
+@require_context
+def quota_class_get(context, class_name, resource):
+    return _quota_class_get(context, class_name, resource)
+
+
+def quota_class_get_default(context):
+    rows = model_query(context, models.QuotaClass,
+                       read_deleted="no").\
+        filter_by(class_name=_DEFAULT_QUOTA_NAME).\
+        all()
+
+    result = {'class_name': _DEFAULT_QUOTA_NAME}
+    for row in rows:
+        result[row.resource] = row.hard_limit
+
+    return result
+
+
+@require_context
+def quota_class_get_all_by_name(context, class_name):
+    authorize_quota_class_context(context, class_name)
+
+    rows = model_query(context, models.QuotaClass, read_deleted="no").\
+        filter_by(class_name=class_name).\
+        all()
+
+    result = {'class_name': class_name}
+    for row in rows:
+        result[row.resource] = row.hard_limit
+
+    return result
+
+
+@require_context
+def _quota_class_get_all_by_resource(context, resource, session):
+    result = model_query(context, models.QuotaClass,
+                         session=session,
+                         read_deleted="no").\
+        filter_by(resource=resource).\
+        all()
+
+    return result
+
+
+@handle_db_data_error
+@require_admin_context
+def quota_class_create(context, class_name, resource, limit):
+    quota_class_ref = models.QuotaClass()
+    quota_class_ref.class_name = class_name
+    quota_class_ref.resource = resource
+    quota_class_ref.hard_limit = limit
+
+    session = get_session()
+    with session.begin():
+        quota_class_ref.save(session)
+        return quota_class_ref
+
+
+@handle_db_data_error
+@require_admin_context
+def quota_class_update(context, class_name, resource, limit):
+    session = get_session()
+    with session.begin():
+        quota_class_ref = _quota_class_get(context, class_name, resource,
+                                           session=session)
+        quota_class_ref.hard_limit = limit
+        return quota_class_ref
+
+
+@require_context
+def quota_class_update_resource(context, old_res, new_res):
+    session = get_session()
+    with session.begin():
+        quota_class_list = _quota_class_get_all_by_resource(
+            context, old_res, session)
+        for quota_class in quota_class_list:
+            quota_class.resource = new_res
+
+
+@require_admin_context
+def quota_class_destroy(context, class_name, resource):
+    session = get_session()
+    with session.begin():
+        quota_class_ref = _quota_class_get(context, class_name, resource,
+                                           session=session)
+        return quota_class_ref.delete(session=session)
+
+
+@require_admin_context
+def quota_class_destroy_all_by_name(context, class_name):
+    session = get_session()
+    with session.begin():
+        quota_classes = model_query(context, models.QuotaClass,
+                                    session=session, read_deleted="no").\
+            filter_by(class_name=class_name).\
+            all()
+
+        for quota_class_ref in quota_classes:
+            quota_class_ref.delete(session=session)
+
+
+###################
+
+
+class _StripedUsage(object):
+    """The usage of a resource, which may be striped over several rows.
+
+    Reads return the sum of all the stripes.  Changes made through this
+    object are applied to the lowest stripe, so code written for a single
+    usage row keeps working when the rows are locked together.
+    """
+
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda row: row.stripe)
+
+    @property
+    def primary(self):
+        return self.rows[0]
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def in_use(self):
+        return sum(row.in_use for row in self.rows)
+
+    @in_use.setter
+    def in_use(self, value):
+        self.primary.in_use += value - self.in_use
+
+    @property
+    def reserved(self):
+        return sum(row.reserved for row in self.rows)
+
+    @reserved.setter
+    def reserved(self, value):
+        self.primary.reserved += value - self.reserved
+
+    @property
+    def total(self):
+        return self.in_use + self.reserved
+
+    @property
+    def until_refresh(self):
+        return self.primary.until_refresh
+
+    @until_refresh.setter
+    def until_refresh(self, value):
+        for row in self.rows:
+            row.until_refresh = value
+
+
+def _group_usage_stripes(rows):
+    stripes = collections.defaultdict(list)
+    for row in rows:
+        stripes[row.resource].append(row)
+    return {resource: _StripedUsage(resource_rows)
+            for resource, resource_rows in stripes.items()}
+
+
+@require_context
+def quota_usage_get(context, project_id, resource):
+    rows = model_query(context, models.QuotaUsage, read_deleted="no").\
+        filter_by(project_id=project_id).\
+        filter_by(resource=resource).\
+        all()
+
+    if not rows:
+        raise exception.QuotaUsageNotFound(project_id=project_id)
+
+    return _StripedUsage(rows)
+
+
+@require_context
+def quota_usage_get_all_by_project(context, project_id):
+    authorize_project_context(context, project_id)
+
+    rows = model_query(context, models.QuotaUsage.resource,
+                       func.sum(models.QuotaUsage.in_use),
+                       func.sum(models.QuotaUsage.reserved),
+                       read_deleted="no").\
+        filter_by(project_id=project_id).\
+        group_by(models.QuotaUsage.resource).\
+        all()
+
+    result = {'project_id': project_id}
+    for resource, in_use, reserved in rows:
+        result[resource] = dict(in_use=int(in_use), reserved=int(reserved))
+
+    return result
+
+
+@require_admin_context
+def _quota_usage_create(context, project_id, resource, in_use, reserved,
+                        until_refresh, session=None, stripe=0):
+
+    quota_usage_ref = models.QuotaUsage()
+    quota_usage_ref.project_id = project_id
+    quota_usage_ref.resource = resource
+    quota_usage_ref.stripe = stripe
+    quota_usage_ref.in_use = in_use
+    quota_usage_ref.reserved = reserved
+    quota_usage_ref.until_refresh = until_refresh
+    quota_usage_ref.save(session=session)
+
+    return quota_usage_ref
+
+
+###################
+
+
+def _reservation_create(context, uuid, usage, project_id, resource, delta,
+                        expire, session=None, allocated_id=None,
+                        block_uuid=None):
+    usage_id = usage['id'] if usage else None
+    reservation_ref = models.Reservation()
+    reservation_ref.uuid = uuid
+    reservation_ref.usage_id = usage_id
+    reservation_ref.project_id = project_id
+    reservation_ref.resource = resource
+    reservation_ref.delta = delta
+    reservation_ref.expire = expire
+    reservation_ref.allocated_id = allocated_id
+    reservation_ref.block_uuid = block_uuid
+    reservation_ref.save(session=session)
+    return reservation_ref
+
+
+###################
+
+
+# NOTE(johannes): The quota code uses SQL locking to ensure races don't
+# cause under or over counting of resources. To avoid deadlocks, this
+# code always acquires the lock on quota_usages before acquiring the lock
+# on reservations.
+
+def _get_quota_usages(context, session, project_id):
+    # Broken out for testability
+    rows = model_query(context, models.QuotaUsage,
+                       read_deleted="no",
+                       session=session).\
+        filter_by(project_id=project_id).\
+        order_by(models.QuotaUsage.id.asc()).\
+        with_lockmode('update').\
+        all()
+    return _group_usage_stripes(rows)
+
+
+def _get_quota_usages_by_resource(context, session, resource):
+    rows = model_query(context, models.QuotaUsage,
+                       read_deleted="no",
+                       session=session).\
+        filter_by(resource=resource).\
+        order_by(models.QuotaUsage.id.asc()).\
+        with_lockmode('update').\
+        all()
+    return rows
+
+
+@require_context
+@_retry_on_deadlock
+def quota_usage_update_resource(context, old_res, new_res):
+    session = get_session()
+    with session.begin():
+        usages = _get_quota_usages_by_resource(context, session, old_res)
+        for usage in usages:
+            usage.resource = new_res
+            usage.until_refresh = 1
+
+
+def _fold_block_reservations(context, session, usages, project_id):
+    """Apply the settled reservations made from blocks to the usages.
+
+    Committed reservations are added to in_use and taken out of their
+    block, which keeps the rest reserved.  The reservations are then
+    detached from their block, so they are only applied once.  Missing
+    usage rows are created and `usages` is updated in place.
+
+    :returns: dictionary mapping the block uuids to what the reservations
+              made from them and still pending take out of them.
+    """
+    rows = model_query(context, models.Reservation, read_deleted="yes",
+                       session=session).\
+        filter_by(project_id=project_id).\
+        filter(models.Reservation.block_uuid.isnot(None)).\
+        order_by(models.Reservation.id.asc()).\
+        with_lockmode('update').\
+        all()
+
+    held = collections.defaultdict(int)
+    settled = []
+    for row in rows:
+        if row.deleted:
+            settled.append(row)
+        elif row.delta > 0:
+            held[row.block_uuid] += row.delta
+    if not settled:
+        return held
+
+    blocks = model_query(context, models.Reservation, read_deleted="no",
+                         session=session).\
+        filter(models.Reservation.uuid.in_(
+            set(row.block_uuid for row in settled))).\
+        order_by(models.Reservation.id.asc()).\
+        with_lockmode('update').\
+        all()
+    blocks = {block.uuid: block for block in blocks}
+    usage_rows = {row.id: row for usage in usages.values()
+                  for row in usage.rows}
+
+    in_use = collections.defaultdict(int)
+    for row in settled:
+        # Rolled back reservations were set to 0
+        in_use[row.resource] += row.delta
+        block = blocks.get(row.block_uuid)
+        if block is not None and row.delta > 0:
+            # NOTE: An expired block was rolled back whole already
+            shrink = min(row.delta, block.delta)
+            block.delta -= shrink
+            if block.usage_id in usage_rows:
+                usage_rows[block.usage_id].reserved -= shrink
+        row.block_uuid = None
+
+    for block in blocks.values():
+        if not block.delta:
+            block.delete(session=session)
+
+    for resource, delta in in_use.items():
+        if not delta:
+            continue
+        if resource not in usages:
+            usages[resource] = _StripedUsage([_quota_usage_create(
+                context.elevated(), project_id, resource, 0, 0, None,
+                session=session)])
+        usages[resource].in_use += delta
+    return held
+
+
+def _refresh_quota_usages(context, session, resources, usages, project_id,
+                          keys, until_refresh):
+    """Recount the usage of keys with the resources' sync functions.
+
+    Missing usage rows are created and `usages` is updated in place.
+    """
+    # The counts include what the settled reservations made from blocks
+    # created, they must not be applied on top of them later
+    _fold_block_reservations(context, session, usages, project_id)
+
+    elevated = context.elevated()
+    work = set(keys)
+    while work:
+        resource = work.pop()
+
+        # Grab the sync routine
+        sync = QUOTA_SYNC_FUNCTIONS[resources[resource].sync]
+        workflow_type_id = getattr(resources[resource],
+                                   'workflow_type_id', None)
+        workflow_type_name = getattr(resources[resource],
+                                     'workflow_type_name', None)
+        updates = sync(elevated, project_id,
+                       workflow_type_id=workflow_type_id,
+                       workflow_type_name=workflow_type_name,
+                       session=session)
+        for res, in_use in updates.items():
+            # Make sure we have a destination for the usage!
+            if res not in usages:
+                usages[res] = _StripedUsage([_quota_usage_create(
+                    elevated, project_id, res, 0, 0, until_refresh or None,
+                    session=session)])
+
+            # Update the usage
+            usages[res].in_use = in_use
+            usages[res].until_refresh = until_refresh or None
+
+            # Because more than one resource may be refreshed
+            # by the call to the sync routine, and we don't
+            # want to double-sync, we make sure all refreshed
+            # resources are dropped from the work set.
+            work.discard(res)
+
+            # NOTE(Vek): We make the assumption that the sync
+            #            routine actually refreshes the
+            #            resources that it is the sync routine
+            #            for.  We don't check, because this is
+            #            a best-effort mechanism.
+
+
+def _quota_reserve_striped(context, quotas, deltas, expire, until_refresh,
+                           max_age, project_id, stripes):
+    """Reserve by locking a single stripe of each usage.
+
+    Returns None when the reservation has to go through the regular path,
+    which locks every usage row of the project: usages that need a
+    refresh, and reservations that are close to or over the limit.
+    Otherwise the headroom is at least `stripes` times each delta, so
+    the at most `stripes` reservations running concurrently on other
+    stripes can't take the usage over the limit.
+    """
+    elevated = context.elevated()
+    reservation_uuids = {resource: str(uuid.uuid4()) for resource in deltas}
+    stripe = uuid.UUID(reservation_uuids[min(deltas)]).int % stripes
+    resources = sorted(deltas)
+
+    session = get_session()
+    with session.begin():
+        locked = model_query(context, models.QuotaUsage, read_deleted="no",
+                             session=session).\
+            filter_by(project_id=project_id, stripe=stripe).\
+            filter(models.QuotaUsage.resource.in_(resources)).\
+            order_by(models.QuotaUsage.id.asc()).\
+            with_lockmode('update').\
+            all()
+        locked = {row.resource: row for row in locked}
+
+        totals = model_query(context, models.QuotaUsage.resource,
+                             func.sum(models.QuotaUsage.in_use),
+                             func.sum(models.QuotaUsage.reserved),
+                             read_deleted="no", session=session).\
+            filter_by(project_id=project_id).\
+            filter(models.QuotaUsage.resource.in_(resources)).\
+            group_by(models.QuotaUsage.resource).\
+            all()
+        totals = {resource: (int(in_use), int(reserved))
+                  for resource, in_use, reserved in totals}
+
+        for resource, delta in deltas.items():
+            if resource not in totals:
+                return None
+            in_use, reserved = totals[resource]
+            if in_use < 0:
+                # Desynced usage, let the regular path heal it
+                return None
+            row = locked.get(resource)
+            if row is not None:
+                if row.until_refresh is not None and row.until_refresh <= 1:
+                    return None
+                if max_age and row.updated_at is not None and (
+                        (timeutils.utcnow() - row.updated_at).
+                        total_seconds() >= max_age):
+                    return None
+            if quotas[resource] >= 0 and delta > 0 and (
+                    quotas[resource] - in_use - reserved < stripes * delta):
+                return None
+
+        reservations = []
+        for resource in resources:
+            delta = deltas[resource]
+            row = locked.get(resource)
+            if row is None:
+                row = _quota_usage_create(elevated, project_id, resource,
+                                          0, 0, until_refresh or None,
+                                          session=session, stripe=stripe)
+            elif row.until_refresh is not None:
+                row.until_refresh -= 1
+
+            reservation = _reservation_create(
+                elevated, reservation_uuids[resource], row, project_id,
+                resource, delta, expire, session=session)
+            reservations.append(reservation.uuid)
+
+            # NOTE(Vek): Only positive increments are reserved, see
+            #            quota_reserve.
+            if delta > 0:
+                row.reserved += delta
+
+        unders = [r for r, delta in deltas.items()
+                  if delta < 0 and delta + totals[r][0] < 0]
+
+    if unders:
+        LOG.warning(_LW("Change will make usage less than 0 for the following "
+                        "resources: %s"), unders)
+    return reservations
+
+
+@require_context
+@_retry_on_deadlock
+@_retry_on_duplicate
+def quota_reserve(context, resources, quotas, deltas, expire,
+                  until_refresh, max_age, project_id=None,
+                  is_allocated_reserve=False, stripes=1):
+    if project_id is None:
+        project_id = context.project_id
+
+    if stripes > 1 and deltas and not is_allocated_reserve:
+        reservations = _quota_reserve_striped(context, quotas, deltas, expire,
+                                              until_refresh, max_age,
+                                              project_id, stripes)
+        if reservations is not None:
+            return reservations
+
+    elevated = context.elevated()
+    session = get_session()
+    with session.begin():
+
+        # Get the current usages
+        usages = _get_quota_usages(context, session, project_id)
+        allocated = quota_allocated_get_all_by_project(context, project_id,
+                                                       session=session)
+        allocated.pop('project_id')
+
+        # Handle usage refresh
+        refresh = set()
+        for resource in deltas.keys():
+            # Do we need to refresh the usage?
+            if resource not in usages:
+                refresh.add(resource)
+            elif usages[resource].in_use < 0:
+                # Negative in_use count indicates a desync, so try to
+                # heal from that...
+                refresh.add(resource)
+            elif usages[resource].until_refresh is not None:
+                usages[resource].until_refresh -= 1
+                if usages[resource].until_refresh <= 0:
+                    refresh.add(resource)
+            elif max_age and usages[resource].updated_at is not None and (
+                (timeutils.utcnow() -
+                    usages[resource].updated_at).total_seconds() >= max_age):
+                refresh.add(resource)
+
+        # OK, refresh the usage
+        if refresh:
+            _refresh_quota_usages(context, session, resources, usages,
+                                  project_id, refresh, until_refresh)
+
+        # Check for deltas that would go negative
+        if is_allocated_reserve:
+            unders = [r for r, delta in deltas.items()
+                      if delta < 0 and delta + allocated.get(r, 0) < 0]
+        else:
+            unders = [r for r, delta in deltas.items()
+                      if delta < 0 and delta + usages[r].in_use < 0]
+
+        # TODO(mc_nair): Should ignore/zero alloc if using non-nested driver
+
+        # Now, let's check the quotas
+        # NOTE(Vek): We're only concerned about positive increments.
+        #            If a project has gone over quota, we want them to
+        #            be able to reduce their usage without any
+        #            problems.
+        overs = [r for r, delta in deltas.items()
+                 if quotas[r] >= 0 and delta >= 0 and
+                 quotas[r] < delta + usages[r].total + allocated.get(r, 0)]
+
+        # NOTE(Vek): The quota check needs to be in the transaction,
+        #            but the transaction doesn't fail just because
+        #            we're over quota, so the OverQuota raise is
+        #            outside the transaction.  If we did the raise
+        #            here, our usage updates would be discarded, but
+        #            they're not invalidated by being over-quota.
+
+        # Create the reservations
+        if not overs:
+            reservations = []
+            for resource, delta in deltas.items():
+                usage = usages[resource]
+                allocated_id = None
+                if is_allocated_reserve:
+                    try:
+                        quota = _quota_get(context, project_id, resource,
+                                           session=session)
+                    except exception.ProjectQuotaNotFound:
+                        # If we were using the default quota, create DB entry
+                        quota = quota_create(context, project_id, resource,
+                                             quotas[resource], 0,
+                                             session=session)
+                    # Since there's no reserved/total for allocated, update
+                    # allocated immediately and subtract on rollback if needed
+                    quota_allocated_update(context, project_id, resource,
+                                           quota.allocated + delta,
+                                           session=session)
+                    allocated_id = quota.id
+                    usage = None
+                reservation = _reservation_create(
+                    elevated, str(uuid.uuid4()), usage, project_id, resource,
+                    delta, expire, session=session, allocated_id=allocated_id)
+
+                reservations.append(reservation.uuid)
+
+                # Also update the reserved quantity
+                # NOTE(Vek): Again, we are only concerned here about
+                #            positive increments.  Here, though, we're
+                #            worried about the following scenario:
+                #
+                #            1) User initiates resize down.
+                #            2) User allocates a new instance.
+                #            3) Resize down fails or is reverted.
+                #            4) User is now over quota.
+                #
+                #            To prevent this, we only update the
+                #            reserved value if the delta is positive.
+                if delta > 0 and not is_allocated_reserve:
+                    usages[resource].reserved += delta
+
+    if unders:
+        LOG.warning(_LW("Change will make usage less than 0 for the following "
+                        "resources: %s"), unders)
+    if overs:
+        usages = {k: dict(in_use=v.in_use, reserved=v.reserved,
+                          allocated=allocated.get(k, 0))
+                  for k, v in usages.items()}
+        raise exception.OverQuota(overs=sorted(overs), quotas=quotas,
+                                  usages=usages)
+
+    return reservations
+
+
+@require_context
+@_retry_on_deadlock
+def quota_reserve_from_blocks(context, project_id, blocks, deltas, expire):
+    """Reserve out of blocks of quota, without locking the usages.
+
+    :param blocks: Dictionary mapping the resources to the uuid of the
+                   block reservation the delta is taken from.
+    """
+    elevated = context.elevated()
+    session = get_session()
+    with session.begin():
+        reservations = []
+        for resource, delta in deltas.items():
+            reservation = _reservation_create(
+                elevated, str(uuid.uuid4()), None, project_id, resource,
+                delta, expire, session=session, block_uuid=blocks[resource])
+            reservations.append(reservation.uuid)
+    return reservations
+
+
+@require_admin_context
+@_retry_on_deadlock
+def quota_usage_flush(context, resources, project_id, blocks, expire,
+                      refresh=None, until_refresh=None, trim=None):
+    """Apply the settled reservations made from blocks to the usages.
+
+    The blocks still in use get their expiration moved to `expire`.  The
+    blocks in `trim` give back what their pending reservations don't take
+    out of them, and are removed once empty.
+
+    :param refresh: Resources recounted with their sync functions.
+    :returns: dictionary mapping the uuids of the live blocks to their size
+              and what their pending reservations take out of them.
+    """
+    trim = set(trim or [])
+    session = get_session()
+    with session.begin():
+        usages = _get_quota_usages(context, session, project_id)
+        held = _fold_block_reservations(context, session, usages,
+                                        project_id)
+        if refresh:
+            _refresh_quota_usages(context, session, resources, usages,
+                                  project_id, refresh, until_refresh)
+
+        rows = []
+        if blocks:
+            rows = model_query(context, models.Reservation,
+                               read_deleted="no", session=session).\
+                filter_by(project_id=project_id).\
+                filter(models.Reservation.uuid.in_(blocks)).\
+                order_by(models.Reservation.id.asc()).\
+                with_lockmode('update').\
+                all()
+        usage_rows = {row.id: row for usage in usages.values()
+                      for row in usage.rows}
+
+        result = {}
+        for block in rows:
+            block_held = held.get(block.uuid, 0)
+            if block.uuid in trim and block.delta > block_held:
+                if block.usage_id in usage_rows:
+                    usage_rows[block.usage_id].reserved -= (block.delta -
+                                                            block_held)
+                block.delta = block_held
+            if not block.delta:
+                block.delete(session=session)
+                continue
+            block.expire = expire
+            result[block.uuid] = (block.delta, block_held)
+    return result
+
+
+@require_context
+@_retry_on_deadlock
+def reservation_commit(context, reservations, project_id=None):
+    _reservations_settle(context,
+                         _reservations_filter(reservations, project_id),
+                         commit=True)
+
+
+@require_context
+@_retry_on_deadlock
+def reservation_rollback(context, reservations, project_id=None):
+    _reservations_settle(context,
+                         _reservations_filter(reservations, project_id),
+                         commit=False)
+
+
+def _increment_by_id(context, session, model, field, increments):
+    """Increment a field of several rows with a single UPDATE.
+
+    :param increments: Dictionary mapping row ids to the increment.
+    """
+    increments = {row_id: inc for row_id, inc in increments.items() if inc}
+    if not increments:
+        return
+
+    column = getattr(model, field)
+    model_query(context, model, read_deleted="no", session=session).\
+        filter(model.id.in_(list(increments))).\
+        update({field: column + case(increments, value=model.id)},
+               synchronize_session=False)
+
+
+def _reservations_filter(uuids, project_id=None):
+    if not uuids:
+        return None
+    condition = models.Reservation.uuid.in_(uuids)
+    if project_id:
+        condition = and_(condition,
+                         models.Reservation.project_id == project_id)
+    return condition
+
+
+def _reservations_settle_many(context, reservations, commit):
+    # Reservations only match the project they are listed under
+    conditions = [_reservations_filter(uuids, project_id)
+                  for project_id, uuids in sorted(reservations.items())
+                  if uuids]
+    if not conditions:
+        return 0
+    return _reservations_settle(context, or_(*conditions), commit)
+
+
+def _reservations_settle(context, condition, commit):
+    if condition is None:
+        return 0
+
+    session = get_session()
+    with session.begin():
+        query = model_query(context, models.Reservation, read_deleted="no",
+                            session=session).\
+            filter(condition)
+
+        # Lock the usages before the reservations like the rest of the
+        # quota code does to avoid deadlocks.  Only the usage rows, or
+        # stripes, that the reservations were made against are locked.
+        usage_ids = query.with_entities(models.Reservation.usage_id).\
+            filter(models.Reservation.usage_id.isnot(None)).\
+            distinct().\
+            all()
+        if usage_ids:
+            model_query(context, models.QuotaUsage.id, read_deleted="no",
+                        session=session).\
+                filter(models.QuotaUsage.id.in_(
+                    [usage_id for usage_id, in usage_ids])).\
+                order_by(models.QuotaUsage.id.asc()).\
+                with_lockmode('update').\
+                all()
+
+        rows = query.with_entities(models.Reservation.usage_id,
+                                   models.Reservation.allocated_id,
+                                   models.Reservation.block_uuid,
+                                   models.Reservation.delta).\
+            with_lockmode('update').\
+            all()
+
+        reserved = collections.defaultdict(int)
+        in_use = collections.defaultdict(int)
+        allocated = collections.defaultdict(int)
+        for usage_id, allocated_id, block_uuid, delta in rows:
+            # Reservations made from blocks are applied to the usages when
+            # their block is flushed, the rolled back ones as 0
+            if block_uuid:
+                continue
+            # Allocated reservations will have already been bumped
+            if allocated_id:
+                if not commit:
+                    allocated[allocated_id] -= delta
+                continue
+            if delta >= 0:
+                reserved[usage_id] -= delta
+            if commit:
+                in_use[usage_id] += delta
+
+        _increment_by_id(context, session, models.QuotaUsage, 'reserved',
+                         reserved)
+        _increment_by_id(context, session, models.QuotaUsage, 'in_use',
+                         in_use)
+        _increment_by_id(context, session, models.Quota, 'allocated',
+                         allocated)
+
+        if not commit:
+            query.filter(models.Reservation.block_uuid.isnot(None)).\
+                update({'delta': 0}, synchronize_session=False)
+        query.update({'deleted': True,
+                      'deleted_at': timeutils.utcnow()},
+                     synchronize_session=False)
+    return len(rows)
+
+
+@require_context
+@_retry_on_deadlock
+def reservation_commit_many(context, reservations):
+    _reservations_settle_many(context, reservations, commit=True)
+
+
+@require_context
+@_retry_on_deadlock
+def reservation_rollback_many(context, reservations):
+    _reservations_settle_many(context, reservations, commit=False)
+
+
+@require_admin_context
+@_retry_on_deadlock
+def _quota_usage_reconcile_project(context, project_id):
+    session = get_session()
+    with session.begin():
+        usages = _get_quota_usages(context, session, project_id)
+        folded = 0
+        for usage in usages.values():
+            if not any(row.in_use for row in usage.rows[1:]):
+                continue
+            in_use = usage.in_use
+            for row in usage.rows[1:]:
+                row.in_use = 0
+            usage.primary.in_use = in_use
+            folded += 1
+        return folded
+
+
+@require_admin_context
+def quota_usage_reconcile(context):
+    """Fold the in_use counts of striped usages into their first stripe.
+
+    Each project is reconciled in its own transaction.  Reserved counts
+    stay in their stripes, since reservations refer to them.
+    """
+    project_ids = model_query(context, models.QuotaUsage.project_id,
+                              read_deleted="no").\
+        group_by(models.QuotaUsage.project_id,
+                 models.QuotaUsage.resource).\
+        having(func.count(models.QuotaUsage.id) > 1).\
+        distinct().\
+        all()
+    return sum(_quota_usage_reconcile_project(context, project_id)
+               for project_id, in project_ids)
+
+
+def quota_destroy_by_project(*args, **kwargs):
+    """Destroy all limit quotas associated with a project.
+
+    Leaves usage and reservation quotas intact.
+    """
+    quota_destroy_all_by_project(only_quotas=True, *args, **kwargs)
+
+
+@require_admin_context
+@_retry_on_deadlock
+def quota_destroy_all_by_project(context, project_id, only_quotas=False):
+    """Destroy all quotas associated with a project.
+
+    This includes limit quotas, usage quotas and reservation quotas.
+    Optionally can only remove limit quotas and leave other types as they are.
+
+    :param context: The request context, for access checks.
+    :param project_id: The ID of the project being deleted.
+    :param only_quotas: Only delete limit quotas, leave other types intact.
+    """
+    session = get_session()
+    with session.begin():
+        quotas = model_query(context, models.Quota, session=session,
+                             read_deleted="no").\
+            filter_by(project_id=project_id).\
+            all()
+
+        for quota_ref in quotas:
+            quota_ref.delete(session=session)
+
+        if only_quotas:
+            return
+
+        quota_usages = model_query(context, models.QuotaUsage,
+                                   session=session, read_deleted="no").\
+            filter_by(project_id=project_id).\
+            all()
+
+        for quota_usage_ref in quota_usages:
+            # Free the stripe for the usages created after this one
+            quota_usage_ref.stripe = -quota_usage_ref.id
+            quota_usage_ref.delete(session=session)
+
+        reservations = model_query(context, models.Reservation,
+                                   session=session, read_deleted="no").\
+            filter_by(project_id=project_id).\
+            all()
+
+        for reservation_ref in reservations:
+            # Not to be applied to the usages by a flush of its block
+            reservation_ref.block_uuid = None
+            reservation_ref.delete(session=session)
+
+
+@_retry_on_deadlock
+def _reservation_expire_batch(context, expire_before, batch_size, after=None):
+    # NOTE: Candidates are picked without locks using the
+    # (deleted, expire) index; _reservations_settle_many locks them in the
+    # usual order and skips any that were committed or rolled back meanwhile
+    query = model_query(context, models.Reservation.expire,
+                        models.Reservation.id, models.Reservation.project_id,
+                        models.Reservation.uuid, read_deleted="no").\
+        filter(models.Reservation.expire < expire_before)
+    if after:
+        # Continue after the last candidate of the previous batch, so the
+        # ones that could not be rolled back are not picked again
+        last_expire, last_id = after
+        query = query.filter(or_(
+            models.Reservation.expire > last_expire,
+            and_(models.Reservation.expire == last_expire,
+                 models.Reservation.id > last_id)))
+    query = query.order_by(models.Reservation.expire.asc(),
+                           models.Reservation.id.asc())
+    if batch_size:
+        query = query.limit(batch_size)
+    rows = query.all()
+
+    reservations = collections.defaultdict(list)
+    for _expire, _id, project_id, reservation_uuid in rows:
+        reservations[project_id].append(reservation_uuid)
+    expired = _reservations_settle_many(context, reservations, commit=False)
+    last = (rows[-1][0], rows[-1][1]) if rows else None
+    return len(rows), expired, last
+
+
+@require_admin_context
+def reservation_expire(context, batch_size=None):
+    """Roll back expired reservations in batches of at most batch_size.
+
+    Each batch runs in its own transaction.  Returns the number of
+    reservations that were rolled back.
+    """
+    expire_before = timeutils.utcnow()
+    total = 0
+    last = None
+    while True:
+        found, expired, last = _reservation_expire_batch(
+            context, expire_before, batch_size, after=last)
+        total += expired
+        if not batch_size or found < batch_size:
+            return total
+
+
+###############################
+
+
+def get_model_for_versioned_object(versioned_object):
+    # Exceptions to model mapping, in general Versioned Objects have the same
+    # name as their ORM models counterparts, but there are some that diverge
+    VO_TO_MODEL_EXCEPTIONS = {}
+
+    model_name = versioned_object.obj_name()
+    return (VO_TO_MODEL_EXCEPTIONS.get(model_name) or
+            getattr(models, model_name))
+
+
+def _get_get_method(model):
+    # Exceptions to model to get methods, in general method names are a simple
+    # conversion changing ORM name from camel case to snake format and adding
+    # _get to the string
+    GET_EXCEPTIONS = {}
+
+    if model in GET_EXCEPTIONS:
+        return GET_EXCEPTIONS[model]
+
+    # General conversion
+    # Convert camel cased model name to snake format
+    s = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', model.__name__)
+    # Get method must be snake formatted model name concatenated with _get
+    method_name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', s).lower() + '_get'
+    return globals().get(method_name)
+
+
+_GET_METHODS = {}
+
+
+@require_context
+def get_by_id(context, model, id, *args, **kwargs):
+    # Add get method to cache dictionary if it's not already there
+    if not _GET_METHODS.get(model):
+        _GET_METHODS[model] = _get_get_method(model)
+
+    return _GET_METHODS[model](context, id, *args, **kwargs)
+
+
+@require_context
+def get_fields_by_id(context, model, id, field_names):
+    field_names = list(field_names)
+    columns = [getattr(model, field) for field in field_names]
+    result = model_query(context, *columns).\
+        filter(model.id == id).\
+        first()
+
+    if not result:
+        raise exception.NotFound(_('%(model)s %(id)s could not be found.') %
+                                 {'model': model.__name__, 'id': id})
+
+    return dict(zip(field_names, result))
+
+
+def condition_db_filter(model, field, value):
+    """Create matching filter.
+
+    If value is an iterable other than a string, any of the values is
+    a valid match (OR), so we'll use SQL IN operator.
+
+    If it's not an iterator == operator will be used.
+    """
+    orm_field = getattr(model, field)
+    # For values that must match and are iterables we use IN
+    if (isinstance(value, collections_abc.Iterable) and
+            not isinstance(value, six.string_types)):
+        # We cannot use in_ when one of the values is None
+        if None not in value:
+            return orm_field.in_(value)
+
+        return or_(orm_field == v for v in value)
+
+    # For values that must match and are not iterables we use ==
+    return orm_field == value
+
+
+def condition_not_db_filter(model, field, value, auto_none=True):
+    """Create non matching filter.
+
+    If value is an iterable other than a string, any of the values is
+    a valid match (OR), so we'll use SQL IN operator.
+
+    If it's not an iterator == operator will be used.
+
+    If auto_none is True then we'll consider NULL values as different as well,
+    like we do in Python and not like SQL does.
+    """
+    result = ~condition_db_filter(model, field, value)
+
+    if (auto_none
+            and ((isinstance(value, collections_abc.Iterable) and
+                  not isinstance(value, six.string_types)
+                  and None not in value)
+                 or (value is not None))):
+        orm_field = getattr(model, field)
+        result = or_(result, orm_field.is_(None))
+
+    return result
+
+
+def is_orm_value(obj):
+    """Check if object is an ORM field or expression."""
+    return isinstance(obj, (sqlalchemy.orm.attributes.InstrumentedAttribute,
+                            sqlalchemy.sql.expression.ColumnElement))
+
+
+def _conditional_update_query(context, model, values, expected_values,
+                              filters, include_deleted, project_only,
+                              session=None):
+    # Provided filters will become part of the where clause
+    where_conds = list(filters)
+
+    # Build where conditions with operators ==, !=, NOT IN and IN
+    for field, condition in expected_values.items():
+        if not isinstance(condition, db.Condition):
+            condition = db.Condition(condition, field)
+        where_conds.append(condition.get_filter(model, field))
+
+    # Transform case values
+    values = {field: case(value.whens, value.value, value.else_)
+              if isinstance(value, db.Case)
+              else value
+              for field, value in values.items()}
+
+    query = model_query(context, model, read_deleted=include_deleted,
+                        project_only=project_only, session=session)
+    return query.filter(*where_conds), values
+
+
+@_retry_on_deadlock
+@require_context
+def conditional_update(context, model, values, expected_values, filters=(),
+                       include_deleted='no', project_only=False):
+    """Compare-and-swap conditional update SQLAlchemy implementation."""
+    query, values = _conditional_update_query(context, model, values,
+                                              expected_values, filters,
+                                              include_deleted, project_only)
+
+    # Return True if we were able to change any DB entry, False otherwise
+    result = query.update(values, synchronize_session=False)
+    return 0 != result
+
+
+def update_returning_supported():
+    dialect = get_engine().dialect
+    # implicit_returning is about INSERTs.  Newer SQLAlchemy releases report
+    # UPDATE ... RETURNING support, older ones only compile it for PostgreSQL
+    # among the backends we support.
+    supported = getattr(dialect, 'update_returning', None)
+    if supported is None:
+        supported = dialect.name == 'postgresql'
+    return bool(supported)
+
+
+@_retry_on_deadlock
+@require_context
+def conditional_update_returning(context, model, values, expected_values,
+                                 returning, filters=(), include_deleted='no',
+                                 project_only=False):
+    """Compare-and-swap conditional update using UPDATE ... RETURNING."""
+    returning = list(returning)
+    session = get_session()
+    with session.begin():
+        query, values = _conditional_update_query(context, model, values,
+                                                  expected_values, filters,
+                                                  include_deleted,
+                                                  project_only,
+                                                  session=session)
+        # Query.update cannot return values, so we reuse the query's where
+        # clause in a core UPDATE statement
+        update = model.__table__.update().\
+            where(query.whereclause).\
+            values(values).\
+            returning(*[getattr(model, field) for field in returning])
+        rows = session.execute(update).fetchall()
+
+    return [dict(zip(returning, row)) for row in rows]
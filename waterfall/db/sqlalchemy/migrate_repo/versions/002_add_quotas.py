@@ -0,0 +1,87 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey
+from sqlalchemy import Integer, MetaData, String, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    quotas = Table('quotas', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean),
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('project_id', String(length=255), index=True),
+        Column('resource', String(length=255), nullable=False),
+        Column('hard_limit', Integer),
+        Column('allocated', Integer, default=0),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+    quota_classes = Table('quota_classes', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean),
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('class_name', String(length=255), index=True),
+        Column('resource', String(length=255)),
+        Column('hard_limit', Integer),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+    quota_usages = Table('quota_usages', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean),
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('project_id', String(length=255), index=True),
+        Column('resource', String(length=255)),
+        Column('in_use', Integer, nullable=False),
+        Column('reserved', Integer, nullable=False),
+        Column('until_refresh', Integer),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+    reservations = Table('reservations', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean),
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('uuid', String(length=36), nullable=False),
+        Column('usage_id', Integer, ForeignKey('quota_usages.id'),
+               nullable=True),
+        Column('allocated_id', Integer, ForeignKey('quotas.id'),
+               nullable=True),
+        Column('project_id', String(length=255), index=True),
+        Column('resource', String(length=255)),
+        Column('delta', Integer, nullable=False),
+        Column('expire', DateTime),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+    for table in (quotas, quota_classes, quota_usages, reservations):
+        table.create()
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError("Downgrade is unsupported.")
@@ -0,0 +1,32 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Column, Index, Integer, MetaData, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    quota_usages = Table('quota_usages', meta, autoload=True)
+
+    stripe = Column('stripe', Integer, nullable=False, server_default='0')
+    quota_usages.create_column(stripe)
+
+    index = Index('quota_usages_project_resource_stripe_idx',
+                  quota_usages.c.project_id, quota_usages.c.resource,
+                  quota_usages.c.stripe)
+    index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError("Downgrade is unsupported.")
@@ -0,0 +1,52 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Boolean, Column, DateTime, Index
+from sqlalchemy import Integer, MetaData, String, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    services = Table('services', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean),
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('host', String(length=255)),
+        Column('binary', String(length=255)),
+        Column('topic', String(length=255)),
+        Column('report_count', Integer, nullable=False),
+        Column('disabled', Boolean),
+        Column('availability_zone', String(length=255)),
+        Column('disabled_reason', String(length=255)),
+        Column('modified_at', DateTime),
+        Column('rpc_current_version', String(length=36)),
+        Column('object_current_version', String(length=36)),
+        Column('replication_status', String(length=36),
+               default='not-capable'),
+        Column('active_backend_id', String(length=255)),
+        Column('frozen', Boolean, nullable=False, default=False),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+    services.create()
+
+    index = Index('services_host_binary_idx',
+                  services.c.host, services.c.binary)
+    index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError("Downgrade is unsupported.")
@@ -0,0 +1,69 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from migrate import UniqueConstraint
+from sqlalchemy import MetaData, Table, select
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    quota_usages = Table('quota_usages', meta, autoload=True)
+    reservations = Table('reservations', meta, autoload=True)
+
+    # Fold the stripes that concurrent reservations created twice into
+    # the oldest of them
+    rows = select([quota_usages.c.id, quota_usages.c.project_id,
+                   quota_usages.c.resource, quota_usages.c.stripe,
+                   quota_usages.c.in_use, quota_usages.c.reserved]).\
+        where(quota_usages.c.deleted == False).\
+        order_by(quota_usages.c.id).execute().fetchall()  # noqa
+    kept = {}
+    folded = set()
+    for row in rows:
+        key = (row.project_id, row.resource, row.stripe)
+        if key not in kept:
+            kept[key] = [row.id, row.in_use, row.reserved]
+            continue
+        folded.add(key)
+        kept[key][1] += row.in_use
+        kept[key][2] += row.reserved
+        reservations.update().\
+            where(reservations.c.usage_id == row.id).\
+            values(usage_id=kept[key][0]).execute()
+        quota_usages.delete().\
+            where(quota_usages.c.id == row.id).execute()
+    for usage_id, in_use, reserved in (kept[key] for key in folded):
+        quota_usages.update().\
+            where(quota_usages.c.id == usage_id).\
+            values(in_use=in_use, reserved=reserved).execute()
+
+    # Deleted usages leave the stripes to the rows that replace them
+    quota_usages.update().\
+        where(quota_usages.c.deleted == True).\
+        values(stripe=-quota_usages.c.id).execute()  # noqa
+
+    # The unique constraint replaces the index on the same columns
+    for index in list(quota_usages.indexes):
+        if index.name == 'quota_usages_project_resource_stripe_idx':
+            index.drop(migrate_engine)
+            # SQLite recreates the table with the indexes it still lists
+            quota_usages.indexes.remove(index)
+
+    UniqueConstraint('project_id', 'resource', 'stripe', table=quota_usages,
+                     name='uniq_quota_usages0project_id0resource0'
+                          'stripe').create()
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError("Downgrade is unsupported.")
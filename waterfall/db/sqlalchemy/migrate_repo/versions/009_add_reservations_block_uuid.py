@@ -0,0 +1,31 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Column, Index, MetaData, String, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    reservations = Table('reservations', meta, autoload=True)
+
+    # Block of quota a reservation was made from, see CachedDbQuotaDriver
+    block_uuid = Column('block_uuid', String(36), nullable=True)
+    reservations.create_column(block_uuid)
+
+    index = Index('reservations_block_uuid_idx', reservations.c.block_uuid)
+    index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError("Downgrade is unsupported.")
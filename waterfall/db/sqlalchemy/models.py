@@ -52,14 +52,156 @@ class WaterfallBase(models.TimestampMixin,
         self.save(session=session)
 
 
+class Service(BASE, WaterfallBase):
+    """Represents a running service on a host."""
+
+    __tablename__ = 'services'
+    __table_args__ = (
+        schema.Index('services_host_binary_idx', 'host', 'binary'),
+        WaterfallBase.__table_args__)
+
+    id = Column(Integer, primary_key=True)
+    host = Column(String(255))  # , ForeignKey('hosts.id'))
+    binary = Column(String(255))
+    topic = Column(String(255))
+    report_count = Column(Integer, nullable=False, default=0)
+    disabled = Column(Boolean, default=False)
+    availability_zone = Column(String(255), default='waterfall')
+    disabled_reason = Column(String(255))
+    # adding column modified_at to contain timestamp
+    # for manual enable/disable of waterfall services
+    # updated_at column will now contain timestamps for
+    # periodic updates
+    modified_at = Column(DateTime)
+
+    # Version columns to support rolling upgrade.
+    # Current version is what the service is running now (i.e. minimum).
+    rpc_current_version = Column(String(36))
+    object_current_version = Column(String(36))
+
+    # replication_status can be: enabled, disabled, not-capable, error,
+    # failed-over or not-configured
+    replication_status = Column(String(36), default="not-capable")
+    active_backend_id = Column(String(255))
+    frozen = Column(Boolean, nullable=False, default=False)
+
+
 class Workflow(BASE, WaterfallBase):
     """Represents a block storage device that can be attached to a vm."""
     __tablename__ = 'workflows'
+    __table_args__ = (
+        schema.Index('workflows_status_updated_at_idx',
+                     'status', 'updated_at'),
+        WaterfallBase.__table_args__)
+
     id = Column(Integer, primary_key=True)
     user_id = Column(String(255))
     project_id = Column(String(255))
     resource_type = Column(String(length=255))
     payload = Column(Text())
+    status = Column(String(255), default='pending')
+
+
+class Quota(BASE, WaterfallBase):
+    """Represents a single quota override for a project.
+
+    If there is no row for a given project id and resource, then the
+    default for the quota class is used.  If there is no row for a
+    given quota class and resource, then the default for the
+    deployment is used. If the row is present but the hard limit is
+    Null, then the resource is unlimited.
+    """
+
+    __tablename__ = 'quotas'
+    id = Column(Integer, primary_key=True)
+
+    project_id = Column(String(255), index=True)
+
+    resource = Column(String(255))
+    hard_limit = Column(Integer, nullable=True)
+    allocated = Column(Integer, default=0)
+
+
+class QuotaClass(BASE, WaterfallBase):
+    """Represents a single quota override for a quota class.
+
+    If there is no row for a given quota class and resource, then the
+    default for the deployment is used.  If the row is present but the
+    hard limit is Null, then the resource is unlimited.
+    """
+
+    __tablename__ = 'quota_classes'
+    id = Column(Integer, primary_key=True)
+
+    class_name = Column(String(255), index=True)
+
+    resource = Column(String(255))
+    hard_limit = Column(Integer, nullable=True)
+
+
+class QuotaUsage(BASE, WaterfallBase):
+    """Represents the current usage for a given resource."""
+
+    __tablename__ = 'quota_usages'
+    __table_args__ = (
+        schema.UniqueConstraint(
+            'project_id', 'resource', 'stripe',
+            name='uniq_quota_usages0project_id0resource0stripe'),
+        WaterfallBase.__table_args__)
+
+    id = Column(Integer, primary_key=True)
+
+    project_id = Column(String(255), index=True)
+    resource = Column(String(255))
+    # Usages may be split in several rows to spread concurrent updates,
+    # the usage of the resource is the sum of all its stripes.  Deleted
+    # usages are moved to the stripe -id to leave theirs free.
+    stripe = Column(Integer, nullable=False, default=0)
+
+    in_use = Column(Integer)
+    reserved = Column(Integer)
+
+    @property
+    def total(self):
+        return self.in_use + self.reserved
+
+    until_refresh = Column(Integer, nullable=True)
+
+
+class Reservation(BASE, WaterfallBase):
+    """Represents a resource reservation for quotas."""
+
+    __tablename__ = 'reservations'
+    __table_args__ = (
+        schema.Index('reservations_deleted_expire_idx', 'deleted', 'expire'),
+        schema.Index('reservations_block_uuid_idx', 'block_uuid'),
+        WaterfallBase.__table_args__)
+
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(36), nullable=False)
+
+    usage_id = Column(Integer, ForeignKey('quota_usages.id'), nullable=True)
+    allocated_id = Column(Integer, ForeignKey('quotas.id'), nullable=True)
+    # Reservation holding the block of quota this one was made from.  Such
+    # reservations have no usage, they are applied to it when their block
+    # is flushed.
+    block_uuid = Column(String(36), nullable=True)
+
+    project_id = Column(String(255), index=True)
+    resource = Column(String(255))
+
+    delta = Column(Integer)
+    expire = Column(DateTime, nullable=False)
+
+    usage = relationship(
+        "QuotaUsage",
+        foreign_keys=usage_id,
+        primaryjoin='and_(Reservation.usage_id == QuotaUsage.id,'
+                    'QuotaUsage.deleted == 0)')
+    quota = relationship(
+        "Quota",
+        foreign_keys=allocated_id,
+        primaryjoin='and_(Reservation.allocated_id == Quota.id)')
 
 
 def register_models():
@@ -71,6 +213,10 @@ def register_models():
     """
     from sqlalchemy import create_engine
     models = (Workflow,
+              Quota,
+              QuotaClass,
+              QuotaUsage,
+              Reservation,
               )
     engine = create_engine(CONF.database.connection, echo=False)
     for model in models:
@@ -231,6 +231,11 @@ class ServiceUnavailable(Invalid):
     message = _("Service is unavailable at this time.")
 
 
+class ThreadPoolFull(ServiceUnavailable):
+    message = _("Thread pool %(name)s is full, %(queued)d tasks are "
+                "already queued.")
+
+
 class ImageUnacceptable(Invalid):
     message = _("Image %(image_id)s is unacceptable: %(reason)s")
 
@@ -51,24 +51,34 @@ This module provides Manager, a base class for managers.
 
 """
 
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
 from oslo_service import periodic_task
 
+from waterfall.common import metrics
+from waterfall.common import threadpool
 from waterfall.db import base
 from waterfall.i18n import _LI
 from waterfall import rpc
-#from waterfall.scheduler import rpcapi as scheduler_rpcapi
+from waterfall.scheduler import rpcapi as scheduler_rpcapi
 from waterfall import version
 
-from eventlet import greenpool
-
 
 CONF = cfg.CONF
+CONF.import_opt('capabilities_full_sync_interval', 'waterfall.common.config')
 LOG = logging.getLogger(__name__)
 
+# Capability counters changing all the time, with the capacity they fill.
+# A change of them alone is only worth an update when the fill crosses a
+# quarter of the capacity, otherwise they are sent along with the other
+# changes.
+VOLATILE_CAPABILITIES = {'thread_pool': {'active': 'size',
+                                         'queued': 'queue_size'}}
+LOAD_BUCKETS = 4
+
 
 class PeriodicTasks(periodic_task.PeriodicTasks):
     def __init__(self):
@@ -102,6 +112,17 @@ class Manager(base.Base, PeriodicTasks):
         """
         pass
 
+    def drain(self, timeout):
+        """Finish the in-flight work before the service stops.
+
+        Called once the service stopped consuming RPC messages.  Child
+        classes should wait up to `timeout` seconds for the operations they
+        are running and leave the unfinished ones in a state they can be
+        resumed from.
+
+        """
+        pass
+
     def init_host_with_rpc(self):
         """A hook for service to do jobs after RPC is ready.
 
@@ -145,32 +166,98 @@ class SchedulerDependentManager(Manager):
 
     Services that need to update the Scheduler of their capabilities
     should derive from this class. Otherwise they can derive from
-    manager.Manager directly. Updates are only sent after
-    update_service_capabilities is called with non-None values.
+    manager.Manager directly. The capabilities given to
+    update_service_capabilities are sent along with the load of the
+    thread pool, which is sent alone until then.
+
+    Every `capabilities_full_sync_interval` seconds all the capabilities
+    are sent.  In between, an update is only sent when they changed and
+    only carries the changed ones, the load of the thread pool only counts
+    as a change when it moves to another quarter of the pool or queue.
+    Updates are numbered so the schedulers can tell when they missed one.
 
     """
 
     def __init__(self, host=None, db_driver=None, service_name='undefined'):
         self.last_capabilities = None
         self.service_name = service_name
-        #self.scheduler_rpcapi = scheduler_rpcapi.SchedulerAPI()
-        self._tp = greenpool.GreenPool()
+        self.scheduler_rpcapi = scheduler_rpcapi.SchedulerAPI()
+        # Capabilities as last sent to the schedulers
+        self._published_capabilities = None
+        self._capabilities_version = 0
+        self._last_full_sync = None
+        self._tp = threadpool.BoundedGreenPool(service_name)
+        metrics.register_source('thread_pool.%s' % service_name,
+                                self._tp.report)
         super(SchedulerDependentManager, self).__init__(host, db_driver)
 
     def update_service_capabilities(self, capabilities):
-        """Remember these capabilities to send on next periodic update."""
+        """Remember these capabilities to send on next periodic update.
+
+        The load of the thread pool is added to them when they are sent,
+        so the schedulers can avoid the hosts whose queue is filling up.
+        """
         self.last_capabilities = capabilities
 
-    #@periodic_task.periodic_task
-    #def _publish_service_capabilities(self, context):
-    #    """Pass data back to the scheduler at a periodic interval."""
-    #    if self.last_capabilities:
-    #        LOG.debug('Notifying Schedulers of capabilities ...')
-    #        self.scheduler_rpcapi.update_service_capabilities(
-    #            context,
-    #            self.service_name,
-    #            self.host,
-    #            self.last_capabilities)
+    @periodic_task.periodic_task
+    def _publish_service_capabilities(self, context):
+        """Pass data back to the scheduler at a periodic interval."""
+        capabilities = dict(self.last_capabilities or {},
+                            thread_pool=self._tp.load())
+        now = time.time()
+        full_sync = (self._published_capabilities is None or
+                     now - self._last_full_sync >=
+                     CONF.capabilities_full_sync_interval)
+        if full_sync:
+            changed, removed = capabilities, []
+        else:
+            published = self._published_capabilities
+            changed = {name: value for name, value in capabilities.items()
+                       if name not in published or
+                       self._stable(name, published[name]) !=
+                       self._stable(name, value)}
+            removed = [name for name in published if name not in capabilities]
+            if not changed and not removed:
+                return
+            changed.update((name, capabilities[name])
+                           for name in VOLATILE_CAPABILITIES
+                           if name in capabilities)
+
+        version = self._capabilities_version + 1
+        LOG.debug('Notifying Schedulers of capabilities %(version)s, '
+                  '%(kind)s ...',
+                  {'version': version,
+                   'kind': 'full sync' if full_sync else 'delta'})
+        self.scheduler_rpcapi.update_service_capabilities(
+            context,
+            self.service_name,
+            self.host,
+            changed,
+            version,
+            full_sync=full_sync,
+            removed=removed)
+        self._capabilities_version = version
+        self._published_capabilities = capabilities
+        if full_sync:
+            self._last_full_sync = now
+
+    @staticmethod
+    def _stable(name, value):
+        """Return the capability with its volatile counters coarsened.
+
+        Each counter is replaced by the quarter of its capacity it fills:
+        0 below 25%, up to 4 when full.
+        """
+        volatile = VOLATILE_CAPABILITIES.get(name)
+        if not volatile or not isinstance(value, dict):
+            return value
+        stable = dict(value)
+        for key, capacity_key in volatile.items():
+            capacity = value.get(capacity_key)
+            if key in stable and capacity:
+                stable[key] = (LOAD_BUCKETS * min(stable[key], capacity) //
+                               capacity)
+        return stable
 
     def _add_to_threadpool(self, func, *args, **kwargs):
         self._tp.spawn_n(func, *args, **kwargs)
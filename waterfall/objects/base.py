@@ -222,7 +222,9 @@ class WaterfallObject(base.VersionedObject):
            :param reflect_changes: If we want changes made in the database to
                                    be reflected in the versioned object.  This
                                    may mean in some cases that we have to
-                                   reload the object from the database.
+                                   read the updated fields back, which is
+                                   done in the UPDATE itself when the backend
+                                   supports RETURNING.
            :returns number of db rows that were updated, which can be used as a
                     boolean, since it will be 0 if we couldn't update the DB
                     and 1 if we could, because we are using unique index id.
@@ -253,24 +255,36 @@ class WaterfallObject(base.VersionedObject):
             changes.update(values)
             values = changes
 
-        result = db.conditional_update(self._context, self.model, values,
-                                       expected, filters)
+        # If we have used a Case, a db field or an expression in values we
+        # don't know which value was used, so we need to read it back from
+        # the DB
+        reload_fields = [field for field, value in values.items()
+                         if isinstance(value, self.Case) or
+                         db.is_orm_value(value)]
+
+        if (reflect_changes and reload_fields and
+                db.update_returning_supported()):
+            # Get the values the DB stored in the same UPDATE statement to
+            # save us the extra round-trip
+            rows = db.conditional_update_returning(self._context, self.model,
+                                                   values, expected,
+                                                   reload_fields, filters)
+            result = len(rows)
+            if result:
+                values = dict(values, **rows[0])
+                reload_fields = []
+        else:
+            result = db.conditional_update(self._context, self.model, values,
+                                           expected, filters)
 
         # If we were able to update the DB then we need to update this object
         # as well to reflect new DB contents and clear the object's dirty flags
         # for those fields.
         if result and reflect_changes:
-            # If we have used a Case, a db field or an expression in values we
-            # don't know which value was used, so we need to read the object
-            # back from the DB
-            if any(isinstance(v, self.Case) or db.is_orm_value(v)
-                   for v in values.values()):
-                # Read back object from DB
-                obj = type(self).get_by_id(self._context, self.id)
-                db_values = obj.obj_to_primitive()['versioned_object.data']
-                # Only update fields were changes were requested
-                values = {field: db_values[field]
-                          for field, value in values.items()}
+            if reload_fields:
+                # Read back only the fields we don't know the value of
+                values = dict(values, **db.get_fields_by_id(
+                    self._context, self.model, self.id, reload_fields))
 
             # NOTE(geguileo): We don't use update method because our objects
             # will eventually move away from VersionedObjectDictCompat
@@ -279,7 +293,13 @@ class WaterfallObject(base.VersionedObject):
             self.obj_reset_changes(values.keys())
         return result
 
-    def refresh(self):
+    def refresh(self, fields=None):
+        """Reload the object's fields from the DB.
+
+        :param fields: Iterable with the names of the fields to reload.  If
+                       None all set fields are refreshed loading the whole
+                       object, otherwise only the given columns are read.
+        """
         # To refresh we need to have a model and for the model to have an id
         # field
         if 'id' not in self.fields:
@@ -287,15 +307,25 @@ class WaterfallObject(base.VersionedObject):
                    (self.obj_name()))
             raise NotImplementedError(msg)
 
-        current = self.get_by_id(self._context, self.id)
-
-        for field in self.fields:
+        if fields is None:
+            current = self.get_by_id(self._context, self.id)
+            fields = self.fields
+        else:
+            fields = list(fields)
+            unknown = set(fields).difference(self.fields)
+            if unknown:
+                raise ValueError(_('Unknown fields: %s') %
+                                 ', '.join(sorted(unknown)))
+            current = db.get_fields_by_id(self._context, self.model, self.id,
+                                          fields)
+
+        for field in fields:
             # Only update attributes that are already set.  We do not want to
             # unexpectedly trigger a lazy-load.
             if self.obj_attr_is_set(field):
                 if self[field] != current[field]:
                     self[field] = current[field]
-        self.obj_reset_changes()
+        self.obj_reset_changes(fields)
 
     def __contains__(self, name):
         # We're using obj_extra_fields to provide aliases for some fields while
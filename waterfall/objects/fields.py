@@ -84,3 +84,19 @@ class ReplicationStatus(Enum):
 
 class ReplicationStatusField(BaseEnumField):
     AUTO_TYPE = ReplicationStatus()
+
+
+class WorkflowStatus(Enum):
+    PENDING = 'pending'
+    APPLYING = 'applying'
+    APPLIED = 'applied'
+    ERROR = 'error'
+
+    ALL = (PENDING, APPLYING, APPLIED, ERROR)
+
+    def __init__(self):
+        super(WorkflowStatus, self).__init__(valid_values=WorkflowStatus.ALL)
+
+
+class WorkflowStatusField(BaseEnumField):
+    AUTO_TYPE = WorkflowStatus()
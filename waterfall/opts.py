@@ -32,6 +32,9 @@ from waterfall.backup import manager as waterfall_backup_manager
 from waterfall.cmd import all as waterfall_cmd_all
 from waterfall.cmd import workflow as waterfall_cmd_workflow
 from waterfall.common import config as waterfall_common_config
+from waterfall.common import metrics as waterfall_common_metrics
+from waterfall.common import periodic as waterfall_common_periodic
+from waterfall.common import threadpool as waterfall_common_threadpool
 import waterfall.compute
 from waterfall.compute import nova as waterfall_compute_nova
 from waterfall import context as waterfall_context
@@ -45,6 +48,8 @@ import waterfall.keymgr
 from waterfall.keymgr import conf_key_mgr as waterfall_keymgr_confkeymgr
 from waterfall.keymgr import key_mgr as waterfall_keymgr_keymgr
 from waterfall import quota as waterfall_quota
+from waterfall import quota_utils as waterfall_quota_utils
+from waterfall import rpc as waterfall_rpc
 from waterfall.scheduler import driver as waterfall_scheduler_driver
 from waterfall.scheduler import host_manager as waterfall_scheduler_hostmanager
 from waterfall.scheduler import manager as waterfall_scheduler_manager
@@ -227,6 +232,9 @@ def list_opts():
                 waterfall_workflow_drivers_nexenta_options.NEXENTA_EDGE_OPTS,
                 waterfall_exception.exc_log_opts,
                 waterfall_common_config.global_opts,
+                waterfall_common_metrics.metrics_opts,
+                waterfall_common_periodic.periodic_opts,
+                waterfall_common_threadpool.threadpool_opts,
                 waterfall_scheduler_weights_capacity.capacity_weight_opts,
                 waterfall_workflow_drivers_sheepdog.sheepdog_opts,
                 [waterfall_api_middleware_sizelimit.max_request_body_size_opt],
@@ -299,6 +307,8 @@ def list_opts():
                 storwize_svc_opts,
                 waterfall_workflow_drivers_hitachi_hbsdfc.workflow_opts,
                 waterfall_quota.quota_opts,
+                waterfall_quota_utils.quota_utils_opts,
+                waterfall_rpc.rpc_opts,
                 waterfall_workflow_drivers_huawei_huaweidriver.huawei_opts,
                 waterfall_workflow_drivers_dell_dellstoragecentercommon.
                 common_opts,
@@ -16,20 +16,26 @@
 
 """Quotas for workflows."""
 
+import collections
 from collections import deque
 import datetime
+import threading
+import weakref
 
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_log import versionutils
+from oslo_service import loopingcall
+from oslo_utils import excutils
 from oslo_utils import importutils
 from oslo_utils import timeutils
 import six
 
 from waterfall import context
+from waterfall import coordination
 from waterfall import db
 from waterfall import exception
-from waterfall.i18n import _, _LE
+from waterfall.i18n import _, _LE, _LI, _LW
 from waterfall import quota_utils
 
 
@@ -74,11 +80,47 @@ quota_opts = [
                      'with default quota.'),
     cfg.IntOpt('per_workflow_size_limit',
                default=-1,
-               help='Max size allowed per workflow, in gigabytes'), ]
+               help='Max size allowed per workflow, in gigabytes'),
+    cfg.IntOpt('quota_cache_sync_interval',
+               default=10,
+               min=1,
+               help='Interval, in seconds, between applying the '
+                    'reservations CachedDbQuotaDriver made out of its '
+                    'blocks of quota to the quota usages in the database'),
+    cfg.IntOpt('quota_cache_block_reservations',
+               default=10,
+               min=1,
+               help='Number of reservations of the largest size seen for a '
+                    'resource that CachedDbQuotaDriver reserves at once for '
+                    'a busy project. Reservations made out of that block '
+                    'do not lock the usage rows of the project'),
+    cfg.IntOpt('quota_usage_stripes',
+               default=1,
+               min=1,
+               help='Number of rows each quota usage is spread over. '
+                    'Values over 1 let concurrent reservations for the '
+                    'same project lock different rows while the project '
+                    'is far from its limits'),
+    cfg.IntOpt('quota_resources_cache_ttl',
+               default=60,
+               help='Number of seconds the quota resources derived from '
+                    'workflow types are cached for. Workflow types created, '
+                    'renamed or deleted are seen after this time at most, '
+                    'only renames made through update_quota_resource are '
+                    'seen at once. 0 disables the cache'),
+    cfg.IntOpt('reservation_expire_batch_size',
+               default=100,
+               help='Maximum number of expired reservations rolled back '
+                    'per transaction when expiring reservations. 0 rolls '
+                    'them all back in a single transaction'), ]
 
 CONF = cfg.CONF
 CONF.register_opts(quota_opts)
 
+# Seconds the limits memoized for a request context are trusted.  Requests
+# are expected to be handled well within it.
+LIMITS_MEMO_LIFETIME = 5
+
 
 class DbQuotaDriver(object):
 
@@ -103,7 +145,8 @@ class DbQuotaDriver(object):
         default_quotas = db.quota_class_get_default(context)
         return default_quotas.get(resource.name, resource.default)
 
-    def get_defaults(self, context, resources, project_id=None):
+    def get_defaults(self, context, resources, project_id=None,
+                     default_quotas=None):
         """Given a list of resources, retrieve the default quotas.
 
         Use the class quotas named `_DEFAULT_QUOTA_NAME` as default quotas,
@@ -112,12 +155,15 @@ class DbQuotaDriver(object):
         :param context: The request context, for access checks.
         :param resources: A dictionary of the registered resources.
         :param project_id: The id of the current project
+        :param default_quotas: The limits of the default quota class, if
+                               they have already been retrieved.
         """
 
         quotas = {}
-        default_quotas = {}
-        if CONF.use_default_quota_class:
-            default_quotas = db.quota_class_get_default(context)
+        if default_quotas is None:
+            default_quotas = {}
+            if CONF.use_default_quota_class:
+                default_quotas = db.quota_class_get_default(context)
 
         for resource in resources.values():
             if default_quotas:
@@ -234,7 +280,27 @@ class DbQuotaDriver(object):
                     allocated=allocated_quotas.get(resource.name, 0), )
         return quotas
 
-    def _get_quotas(self, context, resources, keys, has_sync, project_id=None):
+    def get_limits(self, context, resources, project_id, quota_class=None):
+        """Retrieve the limits that apply to a project with one query.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the resources to get limits for.
+        :param project_id: The ID of the project to return limits for.
+        :param quota_class: The quota class of the project, if any.
+        :returns: A dictionary mapping resource names to limits.
+        """
+
+        limits = db.quota_limits_get(context, project_id,
+                                     quota_class=quota_class,
+                                     resources=list(resources),
+                                     defaults=CONF.use_default_quota_class)
+        defaults = self.get_defaults(context, resources, project_id,
+                                     default_quotas=limits['default'])
+        return {name: limits['project'].get(name, limits['class'].get(
+            name, defaults[name])) for name in resources}
+
+    def _get_quotas(self, context, resources, keys, has_sync, project_id=None,
+                    limits=None):
         """A helper method which retrieves the quotas for specific resources.
 
         This specific resource is identified by keys, and which apply to the
@@ -250,6 +316,9 @@ class DbQuotaDriver(object):
         :param project_id: Specify the project_id if current context
                            is admin and admin wants to impact on
                            common user's tenant.
+        :param limits: Optional dictionary memoizing the limits of the
+                       project.  The limits of the keys missing from it
+                       are retrieved and stored in it.
         """
 
         # Filter resources
@@ -266,14 +335,20 @@ class DbQuotaDriver(object):
             unknown = desired - set(sub_resources.keys())
             raise exception.QuotaResourceUnknown(unknown=sorted(unknown))
 
-        # Grab and return the quotas (without usages)
-        quotas = self.get_project_quotas(context, sub_resources,
-                                         project_id,
-                                         context.quota_class, usages=False)
+        if limits is None:
+            limits = self.get_limits(context, sub_resources, project_id,
+                                     context.quota_class)
+        else:
+            missing = {k: v for k, v in sub_resources.items()
+                       if k not in limits}
+            if missing:
+                limits.update(self.get_limits(context, missing, project_id,
+                                              context.quota_class))
 
-        return {k: v['limit'] for k, v in quotas.items()}
+        return {k: limits[k] for k in sub_resources}
 
-    def limit_check(self, context, resources, values, project_id=None):
+    def limit_check(self, context, resources, values, project_id=None,
+                    limits=None):
         """Check simple quota limits.
 
         For limits--those quotas for which there is no usage
@@ -296,6 +371,8 @@ class DbQuotaDriver(object):
         :param project_id: Specify the project_id if current context
                            is admin and admin wants to impact on
                            common user's tenant.
+        :param limits: Optional dictionary memoizing the limits of the
+                       project, see _get_quotas().
         """
 
         # Ensure no value is less than zero
@@ -309,7 +386,8 @@ class DbQuotaDriver(object):
 
         # Get the applicable quotas
         quotas = self._get_quotas(context, resources, values.keys(),
-                                  has_sync=False, project_id=project_id)
+                                  has_sync=False, project_id=project_id,
+                                  limits=limits)
         # Check the quotas and construct a list of the resources that
         # would be put over limit by the desired values
         overs = [key for key, val in values.items()
@@ -319,7 +397,7 @@ class DbQuotaDriver(object):
                                       usages={})
 
     def reserve(self, context, resources, deltas, expire=None,
-                project_id=None):
+                project_id=None, limits=None):
         """Check quotas and reserve resources.
 
         For counting quotas--those quotas for which there is a usage
@@ -352,17 +430,12 @@ class DbQuotaDriver(object):
         :param project_id: Specify the project_id if current context
                            is admin and admin wants to impact on
                            common user's tenant.
+        :param limits: Optional dictionary memoizing the limits of the
+                       project, see _get_quotas().
         """
 
         # Set up the reservation expiration
-        if expire is None:
-            expire = CONF.reservation_expire
-        if isinstance(expire, six.integer_types):
-            expire = datetime.timedelta(seconds=expire)
-        if isinstance(expire, datetime.timedelta):
-            expire = timeutils.utcnow() + expire
-        if not isinstance(expire, datetime.datetime):
-            raise exception.InvalidReservationExpiration(expire=expire)
+        expire = self._get_reservation_expire(expire)
 
         # If project_id is None, then we use the project_id in context
         if project_id is None:
@@ -373,10 +446,23 @@ class DbQuotaDriver(object):
         #            Yes, the admin may be in the process of reducing
         #            quotas, but that's a pretty rare thing.
         quotas = self._get_quotas(context, resources, deltas.keys(),
-                                  has_sync=True, project_id=project_id)
+                                  has_sync=True, project_id=project_id,
+                                  limits=limits)
         return self._reserve(context, resources, quotas, deltas, expire,
                              project_id)
 
+    @staticmethod
+    def _get_reservation_expire(expire):
+        if expire is None:
+            expire = CONF.reservation_expire
+        if isinstance(expire, six.integer_types):
+            expire = datetime.timedelta(seconds=expire)
+        if isinstance(expire, datetime.timedelta):
+            expire = timeutils.utcnow() + expire
+        if not isinstance(expire, datetime.datetime):
+            raise exception.InvalidReservationExpiration(expire=expire)
+        return expire
+
     def _reserve(self, context, resources, quotas, deltas, expire, project_id):
         # NOTE(Vek): Most of the work here has to be done in the DB
         #            API, because we have to do it in a transaction,
@@ -385,7 +471,8 @@ class DbQuotaDriver(object):
         #            have to do the work there.
         return db.quota_reserve(context, resources, quotas, deltas, expire,
                                 CONF.until_refresh, CONF.max_age,
-                                project_id=project_id)
+                                project_id=project_id,
+                                stripes=CONF.quota_usage_stripes)
 
     def commit(self, context, reservations, project_id=None):
         """Commit reservations.
@@ -419,6 +506,26 @@ class DbQuotaDriver(object):
 
         db.reservation_rollback(context, reservations, project_id=project_id)
 
+    def commit_many(self, context, reservations):
+        """Commit reservations of several projects at once.
+
+        :param context: The request context, for access checks.
+        :param reservations: A dictionary mapping project ids to lists of
+                             the reservation UUIDs, as returned by the
+                             reserve() method.
+        """
+        db.reservation_commit_many(context, reservations)
+
+    def rollback_many(self, context, reservations):
+        """Roll back reservations of several projects at once.
+
+        :param context: The request context, for access checks.
+        :param reservations: A dictionary mapping project ids to lists of
+                             the reservation UUIDs, as returned by the
+                             reserve() method.
+        """
+        db.reservation_rollback_many(context, reservations)
+
     def destroy_by_project(self, context, project_id):
         """Destroy all limit quotas associated with a project.
 
@@ -436,9 +543,20 @@ class DbQuotaDriver(object):
         any that have expired.
 
         :param context: The request context, for access checks.
+        :returns: The number of reservations that were rolled back.
         """
 
-        db.reservation_expire(context)
+        return db.reservation_expire(
+            context, batch_size=CONF.reservation_expire_batch_size)
+
+    def reconcile_usages(self, context):
+        """Fold striped usages back into their first stripe.
+
+        :param context: The request context, for access checks.
+        :returns: The number of usages that were reconciled.
+        """
+
+        return db.quota_usage_reconcile(context)
 
 
 class NestedDbQuotaDriver(DbQuotaDriver):
@@ -604,9 +722,10 @@ class NestedDbQuotaDriver(DbQuotaDriver):
         return 0 if quota_utils.get_parent_project_id(
             context, project_id) else resource.default
 
-    def get_defaults(self, context, resources, project_id=None):
+    def get_defaults(self, context, resources, project_id=None,
+                     default_quotas=None):
         defaults = super(NestedDbQuotaDriver, self).get_defaults(
-            context, resources, project_id)
+            context, resources, project_id, default_quotas=default_quotas)
         # All defaults are 0 for child project
         if quota_utils.get_parent_project_id(context, project_id):
             for key in defaults.keys():
@@ -623,7 +742,8 @@ class NestedDbQuotaDriver(DbQuotaDriver):
             try:
                 reserved += db.quota_reserve(
                     context, resources, quotas, {res: deltas[res]},
-                    expire, CONF.until_refresh, CONF.max_age, project_id)
+                    expire, CONF.until_refresh, CONF.max_age, project_id,
+                    stripes=CONF.quota_usage_stripes)
                 if quotas[res] == -1:
                     reserved += quota_utils.update_alloc_to_next_hard_limit(
                         context, resources, deltas, res, expire, project_id)
@@ -641,6 +761,318 @@ class NestedDbQuotaDriver(DbQuotaDriver):
         return reserved
 
 
+class _CachedProject(object):
+    """Blocks of quota of a project held by this process."""
+
+    def __init__(self, project_id, lease, resources):
+        self.project_id = project_id
+        self.lease = lease
+        self.resources = resources
+        self.lock = threading.Lock()
+        self.lost = False
+        # Block reservation uuids per resource
+        self.blocks = collections.defaultdict(list)
+        # Size of each block, and what the reservations made from it and
+        # not flushed yet take out of it
+        self.sizes = {}
+        self.held = {}
+        # Reservations made from the blocks since the last flush,
+        # uuid -> (block uuid, delta)
+        self.granted = {}
+        # Largest increment reserved per resource, blocks are sized on it
+        self.units = {}
+        # Resources whose blocks could not be topped up
+        self.near_limit = set()
+        self.used = False
+        self.reserve_count = 0
+        self.refreshed_at = timeutils.utcnow()
+
+    def find_block(self, resource, delta):
+        for block in self.blocks[resource]:
+            if self.sizes[block] - self.held[block] >= max(delta, 0):
+                return block
+        return None
+
+
+class CachedDbQuotaDriver(DbQuotaDriver):
+    """Quota driver reserving for busy projects out of blocks of quota.
+
+    The process holding the coordination lease of a project reserves a
+    block of quota for each resource with a regular reservation, checked
+    against the limits and the usages like any other.  Reservations for
+    the project are then taken out of the blocks in memory and written as
+    reservations referring to their block, without locking the usage rows
+    of the project.  They are committed and rolled back by any process
+    without locking the usage rows either.
+
+    Every `quota_cache_sync_interval` seconds the settled reservations are
+    applied to the usages and their blocks in a single transaction, which
+    also recounts the usages following the `until_refresh` and `max_age`
+    semantics of the DB driver.  Projects that were not used since the
+    last flush give their blocks back and their lease is released.
+
+    Since the blocks are reserved in the database, the processes without
+    the lease, which reserve through the DB driver, never see more quota
+    than is left.  When the blocks can't be topped up because the project
+    is close to its limits, the unused part of the blocks is given back
+    and reservations go through the DB driver.
+    """
+
+    def __init__(self):
+        super(CachedDbQuotaDriver, self).__init__()
+        self._projects = {}
+        self._projects_lock = threading.Lock()
+        # Projects we could not lease, project_id -> time of the attempt
+        self._unleased = {}
+        self._sync_timer = None
+
+    def _lease_project(self, project_id):
+        last_attempt = self._unleased.get(project_id)
+        if last_attempt and not timeutils.is_older_than(
+                last_attempt, CONF.quota_cache_sync_interval):
+            return None
+
+        try:
+            lease = coordination.LeaseLock('quota-usage-{project_id}',
+                                           {'project_id': project_id})
+            acquired = lease.acquire(blocking=False)
+        except Exception:
+            LOG.debug('Cannot lease quota usage of project %s, using the '
+                      'database.', project_id, exc_info=True)
+            acquired = False
+
+        if not acquired:
+            self._unleased[project_id] = timeutils.utcnow()
+            return None
+
+        self._unleased.pop(project_id, None)
+        return lease
+
+    def _get_cached_project(self, resources, project_id):
+        cache = self._projects.get(project_id)
+        if cache is None:
+            with self._projects_lock:
+                cache = self._projects.get(project_id)
+                if cache is None:
+                    lease = self._lease_project(project_id)
+                    if lease is None:
+                        return None
+                    cache = _CachedProject(project_id, lease, resources)
+                    lease.add_lost_callback(
+                        lambda lock: self._lease_lost(cache))
+                    self._projects[project_id] = cache
+                    self._start_sync()
+        return None if cache.lost else cache
+
+    @staticmethod
+    def _lease_lost(cache):
+        cache.lost = True
+        LOG.warning(_LW('Lost the quota usage lease of project %s, its '
+                        'blocks are given back once their reservations '
+                        'are settled.'), cache.project_id)
+
+    @staticmethod
+    def _block_expire():
+        # Blocks of a process that died are rolled back by the reservation
+        # expiry, the live ones are pushed back on every flush
+        return timeutils.utcnow() + datetime.timedelta(
+            seconds=3 * CONF.quota_cache_sync_interval)
+
+    def reserve(self, context, resources, deltas, expire=None,
+                project_id=None, limits=None):
+        expire = self._get_reservation_expire(expire)
+        if project_id is None:
+            project_id = context.project_id
+
+        quotas = self._get_quotas(context, resources, deltas.keys(),
+                                  has_sync=True, project_id=project_id,
+                                  limits=limits)
+        cache = self._get_cached_project(resources, project_id)
+        if cache is not None:
+            with cache.lock:
+                cache.resources = resources
+                blocks = self._take_blocks(context, cache, quotas, deltas)
+                if blocks is not None:
+                    try:
+                        reservations = db.quota_reserve_from_blocks(
+                            context, project_id, blocks, deltas, expire)
+                    except Exception:
+                        with excutils.save_and_reraise_exception():
+                            for res, delta in deltas.items():
+                                cache.held[blocks[res]] -= max(delta, 0)
+                    for reservation, res in zip(reservations, deltas):
+                        cache.granted[reservation] = (blocks[res],
+                                                      deltas[res])
+                    cache.used = True
+                    cache.reserve_count += 1
+                    return reservations
+
+        return self._reserve(context, resources, quotas, deltas, expire,
+                             project_id)
+
+    def _take_blocks(self, context, cache, quotas, deltas):
+        """Pick the blocks the deltas are taken from.
+
+        Blocks are topped up when the deltas don't fit in them.  Returns
+        None when one of them still doesn't fit.
+        """
+        blocks = {}
+        for res, delta in deltas.items():
+            cache.units[res] = max(cache.units.get(res, 1), delta)
+            block = cache.find_block(res, delta)
+            # No block is reserved to release quota
+            if (block is None and delta > 0 and
+                    self._top_up(context, cache, quotas, res)):
+                block = cache.find_block(res, delta)
+            if block is None:
+                return None
+            blocks[res] = block
+
+        for res, delta in deltas.items():
+            cache.held[blocks[res]] += max(delta, 0)
+        return blocks
+
+    def _top_up(self, context, cache, quotas, res):
+        if res in cache.near_limit:
+            return False
+
+        size = CONF.quota_cache_block_reservations * cache.units[res]
+        try:
+            block = db.quota_reserve(context, cache.resources, quotas,
+                                     {res: size}, self._block_expire(),
+                                     CONF.until_refresh, CONF.max_age,
+                                     project_id=cache.project_id,
+                                     stripes=CONF.quota_usage_stripes)[0]
+        except exception.OverQuota:
+            # Given back on the next flush, the DB driver takes over
+            cache.near_limit.add(res)
+            return False
+
+        cache.blocks[res].append(block)
+        cache.sizes[block] = size
+        cache.held[block] = 0
+        return True
+
+    def _forget_granted(self, project_id, reservations, commit):
+        cache = self._projects.get(project_id)
+        if cache is None:
+            return
+        with cache.lock:
+            for reservation in reservations:
+                block, delta = cache.granted.pop(reservation, (None, 0))
+                # Committed ones stay in their block until it is flushed
+                if not commit and block in cache.held:
+                    cache.held[block] -= max(delta, 0)
+
+    def commit(self, context, reservations, project_id=None):
+        super(CachedDbQuotaDriver, self).commit(context, reservations,
+                                                project_id=project_id)
+        self._forget_granted(project_id or context.project_id, reservations,
+                             True)
+
+    def rollback(self, context, reservations, project_id=None):
+        super(CachedDbQuotaDriver, self).rollback(context, reservations,
+                                                  project_id=project_id)
+        self._forget_granted(project_id or context.project_id, reservations,
+                             False)
+
+    def commit_many(self, context, reservations):
+        super(CachedDbQuotaDriver, self).commit_many(context, reservations)
+        for project_id, uuids in reservations.items():
+            self._forget_granted(project_id, uuids, True)
+
+    def rollback_many(self, context, reservations):
+        super(CachedDbQuotaDriver, self).rollback_many(context, reservations)
+        for project_id, uuids in reservations.items():
+            self._forget_granted(project_id, uuids, False)
+
+    def _needs_refresh(self, cache):
+        if CONF.until_refresh and cache.reserve_count >= CONF.until_refresh:
+            return True
+        return bool(CONF.max_age and timeutils.is_older_than(
+            cache.refreshed_at, CONF.max_age))
+
+    def _flush_project(self, context, cache):
+        with cache.lock:
+            blocks = [block for res_blocks in cache.blocks.values()
+                      for block in res_blocks]
+            idle = cache.lost or not cache.used
+            if idle:
+                trim = blocks
+            else:
+                trim = [block for res in cache.near_limit
+                        for block in cache.blocks[res]]
+            refresh = None
+            if self._needs_refresh(cache):
+                refresh = [res for res in cache.blocks
+                           if res in cache.resources]
+
+            sizes = db.quota_usage_flush(context, cache.resources,
+                                         cache.project_id, blocks,
+                                         self._block_expire(),
+                                         refresh=refresh,
+                                         until_refresh=CONF.until_refresh,
+                                         trim=trim)
+
+            for res in list(cache.blocks):
+                cache.blocks[res] = [block for block in cache.blocks[res]
+                                     if block in sizes]
+            cache.sizes = {block: size for block, (size, _held)
+                           in sizes.items()}
+            cache.held = {block: held for block, (_size, held)
+                          in sizes.items()}
+            cache.granted.clear()
+            cache.near_limit.clear()
+            cache.used = False
+            if refresh is not None:
+                cache.reserve_count = 0
+                cache.refreshed_at = timeutils.utcnow()
+
+            if not idle or sizes:
+                return
+
+            # Flushed and given back, other processes can take over
+            with self._projects_lock:
+                self._projects.pop(cache.project_id, None)
+            cache.lost = True
+            try:
+                cache.lease.release()
+            except Exception:
+                LOG.exception(_LE('Failed to release quota usage lease of '
+                                  'project %s'), cache.project_id)
+
+    def sync_usages(self, context):
+        """Flush the reservations made from blocks to the usages."""
+        for cache in list(self._projects.values()):
+            try:
+                self._flush_project(context, cache)
+            except Exception:
+                LOG.exception(_LE('Failed to flush the quota usage of '
+                                  'project %s.'), cache.project_id)
+
+    def release(self, context):
+        """Give back the blocks of all the projects held.
+
+        The blocks of projects with reservations still pending are given
+        back by the following flushes, once they are settled.
+        """
+        for cache in list(self._projects.values()):
+            cache.lost = True
+        self.sync_usages(context)
+
+    def _start_sync(self):
+        if self._sync_timer is None:
+            interval = CONF.quota_cache_sync_interval
+            self._sync_timer = loopingcall.FixedIntervalLoopingCall(
+                self._periodic_sync_usages)
+            self._sync_timer.start(interval=interval, initial_delay=interval)
+            LOG.info(_LI('Started quota usage synchronization every '
+                         '%d seconds.'), CONF.quota_cache_sync_interval)
+
+    def _periodic_sync_usages(self):
+        self.sync_usages(context.get_admin_context())
+
+
 class BaseResource(object):
     """Describe a single resource for quota checking."""
 
@@ -818,6 +1250,9 @@ class QuotaEngine(object):
         self._resources = {}
         self._quota_driver_class = quota_driver_class
         self._driver_class = None
+        # Limits looked up for each request context, by project, with the
+        # time they were looked up
+        self._limits_memo = weakref.WeakKeyDictionary()
 
     @property
     def _driver(self):
@@ -930,6 +1365,47 @@ class QuotaEngine(object):
                                                defaults=defaults,
                                                usages=usages)
 
+    def _get_limits_memo(self, context, project_id):
+        """Return the memo of limits of a project for a request context.
+
+        Limits are looked up once per request, so checking several quotas
+        while handling the same request costs a single query.  Contexts
+        outliving a request, like the admin context of periodic tasks,
+        look them up again once the memo is older than
+        LIMITS_MEMO_LIFETIME seconds.
+        """
+        if project_id is None:
+            project_id = context.project_id
+        memos = self._limits_memo.setdefault(context, {})
+        looked_up_at, limits = memos.get(project_id, (None, None))
+        if looked_up_at is None or timeutils.is_older_than(
+                looked_up_at, LIMITS_MEMO_LIFETIME):
+            limits = {}
+            memos[project_id] = (timeutils.utcnow(), limits)
+        return limits
+
+    def invalidate_limits(self, context=None, project_id=None):
+        """Drop the limits looked up before the quotas were changed.
+
+        Whoever changes the limits of a project while handling a request
+        must call this so that the rest of the request sees the change.
+
+        :param context: The request context whose limits are dropped.  If
+                        None, the limits of every request are dropped.
+        :param project_id: The project whose limits are dropped.  If None,
+                           the limits of every project are dropped.
+        """
+
+        if context is None:
+            memos = list(self._limits_memo.values())
+        else:
+            memos = [self._limits_memo.get(context, {})]
+        for memo in memos:
+            if project_id is None:
+                memo.clear()
+            else:
+                memo.pop(project_id, None)
+
     def count(self, context, resource, *args, **kwargs):
         """Count a resource.
 
@@ -974,8 +1450,10 @@ class QuotaEngine(object):
                            common user's tenant.
         """
 
+        limits = self._get_limits_memo(context, project_id)
         return self._driver.limit_check(context, self.resources, values,
-                                        project_id=project_id)
+                                        project_id=project_id,
+                                        limits=limits)
 
     def reserve(self, context, expire=None, project_id=None, **deltas):
         """Check quotas and reserve resources.
@@ -1012,9 +1490,11 @@ class QuotaEngine(object):
                            common user's tenant.
         """
 
+        limits = self._get_limits_memo(context, project_id)
         reservations = self._driver.reserve(context, self.resources, deltas,
                                             expire=expire,
-                                            project_id=project_id)
+                                            project_id=project_id,
+                                            limits=limits)
 
         LOG.debug("Created reservations %s", reservations)
 
@@ -1062,6 +1542,44 @@ class QuotaEngine(object):
             LOG.exception(_LE("Failed to roll back reservations "
                               "%s"), reservations)
 
+    def commit_many(self, context, reservations):
+        """Commit reservations of several projects in one transaction.
+
+        :param context: The request context, for access checks.
+        :param reservations: A dictionary mapping project ids to lists of
+                             the reservation UUIDs, as returned by the
+                             reserve() method.
+        """
+
+        try:
+            self._driver.commit_many(context, reservations)
+        except Exception:
+            # NOTE(Vek): Ignoring exceptions here is safe, because the
+            # usage resynchronization and the reservation expiration
+            # mechanisms will resolve the issue.  The exception is
+            # logged, however, because this is less than optimal.
+            LOG.exception(_LE("Failed to commit "
+                              "reservations %s"), reservations)
+
+    def rollback_many(self, context, reservations):
+        """Roll back reservations of several projects in one transaction.
+
+        :param context: The request context, for access checks.
+        :param reservations: A dictionary mapping project ids to lists of
+                             the reservation UUIDs, as returned by the
+                             reserve() method.
+        """
+
+        try:
+            self._driver.rollback_many(context, reservations)
+        except Exception:
+            # NOTE(Vek): Ignoring exceptions here is safe, because the
+            # usage resynchronization and the reservation expiration
+            # mechanisms will resolve the issue.  The exception is
+            # logged, however, because this is less than optimal.
+            LOG.exception(_LE("Failed to roll back reservations "
+                              "%s"), reservations)
+
     def destroy_by_project(self, context, project_id):
         """Destroy all quota limits associated with a project.
 
@@ -1070,6 +1588,8 @@ class QuotaEngine(object):
         """
 
         self._driver.destroy_by_project(context, project_id)
+        self.invalidate_limits(project_id=project_id)
+        quota_utils.invalidate_project_hierarchy(project_id)
 
     def expire(self, context):
         """Expire reservations.
@@ -1078,9 +1598,19 @@ class QuotaEngine(object):
         any that have expired.
 
         :param context: The request context, for access checks.
+        :returns: The number of reservations that were rolled back.
+        """
+
+        return self._driver.expire(context)
+
+    def reconcile_usages(self, context):
+        """Reconcile striped quota usages.
+
+        :param context: The request context, for access checks.
+        :returns: The number of usages that were reconciled.
         """
 
-        self._driver.expire(context)
+        return self._driver.reconcile_usages(context)
 
     def add_workflow_type_opts(self, context, opts, workflow_type_id):
         """Add workflow type resource options.
@@ -1119,10 +1649,41 @@ class QuotaEngine(object):
 class WorkflowTypeQuotaEngine(QuotaEngine):
     """Represent the set of all quotas."""
 
+    def __init__(self, quota_driver_class=None):
+        super(WorkflowTypeQuotaEngine, self).__init__(quota_driver_class)
+        # (resources, load time) or None, replaced as a whole
+        self._resources_cache = None
+        self._resources_generation = 0
+
     @property
     def resources(self):
-        """Fetches all possible quota resources."""
+        """Fetches all possible quota resources.
+
+        The resources are cached for quota_resources_cache_ttl seconds, or
+        until invalidate_resources() is called.  Nothing else invalidates
+        them, so the TTL bounds how long workflow type changes go unseen.
+        """
+
+        cached = self._resources_cache
+        if cached is not None and not timeutils.is_older_than(
+                cached[1], CONF.quota_resources_cache_ttl):
+            return cached[0]
+
+        generation = self._resources_generation
+        result = self._load_resources()
+        # Don't cache what was loaded while an invalidation was going on
+        if (CONF.quota_resources_cache_ttl and
+                generation == self._resources_generation):
+            self._resources_cache = (result, timeutils.utcnow())
+        return result
+
+    def invalidate_resources(self):
+        """Drop the cached resources, for workflow type changes."""
+
+        self._resources_generation += 1
+        self._resources_cache = None
 
+    def _load_resources(self):
         result = {}
         # Global quotas.
         argses = [('workflows', '_sync_workflows', 'quota_workflows'),
@@ -1174,6 +1735,8 @@ class WorkflowTypeQuotaEngine(QuotaEngine):
             db.quota_update_resource(context,
                                      old_res,
                                      new_res)
+        self.invalidate_resources()
+        self.invalidate_limits()
 
 
 class CGQuotaEngine(QuotaEngine):
@@ -12,26 +12,36 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import copy
+import threading
+
 import webob
 
 from oslo_config import cfg
 from oslo_log import log as logging
-
-from keystoneclient.auth.identity.generic import token
-from keystoneclient import client
-from keystoneclient import exceptions
-from keystoneclient import session
+from oslo_utils import timeutils
 
 from waterfall import db
 from waterfall import exception
 from waterfall.i18n import _, _LW
 
+quota_utils_opts = [
+    cfg.IntOpt('project_hierarchy_cache_ttl',
+               default=60,
+               help='Number of seconds the Keystone project hierarchy used '
+                    'by nested quotas is cached.  Set to 0 to disable the '
+                    'cache.'),
+]
+
 CONF = cfg.CONF
-CONF.import_opt('auth_uri', 'keystonemiddleware.auth_token.__init__',
-                'keystone_authtoken')
+CONF.register_opts(quota_utils_opts)
 
 LOG = logging.getLogger(__name__)
 
+# Keystone session shared by all the clients so connections are pooled
+_KEYSTONE_SESSION = None
+_KEYSTONE_SESSION_LOCK = threading.Lock()
+
 
 class GenericProjectInfo(object):
     """Abstraction layer for Keystone V2 and V3 project objects"""
@@ -48,6 +58,72 @@ class GenericProjectInfo(object):
         self.is_admin_project = is_admin_project
 
 
+class ProjectHierarchyCache(object):
+    """Cache of Keystone project hierarchies with a time to live.
+
+    Entries are GenericProjectInfo instances keyed by the project id and the
+    parts of the tree that were requested, and can be explicitly invalidated
+    when the hierarchy is known to have changed.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ttl = CONF.project_hierarchy_cache_ttl
+        if ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if timeutils.is_older_than(stored_at, ttl):
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if CONF.project_hierarchy_cache_ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (timeutils.utcnow(), value)
+
+    def invalidate(self, project_id=None):
+        """Drop cached entries mentioning a project, or all of them.
+
+        Moving or deleting a project changes the subtree of its parents and
+        the parents of its subtree too, so those entries are dropped as well.
+        When a project is moved its new parent must be invalidated too.
+        """
+        with self._lock:
+            if project_id is None:
+                self._entries.clear()
+                return
+            for key, (_stored_at, value) in list(self._entries.items()):
+                if key[0] in (project_id, None) or _mentions(value,
+                                                             project_id):
+                    del self._entries[key]
+
+
+def _mentions(project, project_id):
+    def in_tree(tree):
+        return bool(tree) and any(node == project_id or in_tree(children)
+                                  for node, children in tree.items())
+
+    return (project.parent_id == project_id or in_tree(project.subtree) or
+            in_tree(project.parents))
+
+
+PROJECT_HIERARCHY_CACHE = ProjectHierarchyCache()
+
+
+def invalidate_project_hierarchy(project_id=None):
+    """Forget the cached hierarchy of a project, or of all projects."""
+    PROJECT_HIERARCHY_CACHE.invalidate(project_id)
+
+
 def get_workflow_type_reservation(ctxt, workflow, type_id,
                                 reserve_vol_type_only=False):
     from waterfall import quota
@@ -129,6 +205,24 @@ def get_project_hierarchy(context, project_id, subtree_as_ids=False,
     If the domain is being used as the top most parent, it is filtered out from
     the parent tree and parent_id.
     """
+    key = (project_id, subtree_as_ids, parents_as_ids)
+    generic_project = PROJECT_HIERARCHY_CACHE.get(key)
+    if generic_project is None:
+        generic_project = _get_project_hierarchy(context, project_id,
+                                                 subtree_as_ids,
+                                                 parents_as_ids)
+        PROJECT_HIERARCHY_CACHE.set(key, generic_project)
+
+    # is_admin_project depends on the caller, so don't change cached entries
+    generic_project = copy.copy(generic_project)
+    generic_project.is_admin_project = is_admin_project
+    return generic_project
+
+
+def _get_project_hierarchy(context, project_id, subtree_as_ids,
+                           parents_as_ids):
+    from keystoneclient import exceptions
+
     try:
         keystone = _keystone_client(context)
         generic_project = GenericProjectInfo(project_id, keystone.version)
@@ -148,9 +242,9 @@ def get_project_hierarchy(context, project_id, subtree_as_ids=False,
             if parents_as_ids:
                 generic_project.parents = _filter_domain_id_from_parents(
                     project.domain_id, project.parents)
-
-            generic_project.is_admin_project = is_admin_project
     except exceptions.NotFound:
+        # Deleted, don't keep it in the trees of other projects either
+        invalidate_project_hierarchy(project_id)
         msg = (_("Tenant ID: %s does not exist.") % project_id)
         raise webob.exc.HTTPNotFound(explanation=msg)
 
@@ -162,8 +256,15 @@ def get_parent_project_id(context, project_id):
 
 
 def get_all_projects(context):
-    # Right now this would have to be done as cloud admin with Keystone v3
-    return _keystone_client(context, (3, 0)).projects.list()
+    # The project list is cached under a key without project id, so it is
+    # dropped when any project is invalidated
+    key = (None, 'all_projects')
+    projects = PROJECT_HIERARCHY_CACHE.get(key)
+    if projects is None:
+        # Right now this would have to be done as cloud admin with Keystone v3
+        projects = _keystone_client(context, (3, 0)).projects.list()
+        PROJECT_HIERARCHY_CACHE.set(key, projects)
+    return projects
 
 
 def get_all_root_project_ids(context):
@@ -223,6 +324,10 @@ def validate_setup_for_nested_quota_use(ctxt, resources,
         be updated. If False, an exception is raised reporting any parent
         allocated quotas are currently incorrect.
     """
+    from keystoneclient import exceptions
+
+    # Validate against the hierarchy as it is now in Keystone
+    invalidate_project_hierarchy()
     try:
         project_roots = get_all_root_project_ids(ctxt)
 
@@ -255,13 +360,34 @@ def _keystone_client(context, version=(3, 0)):
     :param version: version of Keystone to request
     :return: keystoneclient.client.Client object
     """
+    # keystoneclient and the keystone_authtoken options are only loaded by
+    # the services using nested quotas, the first time they need Keystone.
+    from keystoneclient.auth.identity.generic import token
+    from keystoneclient import client
+    CONF.import_opt('auth_uri', 'keystonemiddleware.auth_token.__init__',
+                    'keystone_authtoken')
+
     auth_plugin = token.Token(
         auth_url=CONF.keystone_authtoken.auth_uri,
         token=context.auth_token,
         project_id=context.project_id)
-    client_session = session.Session(auth=auth_plugin,
-                                     verify=False if
-                                     CONF.keystone_authtoken.insecure else
-                                     (CONF.keystone_authtoken.cafile or True))
     return client.Client(auth_url=CONF.keystone_authtoken.auth_uri,
-                         session=client_session, version=version)
+                         session=_keystone_session(), auth=auth_plugin,
+                         version=version)
+
+
+def _keystone_session():
+    """Return the Keystone session shared by all clients.
+
+    Authentication is per request, so the session carries no auth plugin and
+    is only used to reuse its pool of connections.
+    """
+    from keystoneclient import session
+
+    global _KEYSTONE_SESSION
+    with _KEYSTONE_SESSION_LOCK:
+        if _KEYSTONE_SESSION is None:
+            _KEYSTONE_SESSION = session.Session(
+                verify=False if CONF.keystone_authtoken.insecure else
+                (CONF.keystone_authtoken.cafile or True))
+        return _KEYSTONE_SESSION
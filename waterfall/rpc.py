@@ -26,6 +26,11 @@ __all__ = [
     'TRANSPORT_ALIASES',
 ]
 
+import functools
+import inspect
+import threading
+import time
+
 from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
@@ -36,14 +41,51 @@ profiler = importutils.try_import('osprofiler.profiler')
 import waterfall.context
 import waterfall.exception
 from waterfall.i18n import _LI
+from waterfall.common import metrics
 from waterfall import objects
 from waterfall.objects import base
 
+rpc_opts = [
+    cfg.BoolOpt('rpc_compact_context',
+                default=True,
+                help='Send only the fields of the request context used by '
+                     'the managers in the RPC messages, including the auth '
+                     'token the quota code uses to talk to Keystone, '
+                     'instead of the full context including the service '
+                     'catalog.'),
+    cfg.BoolOpt('rpc_measure_payload_size',
+                default=False,
+                help='Encode the arguments of the RPC messages sent, and '
+                     'the request contexts in their full and compact forms, '
+                     'once more to record their size. Only meant for '
+                     'debugging, it costs a second encoding of every '
+                     'message.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(rpc_opts)
 LOG = logging.getLogger(__name__)
 TRANSPORT = None
 NOTIFIER = None
 
+# Messages sent per method, "<topic>.<method>", and the size in bytes of
+# their serialized arguments when rpc_measure_payload_size is set
+CAST_TIMINGS = metrics.timings('rpc.casts')
+CALL_TIMINGS = metrics.timings('rpc.calls')
+PAYLOAD_SIZES = metrics.timings('rpc.payload_bytes')
+# Messages handled per method, and the delay between their sending and their
+# dispatching.  The delay is only accurate if the clocks of the hosts are in
+# sync.
+DISPATCH_TIMINGS = metrics.timings('rpc.dispatch')
+QUEUE_DELAYS = metrics.timings('rpc.queue_delay')
+# Size in bytes of the contexts sent, in their compact and full forms, and
+# the bytes saved by the compact form, measured once per context when
+# rpc_measure_payload_size is set
+CONTEXT_SIZES = metrics.timings('rpc.context_bytes')
+
+# Green thread local state of the message being sent or dispatched
+_MESSAGE = threading.local()
+
 ALLOWED_EXMODS = [
     waterfall.exception.__name__,
 ]
@@ -69,7 +111,8 @@ def init(conf):
                                         allowed_remote_exmods=exmods,
                                         aliases=TRANSPORT_ALIASES)
 
-    serializer = RequestContextSerializer(JsonPayloadSerializer())
+    serializer = RequestContextSerializer(JsonPayloadSerializer(),
+                                          sent_at=False)
     NOTIFIER = messaging.Notifier(TRANSPORT, serializer=serializer)
 
 
@@ -109,21 +152,61 @@ class JsonPayloadSerializer(messaging.NoOpSerializer):
 
 class RequestContextSerializer(messaging.Serializer):
 
-    def __init__(self, base):
+    def __init__(self, base, compact=False, sent_at=True):
         self._base = base
+        self._compact = compact
+        # Only the RPC messages have their queue delay recorded
+        self._sent_at = sent_at
 
     def serialize_entity(self, context, entity):
-        if not self._base:
-            return entity
-        return self._base.serialize_entity(context, entity)
+        if self._base:
+            entity = self._base.serialize_entity(context, entity)
+        if getattr(_MESSAGE, 'payload_size', None) is not None:
+            try:
+                _MESSAGE.payload_size += len(jsonutils.dump_as_bytes(entity))
+            except Exception:
+                # The transport encodes it its own way, the size is only
+                # given up on
+                LOG.debug('Could not measure the size of %s.', type(entity))
+                _MESSAGE.payload_size = None
+        return entity
 
     def deserialize_entity(self, context, entity):
         if not self._base:
             return entity
         return self._base.deserialize_entity(context, entity)
 
+    def _compact_context(self, context):
+        # Built once per context instance, until the context is changed
+        compact = context.__dict__.get('rpc_cache')
+        if compact is None or compact['roles'] != context.roles:
+            compact = context.to_rpc_dict()
+            # Not through setattr, which drops the cached form
+            context.__dict__['rpc_cache'] = compact
+            if CONF.rpc_measure_payload_size:
+                self._record_context_sizes(context, compact)
+        return dict(compact)
+
+    @staticmethod
+    def _record_context_sizes(context, compact):
+        try:
+            compact_size = len(jsonutils.dump_as_bytes(compact))
+            full_size = len(jsonutils.dump_as_bytes(context.to_dict()))
+        except Exception:
+            LOG.debug('Could not measure the size of the context.')
+            return
+        CONTEXT_SIZES.record('compact', compact_size)
+        CONTEXT_SIZES.record('full', full_size)
+        CONTEXT_SIZES.record('saved', full_size - compact_size)
+
     def serialize_context(self, context):
-        _context = context.to_dict()
+        if self._compact and isinstance(context,
+                                        waterfall.context.RequestContext):
+            _context = self._compact_context(context)
+        else:
+            _context = context.to_dict()
+        if self._sent_at:
+            _context['sent_at'] = time.time()
         if profiler is not None:
             prof = profiler.get()
             if prof:
@@ -136,6 +219,9 @@ class RequestContextSerializer(messaging.Serializer):
         return _context
 
     def deserialize_context(self, context):
+        sent_at = context.pop('sent_at', None)
+        if sent_at is not None:
+            _MESSAGE.queue_delay = max(0.0, time.time() - sent_at)
         trace_info = context.pop("trace_info", None)
         if trace_info:
             if profiler is not None:
@@ -144,18 +230,94 @@ class RequestContextSerializer(messaging.Serializer):
         return waterfall.context.RequestContext.from_dict(context)
 
 
+class _CallContext(object):
+    """Prepared RPC client recording the messages it sends."""
+
+    def __init__(self, cctxt, topic):
+        self._cctxt = cctxt
+        self._topic = topic
+
+    def _send(self, timings, send, ctxt, method, kwargs):
+        key = '%s.%s' % (self._topic, method)
+        if not CONF.rpc_measure_payload_size:
+            with timings.time(key):
+                return send(ctxt, method, **kwargs)
+
+        # Summed up by the serializer while the message is built
+        _MESSAGE.payload_size = 0
+        try:
+            with timings.time(key):
+                return send(ctxt, method, **kwargs)
+        finally:
+            if _MESSAGE.payload_size is not None:
+                PAYLOAD_SIZES.record(key, _MESSAGE.payload_size)
+            _MESSAGE.payload_size = None
+
+    def cast(self, ctxt, method, **kwargs):
+        return self._send(CAST_TIMINGS, self._cctxt.cast, ctxt, method,
+                          kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self._send(CALL_TIMINGS, self._cctxt.call, ctxt, method,
+                          kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cctxt, name)
+
+
+class RPCClient(messaging.RPCClient):
+    """RPC client recording the casts and calls per method."""
+
+    def prepare(self, *args, **kwargs):
+        cctxt = super(RPCClient, self).prepare(*args, **kwargs)
+        return _CallContext(cctxt, kwargs.get('topic') or self.target.topic)
+
+    def cast(self, ctxt, method, **kwargs):
+        self.prepare().cast(ctxt, method, **kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self.prepare().call(ctxt, method, **kwargs)
+
+
 def get_client(target, version_cap=None, serializer=None):
     assert TRANSPORT is not None
-    serializer = RequestContextSerializer(serializer)
-    return messaging.RPCClient(TRANSPORT,
-                               target,
-                               version_cap=version_cap,
-                               serializer=serializer)
+    serializer = RequestContextSerializer(serializer,
+                                          compact=CONF.rpc_compact_context)
+    return RPCClient(TRANSPORT,
+                     target,
+                     version_cap=version_cap,
+                     serializer=serializer)
+
+
+class _Endpoint(object):
+    """RPC endpoint recording the messages it handles."""
+
+    def __init__(self, endpoint, topic):
+        self._endpoint = endpoint
+        self._topic = topic
+
+    def __getattr__(self, name):
+        attr = getattr(self._endpoint, name)
+        if name.startswith('_') or not inspect.ismethod(attr):
+            return attr
+        key = '%s.%s' % (self._topic, name)
+
+        @functools.wraps(attr)
+        def handle(ctxt, *args, **kwargs):
+            # Set by the serializer when the message context was received
+            delay = getattr(_MESSAGE, 'queue_delay', None)
+            if delay is not None:
+                QUEUE_DELAYS.record(key, delay)
+                _MESSAGE.queue_delay = None
+            with DISPATCH_TIMINGS.time(key):
+                return attr(ctxt, *args, **kwargs)
+        return handle
 
 
 def get_server(target, endpoints, serializer=None):
     assert TRANSPORT is not None
     serializer = RequestContextSerializer(serializer)
+    endpoints = [_Endpoint(endpoint, target.topic) for endpoint in endpoints]
     return messaging.get_rpc_server(TRANSPORT,
                                     target,
                                     endpoints,
@@ -0,0 +1,138 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Manage hosts in the current zone.
+
+Managers publish their capabilities as numbered updates: a full sync
+carries all of them, the updates in between only the capabilities changed
+since the previous one.  The HostManager merges them into a cached state
+per host.  A delta that doesn't follow the cached version is ignored and
+the host keeps its previous state until its next full sync.
+"""
+
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from waterfall.common import metrics
+from waterfall.i18n import _LI
+
+LOG = logging.getLogger(__name__)
+
+host_manager_opts = [
+    cfg.IntOpt('host_state_max_age',
+               default=1800,
+               min=0,
+               help='Seconds after which the state of a host that stopped '
+                    'sending capabilities is dropped by the schedulers, 0 '
+                    'keeps it forever. Must be greater than '
+                    'capabilities_full_sync_interval.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(host_manager_opts)
+
+
+class HostState(object):
+    """Capabilities of a service on a host, as last reported."""
+
+    def __init__(self, host, service_name):
+        self.host = host
+        self.service_name = service_name
+        self.capabilities = {}
+        self.version = None
+        self.updated_at = None
+
+    def update(self, capabilities, version, full_sync, removed):
+        """Apply an update, return False if it can't be applied."""
+        if full_sync:
+            self.capabilities = dict(capabilities)
+        elif self.version is None or version != self.version + 1:
+            return False
+        else:
+            self.capabilities.update(capabilities)
+            for name in removed:
+                self.capabilities.pop(name, None)
+        self.version = version
+        self.updated_at = time.time()
+        return True
+
+    def __repr__(self):
+        return ('host: %(host)s service: %(service)s version: %(version)s' %
+                {'host': self.host, 'service': self.service_name,
+                 'version': self.version})
+
+
+class HostManager(object):
+    """Base HostManager class."""
+
+    def __init__(self):
+        self.host_state_map = {}
+        self.stats = {'full_syncs': 0, 'deltas': 0, 'ignored': 0,
+                      'expired': 0}
+        metrics.register_source('host_states', self.report)
+
+    def update_service_capabilities(self, service_name, host, capabilities,
+                                    capabilities_version, full_sync=True,
+                                    removed=None):
+        """Merge an update of the capabilities of a service."""
+        key = (service_name, host)
+        state = self.host_state_map.get(key)
+        if state is None:
+            if not full_sync:
+                self.stats['ignored'] += 1
+                LOG.debug('Ignoring capabilities delta %(version)s of '
+                          '%(service)s on %(host)s until its full sync.',
+                          {'version': capabilities_version,
+                           'service': service_name, 'host': host})
+                return
+            state = self.host_state_map[key] = HostState(host, service_name)
+
+        if not state.update(capabilities, capabilities_version, full_sync,
+                            removed or []):
+            self.stats['ignored'] += 1
+            LOG.debug('Ignoring capabilities delta %(version)s of '
+                      '%(service)s on %(host)s, it follows version '
+                      '%(cached)s.',
+                      {'version': capabilities_version,
+                       'service': service_name, 'host': host,
+                       'cached': state.version})
+            return
+        self.stats['full_syncs' if full_sync else 'deltas'] += 1
+        LOG.debug('Received %(service)s capabilities %(version)s from '
+                  '%(host)s.', {'service': service_name, 'host': host,
+                                'version': capabilities_version})
+
+    def _expire_host_states(self):
+        if not CONF.host_state_max_age:
+            return
+        oldest = time.time() - CONF.host_state_max_age
+        for key, state in list(self.host_state_map.items()):
+            if state.updated_at < oldest:
+                LOG.info(_LI('Dropping the state of %(service)s on '
+                             '%(host)s, no capabilities received for '
+                             '%(age)s seconds.'),
+                         {'service': state.service_name, 'host': state.host,
+                          'age': CONF.host_state_max_age})
+                del self.host_state_map[key]
+                self.stats['expired'] += 1
+
+    def get_all_host_states(self, service_name=None):
+        """Return the states of the hosts reporting capabilities."""
+        self._expire_host_states()
+        return [state for state in self.host_state_map.values()
+                if service_name is None or state.service_name == service_name]
+
+    def report(self):
+        return dict(self.stats, hosts=len(self.host_state_map))
@@ -0,0 +1,46 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Scheduler Service
+"""
+
+from oslo_log import log as logging
+import oslo_messaging as messaging
+
+from waterfall import manager
+from waterfall.scheduler import host_manager
+
+LOG = logging.getLogger(__name__)
+
+
+class SchedulerManager(manager.Manager):
+    """Keep the capabilities of the hosts up to date."""
+
+    RPC_API_VERSION = '1.0'
+
+    target = messaging.Target(version=RPC_API_VERSION)
+
+    def __init__(self, service_name=None, *args, **kwargs):
+        self.host_manager = host_manager.HostManager()
+        super(SchedulerManager, self).__init__(*args, **kwargs)
+
+    def update_service_capabilities(self, context, service_name=None,
+                                    host=None, capabilities=None,
+                                    capabilities_version=None,
+                                    full_sync=True, removed=None):
+        """Process a capability update from a service node."""
+        if capabilities is None:
+            capabilities = {}
+        self.host_manager.update_service_capabilities(
+            service_name, host, capabilities, capabilities_version,
+            full_sync=full_sync, removed=removed)
@@ -0,0 +1,63 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Client side of the scheduler manager RPC API.
+"""
+
+from oslo_config import cfg
+import oslo_messaging as messaging
+
+from waterfall.objects import base as objects_base
+from waterfall import rpc
+
+
+CONF = cfg.CONF
+
+
+class SchedulerAPI(object):
+    """Client side of the scheduler rpc API.
+
+    API version history:
+
+        1.0 - Initial version, with delta capability updates.
+    """
+
+    RPC_API_VERSION = '1.0'
+    TOPIC = CONF.scheduler_topic
+    BINARY = 'waterfall-scheduler'
+
+    def __init__(self):
+        super(SchedulerAPI, self).__init__()
+        target = messaging.Target(topic=CONF.scheduler_topic,
+                                  version=self.RPC_API_VERSION)
+        serializer = objects_base.WaterfallObjectSerializer()
+        self.client = rpc.get_client(target, version_cap='1.0',
+                                     serializer=serializer)
+
+    def update_service_capabilities(self, ctxt, service_name, host,
+                                    capabilities, capabilities_version,
+                                    full_sync=True, removed=None):
+        """Send the capabilities of a host to all the schedulers.
+
+        :param capabilities: All the capabilities of the host if full_sync
+            is True, otherwise only the ones changed since the update
+            numbered capabilities_version - 1.
+        :param removed: Names of the capabilities dropped since the last
+            update.
+        """
+        cctxt = self.client.prepare(fanout=True)
+        cctxt.cast(ctxt, 'update_service_capabilities',
+                   service_name=service_name, host=host,
+                   capabilities=capabilities,
+                   capabilities_version=capabilities_version,
+                   full_sync=full_sync, removed=removed or [])
@@ -21,6 +21,7 @@
 import inspect
 import os
 import random
+import time
 
 from oslo_concurrency import processutils
 from oslo_config import cfg
@@ -36,7 +37,11 @@ profiler = importutils.try_import('osprofiler.profiler')
 osprofiler_web = importutils.try_import('osprofiler.web')
 profiler_opts = importutils.try_import('osprofiler.opts')
 
+from waterfall.common import metrics
+from waterfall.common import periodic
 from waterfall import context
+from waterfall import coordination
+from waterfall import db
 from waterfall import exception
 from waterfall.i18n import _, _LE, _LI, _LW
 from waterfall import objects
@@ -60,6 +65,14 @@ service_opts = [
                help='Range, in seconds, to randomly delay when starting the'
                     ' periodic task scheduler to reduce stampeding.'
                     ' (Disable by setting to 0)'),
+    cfg.IntOpt('drain_timeout',
+               default=30,
+               min=0,
+               help='Number of seconds a stopping service waits for the '
+                    'operations it is running once it stopped consuming '
+                    'RPC messages. The unfinished ones are left to be '
+                    'resumed. Should be lower than '
+                    'graceful_shutdown_timeout.'),
     cfg.StrOpt('osapi_workflow_listen',
                default="0.0.0.0",
                help='IP address on which OpenStack Workflow API listens'),
@@ -105,6 +118,83 @@ def setup_profiler(binary, host):
         osprofiler_web.disable()
 
 
+class ServiceHeartbeat(object):
+    """Report the state of all the services of this process at once.
+
+    Every `report_interval` seconds the services whose manager is working
+    get their report count bumped by a single UPDATE, through one pooled
+    connection, instead of a read and a write per service.
+    """
+
+    def __init__(self):
+        self.services = {}
+        self._timer = None
+
+    def add(self, svc):
+        self.services[svc.service_id] = svc
+        if self._timer is None:
+            self._timer = loopingcall.FixedIntervalLoopingCall(self.report)
+            self._timer.start(interval=svc.report_interval,
+                              initial_delay=svc.report_interval)
+
+    def remove(self, svc):
+        self.services.pop(getattr(svc, 'service_id', None), None)
+        if not self.services and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def report(self, services=None):
+        if services is None:
+            services = list(self.services.values())
+        services = [s for s in services if s.is_reporting()]
+        if not services:
+            return
+
+        ctxt = context.get_admin_context()
+        zone = CONF.storage_availability_zone
+        try:
+            missing = db.service_heartbeat(
+                ctxt, [s.service_id for s in services],
+                availability_zone=zone)
+            for svc in services:
+                if svc.service_id not in missing:
+                    continue
+                LOG.debug('The service database object disappeared, '
+                          'recreating it.')
+                registered = self.services.pop(svc.service_id, None)
+                svc._create_service_ref(ctxt)
+                if registered:
+                    self.services[svc.service_id] = svc
+
+            # TODO(termie): make this pattern be more elegant.
+            for svc in services:
+                if getattr(svc, 'model_disconnected', False):
+                    svc.model_disconnected = False
+                    LOG.error(_LE('Recovered model server connection!'))
+
+        except db_exc.DBConnectionError:
+            self._disconnected(services, _LE('model server went away'))
+
+        # NOTE(jsbryant) Other DB errors can happen in HA configurations.
+        # such errors shouldn't kill this thread, so we handle them here.
+        except db_exc.DBError:
+            self._disconnected(services, _LE('DBError encountered: '))
+
+        except Exception:
+            self._disconnected(services, _LE('Exception encountered: '))
+
+    @staticmethod
+    def _disconnected(services, message):
+        if not all(getattr(s, 'model_disconnected', False)
+                   for s in services):
+            LOG.exception(message)
+        for svc in services:
+            svc.model_disconnected = True
+
+
+HEARTBEAT = ServiceHeartbeat()
+
+
 class Service(service.Service):
     """Service object for binaries running on hosts.
 
@@ -115,7 +205,8 @@ class Service(service.Service):
 
     def __init__(self, host, binary, topic, manager, report_interval=None,
                  periodic_interval=None, periodic_fuzzy_delay=None,
-                 service_name=None, *args, **kwargs):
+                 service_name=None, coordination=False, metrics_port=None,
+                 metrics_port_count=1, *args, **kwargs):
         super(Service, self).__init__()
 
         if not rpc.initialized():
@@ -135,15 +226,15 @@ class Service(service.Service):
         # result in us using None (if it's the first time the service is run)
         # or an old version (if this is a normal upgrade of a single service).
         ctxt = context.get_admin_context()
-        #try:
-        #    service_ref = objects.Service.get_by_args(ctxt, host, binary)
-        #    service_ref.rpc_current_version = manager_class.RPC_API_VERSION
-        #    obj_version = objects_base.OBJ_VERSIONS.get_current()
-        #    service_ref.object_current_version = obj_version
-        #    service_ref.save()
-        #    self.service_id = service_ref.id
-        #except exception.NotFound:
-        #    self._create_service_ref(ctxt, manager_class.RPC_API_VERSION)
+        try:
+            service_ref = objects.Service.get_by_args(ctxt, host, binary)
+            service_ref.rpc_current_version = manager_class.RPC_API_VERSION
+            obj_version = objects_base.OBJ_VERSIONS.get_current()
+            service_ref.object_current_version = obj_version
+            service_ref.save()
+            self.service_id = service_ref.id
+        except exception.NotFound:
+            self._create_service_ref(ctxt, manager_class.RPC_API_VERSION)
 
         self.manager = manager_class(host=self.host,
                                      service_name=service_name,
@@ -154,6 +245,10 @@ class Service(service.Service):
         self.basic_config_check()
         self.saved_args, self.saved_kwargs = args, kwargs
         self.timers = []
+        self.coordination = coordination
+        self.metrics_port = metrics_port
+        self.metrics_port_count = metrics_port_count
+        self.metrics_server = None
 
         setup_profiler(binary, host)
         self.rpcserver = None
@@ -163,6 +258,15 @@ class Service(service.Service):
         LOG.info(_LI('Starting %(topic)s node (version %(version_string)s)'),
                  {'topic': self.topic, 'version_string': version_string})
         self.model_disconnected = False
+
+        # Services launched with several workers are started in processes
+        # forked after the service DB entry was written, they must not
+        # share the DB connections of their parent.
+        db.dispose_engine()
+
+        if self.coordination:
+            coordination.COORDINATOR.start()
+
         self.manager.init_host()
 
         LOG.debug("Creating RPC server for service %s", self.topic)
@@ -176,12 +280,8 @@ class Service(service.Service):
 
         self.manager.init_host_with_rpc()
 
-        #if self.report_interval:
-        #    pulse = loopingcall.FixedIntervalLoopingCall(
-        #        self.report_state)
-        #    pulse.start(interval=self.report_interval,
-        #                initial_delay=self.report_interval)
-        #    self.timers.append(pulse)
+        if self.report_interval:
+            HEARTBEAT.add(self)
 
         if self.periodic_interval:
             if self.periodic_fuzzy_delay:
@@ -189,11 +289,14 @@ class Service(service.Service):
             else:
                 initial_delay = None
 
-            periodic = loopingcall.FixedIntervalLoopingCall(
-                self.periodic_tasks)
-            periodic.start(interval=self.periodic_interval,
-                           initial_delay=initial_delay)
-            self.timers.append(periodic)
+            self.periodic = periodic.PeriodicScheduler(
+                self.manager, context.get_admin_context)
+            self.periodic.start(initial_delay=initial_delay)
+            self.timers.extend(self.periodic.timers)
+
+        if self.metrics_port:
+            self.metrics_server = metrics.start_server(
+                self.metrics_port, self.metrics_port_count)
 
     def basic_config_check(self):
         """Perform basic config checks before starting service."""
@@ -234,7 +337,8 @@ class Service(service.Service):
     @classmethod
     def create(cls, host=None, binary=None, topic=None, manager=None,
                report_interval=None, periodic_interval=None,
-               periodic_fuzzy_delay=None, service_name=None):
+               periodic_fuzzy_delay=None, service_name=None,
+               coordination=False, metrics_port=None, metrics_port_count=1):
         """Instantiates class and passes back application object.
 
         :param host: defaults to CONF.host
@@ -244,6 +348,11 @@ class Service(service.Service):
         :param report_interval: defaults to CONF.report_interval
         :param periodic_interval: defaults to CONF.periodic_interval
         :param periodic_fuzzy_delay: defaults to CONF.periodic_fuzzy_delay
+        :param coordination: whether to start the coordination backend
+        :param metrics_port: first port the processes of the service serve
+                             their metrics on, None to not serve them
+        :param metrics_port_count: number of ports from metrics_port on,
+                                   one per process of the service
 
         """
         if not host:
@@ -265,7 +374,10 @@ class Service(service.Service):
                           report_interval=report_interval,
                           periodic_interval=periodic_interval,
                           periodic_fuzzy_delay=periodic_fuzzy_delay,
-                          service_name=service_name)
+                          service_name=service_name,
+                          coordination=coordination,
+                          metrics_port=metrics_port,
+                          metrics_port_count=metrics_port_count)
 
         return service_obj
 
@@ -277,12 +389,30 @@ class Service(service.Service):
         except Exception:
             pass
 
+        # No new messages are consumed now, let the running ones finish
+        start = time.time()
+        try:
+            self.manager.drain(CONF.drain_timeout)
+        except Exception:
+            LOG.exception(_LE('Error draining %s.'), self.topic)
+        LOG.info(_LI('Drained %(topic)s in %(elapsed).2f seconds.'),
+                 {'topic': self.topic, 'elapsed': time.time() - start})
+
+        HEARTBEAT.remove(self)
         self.timers_skip = []
         for x in self.timers:
             try:
                 x.stop()
             except Exception:
                 self.timers_skip.append(x)
+
+        if self.coordination:
+            try:
+                coordination.COORDINATOR.stop()
+            except Exception:
+                pass
+        if self.metrics_server:
+            self.metrics_server.stop()
         super(Service, self).stop(graceful=True)
 
     def wait(self):
@@ -304,54 +434,19 @@ class Service(service.Service):
 
     def report_state(self):
         """Update the state of this service in the datastore."""
-        if not self.manager.is_working():
-            # NOTE(dulek): If manager reports a problem we're not sending
-            # heartbeats - to indicate that service is actually down.
-            LOG.error(_LE('Manager for service %(binary)s %(host)s is '
-                          'reporting problems, not sending heartbeat. '
-                          'Service will appear "down".'),
-                      {'binary': self.binary,
-                       'host': self.host})
-            return
-
-        ctxt = context.get_admin_context()
-        zone = CONF.storage_availability_zone
-        try:
-            try:
-                service_ref = objects.Service.get_by_id(ctxt, self.service_id)
-            except exception.NotFound:
-                LOG.debug('The service database object disappeared, '
-                          'recreating it.')
-                self._create_service_ref(ctxt)
-                service_ref = objects.Service.get_by_id(ctxt, self.service_id)
-
-            service_ref.report_count += 1
-            if zone != service_ref.availability_zone:
-                service_ref.availability_zone = zone
-
-            service_ref.save()
-
-            # TODO(termie): make this pattern be more elegant.
-            if getattr(self, 'model_disconnected', False):
-                self.model_disconnected = False
-                LOG.error(_LE('Recovered model server connection!'))
-
-        except db_exc.DBConnectionError:
-            if not getattr(self, 'model_disconnected', False):
-                self.model_disconnected = True
-                LOG.exception(_LE('model server went away'))
-
-        # NOTE(jsbryant) Other DB errors can happen in HA configurations.
-        # such errors shouldn't kill this thread, so we handle them here.
-        except db_exc.DBError:
-            if not getattr(self, 'model_disconnected', False):
-                self.model_disconnected = True
-                LOG.exception(_LE('DBError encountered: '))
-
-        except Exception:
-            if not getattr(self, 'model_disconnected', False):
-                self.model_disconnected = True
-                LOG.exception(_LE('Exception encountered: '))
+        HEARTBEAT.report([self])
+
+    def is_reporting(self):
+        if self.manager.is_working():
+            return True
+        # NOTE(dulek): If manager reports a problem we're not sending
+        # heartbeats - to indicate that service is actually down.
+        LOG.error(_LE('Manager for service %(binary)s %(host)s is '
+                      'reporting problems, not sending heartbeat. '
+                      'Service will appear "down".'),
+                  {'binary': self.binary,
+                   'host': self.host})
+        return False
 
     def reset(self):
         self.manager.reset()
@@ -361,15 +456,19 @@ class Service(service.Service):
 class WSGIService(service.ServiceBase):
     """Provides ability to launch API from a 'paste' configuration."""
 
-    def __init__(self, name, loader=None):
+    def __init__(self, name, loader=None, metrics_port=None):
         """Initialize, but do not start the WSGI server.
 
         :param name: The name of the WSGI server given to the loader.
         :param loader: Loads the WSGI application using the given name.
+        :param metrics_port: First port the workers serve their metrics on,
+                             each takes one.  None to not serve them.
         :returns: None
 
         """
         self.name = name
+        self.metrics_port = metrics_port
+        self.metrics_server = None
         self.manager = self._get_manager()
         self.loader = loader or wsgi.Loader(CONF)
         self.app = self.loader.load_app(name)
@@ -424,8 +523,18 @@ class WSGIService(service.ServiceBase):
         """
         if self.manager:
             self.manager.init_host()
+        # The coordinator gives the workflow RPC client its hash ring, the
+        # API keeps casting to the topic if it can't be started.
+        try:
+            coordination.COORDINATOR.start()
+        except Exception:
+            LOG.warning(_LW('Coordination backend unavailable, workflows '
+                            'will not be partitioned across managers.'))
         self.server.start()
         self.port = self.server.port
+        if self.metrics_port:
+            self.metrics_server = metrics.start_server(self.metrics_port,
+                                                       self.workers or 1)
 
     def stop(self):
         """Stop serving this API.
@@ -434,6 +543,12 @@ class WSGIService(service.ServiceBase):
 
         """
         self.server.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        try:
+            coordination.COORDINATOR.stop()
+        except Exception:
+            pass
 
     def wait(self):
         """Wait for the service to stop serving this API.
@@ -15,9 +15,42 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import fixtures
+from oslo_config import cfg
 from oslotest import base
 
+from waterfall import context
+
 
 class TestCase(base.BaseTestCase):
 
     """Test case base class for all unit tests."""
+
+
+class Database(fixtures.Fixture):
+    """Empty in-memory SQLite database for the DB API."""
+
+    def _setUp(self):
+        # Imported here so the tests not using the database don't load the
+        # DB API
+        from waterfall.db.sqlalchemy import api as sqla_api
+        from waterfall.db.sqlalchemy import models
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'waterfall.db.sqlalchemy.api._FACADE', None))
+        cfg.CONF.set_override('connection', 'sqlite://', group='database')
+        self.addCleanup(cfg.CONF.clear_override, 'connection',
+                        group='database')
+        engine = sqla_api.get_engine()
+        models.BASE.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+
+
+class DBTestCase(TestCase):
+
+    """Test case using an empty database."""
+
+    def setUp(self):
+        super(DBTestCase, self).setUp()
+        self.useFixture(Database())
+        self.context = context.get_admin_context()
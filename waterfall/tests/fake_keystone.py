@@ -0,0 +1,98 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process Keystone v3 stand-in for nested quota tests and benchmarks."""
+
+import fixtures
+from keystoneclient import exceptions
+
+from waterfall import quota_utils
+
+
+class FakeProject(object):
+    def __init__(self, id, parent_id, domain_id='default'):
+        self.id = id
+        self.parent_id = parent_id
+        self.domain_id = domain_id
+        self.subtree = None
+        self.parents = None
+
+
+class FakeProjectManager(object):
+    def __init__(self, keystone):
+        self._keystone = keystone
+
+    def _subtree(self, project_id):
+        children = [p.id for p in self._keystone.projects_by_id.values()
+                    if p.parent_id == project_id]
+        return {child: self._subtree(child) or None for child in children}
+
+    def _parents(self, project_id):
+        # Up to the domain, which is the parent of the root projects
+        project = self._keystone.projects_by_id[project_id]
+        if not project.parent_id:
+            return {project.domain_id: None}
+        return {project.parent_id: self._parents(project.parent_id)}
+
+    def get(self, project_id, subtree_as_ids=False, parents_as_ids=False):
+        self._keystone.calls += 1
+        if project_id not in self._keystone.projects_by_id:
+            raise exceptions.NotFound()
+        project = self._keystone.projects_by_id[project_id]
+        result = FakeProject(project.id,
+                             project.parent_id or project.domain_id,
+                             project.domain_id)
+        if subtree_as_ids:
+            result.subtree = self._subtree(project_id) or None
+        if parents_as_ids:
+            result.parents = self._parents(project_id)
+        return result
+
+    def list(self):
+        self._keystone.calls += 1
+        return list(self._keystone.projects_by_id.values())
+
+
+class FakeKeystoneClient(object):
+    """Keystone v3 client answering from an in-memory project tree.
+
+    :param projects: Dictionary mapping project ids to their parent ids,
+                     None for root projects.
+    """
+    version = 'v3'
+
+    def __init__(self, projects):
+        self.projects_by_id = {
+            project_id: FakeProject(project_id, parent_id)
+            for project_id, parent_id in projects.items()}
+        self.projects = FakeProjectManager(self)
+        self.calls = 0
+
+
+class FakeKeystoneFixture(fixtures.Fixture):
+    """Make quota_utils talk to a FakeKeystoneClient.
+
+    The hierarchy cache is cleared on setup and cleanup so cached entries
+    don't leak between tests.  The number of Keystone requests made is
+    available in `client.calls`.
+    """
+
+    def __init__(self, projects):
+        super(FakeKeystoneFixture, self).__init__()
+        self.client = FakeKeystoneClient(projects)
+
+    def _setUp(self):
+        quota_utils.invalidate_project_hierarchy()
+        self.addCleanup(quota_utils.invalidate_project_hierarchy)
+        self.useFixture(fixtures.MonkeyPatch(
+            'waterfall.quota_utils._keystone_client',
+            lambda context, version=(3, 0): self.client))
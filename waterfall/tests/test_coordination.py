@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_coordination
+----------------------------------
+
+Tests for `waterfall.coordination`.
+"""
+
+import os
+import threading
+import time
+
+import eventlet
+import fixtures
+import mock
+from tooz import coordination as tooz_coordination
+from tooz import locking as tooz_locking
+
+from waterfall import coordination
+from waterfall.tests import base
+
+
+class MockToozLock(tooz_locking.Lock):
+    active_locks = set()
+
+    def __init__(self, name):
+        super(MockToozLock, self).__init__(name)
+        self.acquire_calls = 0
+
+    def acquire(self, blocking=True, *args, **kwargs):
+        self.acquire_calls += 1
+        if self.name not in self.active_locks:
+            self.active_locks.add(self.name)
+            return True
+        if not blocking:
+            return False
+        raise tooz_coordination.LockAcquireFailed('Would block forever')
+
+    def release(self):
+        self.active_locks.remove(self.name)
+        return True
+
+
+class MockCoordinator(object):
+    def __init__(self):
+        self.locks = {}
+
+    def get_lock(self, name):
+        return self.locks.setdefault(name, MockToozLock(name))
+
+
+class CoordinationTestCase(base.TestCase):
+    def setUp(self):
+        super(CoordinationTestCase, self).setUp()
+        MockToozLock.active_locks.clear()
+        self.coordinator = MockCoordinator()
+
+    def test_lock(self):
+        lock = coordination.Lock('lock-{id}', {'id': 'a'}, self.coordinator)
+        self.assertTrue(lock.acquire())
+        self.assertIn('lock-a', MockToozLock.active_locks)
+        lock.release()
+        self.assertEqual(set(), MockToozLock.active_locks)
+
+    def test_local_waiter_does_not_hit_backend(self):
+        first = coordination.Lock('lock', coordinator=self.coordinator)
+        second = coordination.Lock('lock', coordinator=self.coordinator)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire(False))
+        self.assertEqual(1, self.coordinator.locks['lock'].acquire_calls)
+
+        first.release()
+        self.assertTrue(second.acquire(False))
+        second.release()
+
+    def test_local_timeout(self):
+        first = coordination.Lock('lock', coordinator=self.coordinator)
+        second = coordination.Lock('lock', coordinator=self.coordinator)
+        first.acquire()
+        self.assertFalse(second.acquire(0.01))
+        first.release()
+
+    def test_local_timeout_acquired_when_released(self):
+        first = coordination.Lock('lock', coordinator=self.coordinator)
+        second = coordination.Lock('lock', coordinator=self.coordinator)
+        first.acquire()
+        eventlet.spawn_after(0.02, first.release)
+        with mock.patch.object(second.local_lock, 'acquire',
+                               wraps=second.local_lock.acquire) as acquire:
+            self.assertTrue(second.acquire(5))
+        # Never blocks in the semaphore, python 2.7 has no timeout there
+        self.assertTrue(all(call == mock.call(False)
+                            for call in acquire.call_args_list))
+        second.release()
+
+    def test_backend_failure_releases_local_lock(self):
+        lock = coordination.Lock('lock', coordinator=self.coordinator)
+        backend = self.coordinator.locks['lock']
+        with mock.patch.object(backend, 'acquire',
+                               side_effect=tooz_coordination.ToozError('x')):
+            self.assertRaises(tooz_coordination.ToozError, lock.acquire)
+        self.assertTrue(lock.acquire(False))
+        lock.release()
+
+    def test_synchronized(self):
+        calls = []
+
+        @coordination.synchronized('lock-{f_name}-{arg}',
+                                   coordinator=self.coordinator)
+        def func(arg):
+            calls.append(MockToozLock.active_locks.copy())
+
+        threads = [threading.Thread(target=func, args=(1,))
+                   for _i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([{'lock-func-1'}] * 5, calls)
+        self.assertEqual(set(), MockToozLock.active_locks)
+
+    def test_synchronized_not_acquired(self):
+        @coordination.synchronized('lock', blocking=False,
+                                   coordinator=self.coordinator)
+        def func():
+            pass
+
+        self.coordinator.get_lock('lock').acquire()
+        self.assertRaises(tooz_coordination.LockAcquireFailed, func)
+
+    def test_lock_stats(self):
+        stats = coordination.LockStats()
+        self.useFixture(fixtures.MockPatchObject(coordination, 'LOCK_STATS',
+                                                 stats))
+        lock = coordination.Lock('lock-{id}', {'id': 'a'}, self.coordinator)
+        other = coordination.Lock('lock-{id}', {'id': 'a'}, self.coordinator)
+        lock.acquire()
+        self.assertFalse(other.acquire(False))
+
+        report = stats.report()
+        self.assertEqual(['lock-a'],
+                         [holder['name'] for holder in report['holders']])
+        lock.release()
+
+        report = stats.report()['locks']['lock-{id}']
+        self.assertEqual(1, report['acquired'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(0, report['held'])
+        self.assertEqual([], stats.report()['holders'])
+
+    @mock.patch.object(coordination.LOG, 'warning')
+    def test_hold_warning(self, mock_warning):
+        coordination.CONF.set_override('lock_hold_warning_threshold',
+                                       0.000001, group='coordination')
+        self.addCleanup(coordination.CONF.clear_override,
+                        'lock_hold_warning_threshold', group='coordination')
+        lock = coordination.Lock('lock', coordinator=self.coordinator)
+        lock.acquire()
+        time.sleep(0.01)
+        lock.release()
+        self.assertTrue(mock_warning.called)
+
+    def test_lease_lock_renewed(self):
+        lock = coordination.LeaseLock('lock', coordinator=self.coordinator,
+                                      renew_interval=0.01)
+        backend = self.coordinator.locks['lock']
+        with mock.patch.object(backend, 'is_still_owner',
+                               create=True, return_value=True) as owner:
+            self.assertTrue(lock.acquire())
+            eventlet.sleep(0.05)
+            lock.release()
+            calls = owner.call_count
+            eventlet.sleep(0.03)
+        self.assertGreater(calls, 1)
+        self.assertEqual(calls, owner.call_count)
+        self.assertFalse(lock.lost)
+
+    def test_lease_lock_lost(self):
+        lost = []
+        lock = coordination.LeaseLock('lock', coordinator=self.coordinator,
+                                      on_lost=[lost.append],
+                                      renew_interval=0.01)
+        backend = self.coordinator.locks['lock']
+        with mock.patch.object(backend, 'is_still_owner',
+                               create=True, return_value=False):
+            lock.acquire()
+            eventlet.sleep(0.05)
+        self.assertTrue(lock.lost)
+        self.assertEqual([lock], lost)
+        lock.release()
+
+
+class CoordinatorForkTestCase(base.TestCase):
+    def _agent_id_in_child(self, coordinator):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(read_fd)
+                with mock.patch.object(coordinator, '_start'):
+                    coordinator.start()
+                os.write(write_fd, coordinator.agent_id.encode())
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            agent_id = pipe.read()
+        os.waitpid(pid, 0)
+        return agent_id
+
+    def test_forked_workers_agent_ids(self):
+        coordinator = coordination.Coordinator(prefix='waterfall-')
+        agent_ids = {coordinator.agent_id,
+                     self._agent_id_in_child(coordinator),
+                     self._agent_id_in_child(coordinator)}
+        self.assertEqual(3, len(agent_ids))
+
+        with mock.patch.object(coordinator, '_start'):
+            coordinator.start()
+        self.addCleanup(setattr, coordinator, 'started', False)
+        self.assertIn(coordinator.agent_id, agent_ids)
+
+    def test_given_agent_id_kept(self):
+        coordinator = coordination.Coordinator(agent_id='agent')
+        self.assertEqual('agent', self._agent_id_in_child(coordinator))
+
+
+class LeaderElectionTestCase(base.TestCase):
+    def setUp(self):
+        super(LeaderElectionTestCase, self).setUp()
+        backend_url = 'file://%s' % self.useFixture(fixtures.TempDir()).path
+        coordination.CONF.set_override('backend_url', backend_url,
+                                       group='coordination')
+        self.addCleanup(coordination.CONF.clear_override, 'backend_url',
+                        group='coordination')
+
+    def _member(self, host=None):
+        member = coordination.Coordinator(prefix='waterfall-')
+        member.join_group('group', capabilities={'host': host})
+        # Elections are run by hand instead of by the heartbeat thread
+        with mock.patch.object(coordination.eventlet, 'spawn'):
+            member.start()
+        member._ev = None
+        self.addCleanup(member.stop)
+        return member
+
+    def test_single_leader_and_failover(self):
+        first = self._member()
+        second = self._member()
+        first._run_elections()
+        second._run_elections()
+        self.assertTrue(first.is_leader('group'))
+        self.assertFalse(second.is_leader('group'))
+
+        first.stop()
+        second._run_elections()
+        self.assertTrue(second.is_leader('group'))
+        report = second.leadership_report()['groups']['group']
+        self.assertTrue(report['leader'])
+        self.assertEqual(1, report['elections'])
+
+    def test_leader_only(self):
+        member = self._member()
+        calls = []
+
+        @coordination.leader_only('group', coordinator=member)
+        def task():
+            calls.append(True)
+
+        task()
+        self.assertEqual([], calls)
+        member._run_elections()
+        task()
+        self.assertEqual([True], calls)
+
+    def test_hash_ring(self):
+        first = self._member('host1')
+        self.assertEqual({'host1'}, first.get_hash_ring('group').nodes)
+
+        second = self._member('host2')
+        coordination.CONF.set_override('heartbeat', 0, group='coordination')
+        self.addCleanup(coordination.CONF.clear_override, 'heartbeat',
+                        group='coordination')
+        ring = second.get_hash_ring('group')
+        self.assertEqual({'host1', 'host2'}, ring.nodes)
+        self.assertEqual({'group': ['host1', 'host2']},
+                         second.leadership_report()['hash_rings'])
+
+
+class HashRingTestCase(base.TestCase):
+    def test_minimal_rebalance(self):
+        keys = ['project-%d' % i for i in range(1000)]
+        ring = coordination.HashRing(['host1', 'host2', 'host3'])
+        before = {key: ring.get_node(key) for key in keys}
+        self.assertEqual({'host1', 'host2', 'host3'}, set(before.values()))
+
+        ring = coordination.HashRing(['host1', 'host2', 'host3', 'host4'])
+        moved = [key for key in keys if ring.get_node(key) != before[key]]
+        self.assertTrue(all(ring.get_node(key) == 'host4' for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+    def test_empty(self):
+        self.assertIsNone(coordination.HashRing([]).get_node('key'))
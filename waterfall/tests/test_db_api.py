@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_db_api
+----------------------------------
+
+Tests for `waterfall.db.sqlalchemy.api`.
+"""
+
+import datetime
+
+import mock
+from oslo_utils import timeutils
+from oslo_versionedobjects import fields
+from sqlalchemy.dialects import postgresql
+
+from waterfall import db
+from waterfall.db.sqlalchemy import api as sqla_api
+from waterfall.db.sqlalchemy import models
+from waterfall import exception
+from waterfall.objects import base as objects_base
+from waterfall.tests import base
+
+
+@objects_base.WaterfallObjectRegistry.register_if(False)
+class FakeWorkflow(objects_base.WaterfallObject,
+                   objects_base.WaterfallObjectDictCompat):
+    model = models.Workflow
+    fields = {
+        'id': fields.IntegerField(),
+        'status': fields.StringField(nullable=True),
+        'resource_type': fields.StringField(nullable=True),
+    }
+
+
+class ConditionalUpdateTestCase(base.DBTestCase):
+    def setUp(self):
+        super(ConditionalUpdateTestCase, self).setUp()
+        self.workflow = sqla_api.workflow_create(self.context, 'volume', '{}')
+        self.obj = FakeWorkflow(self.context, id=self.workflow.id,
+                                status='pending', resource_type='volume')
+        self.obj.obj_reset_changes()
+
+    def _set_status(self, status):
+        db.conditional_update(self.context, models.Workflow,
+                              {'status': status}, {'id': self.workflow.id})
+
+    def test_get_fields_by_id(self):
+        self.assertEqual({'status': 'pending'},
+                         db.get_fields_by_id(self.context, models.Workflow,
+                                             self.workflow.id, ['status']))
+        self.assertRaises(exception.NotFound, db.get_fields_by_id,
+                          self.context, models.Workflow, -1, ['status'])
+
+    def test_refresh_fields(self):
+        self._set_status('running')
+        db.conditional_update(self.context, models.Workflow,
+                              {'resource_type': 'backup'},
+                              {'id': self.workflow.id})
+
+        self.obj.refresh(['status'])
+        self.assertEqual('running', self.obj.status)
+        self.assertEqual('volume', self.obj.resource_type)
+        self.assertEqual(set(), self.obj.obj_what_changed())
+        self.assertRaises(ValueError, self.obj.refresh, ['size'])
+
+    def test_update_returning_supported(self):
+        # SQLite is only given RETURNING by the newest SQLAlchemy releases
+        dialect = sqla_api.get_engine().dialect
+        self.assertEqual(getattr(dialect, 'update_returning', False),
+                         sqla_api.update_returning_supported())
+
+        with mock.patch.object(sqla_api, 'get_engine') as get_engine:
+            get_engine.return_value.dialect = postgresql.dialect()
+            self.assertTrue(sqla_api.update_returning_supported())
+
+    @mock.patch.object(db, 'update_returning_supported', return_value=False)
+    def test_conditional_update_reads_back(self, mock_supported):
+        case = db.Case([(models.Workflow.status == 'pending', 'running')],
+                       else_='error')
+        self.assertTrue(self.obj.conditional_update({'status': case},
+                                                    {'status': 'pending'}))
+        self.assertEqual('running', self.obj.status)
+        self.assertEqual(set(), self.obj.obj_what_changed())
+
+        self.assertFalse(self.obj.conditional_update({'status': case},
+                                                     {'status': 'pending'}))
+        self.assertEqual('running', self.obj.status)
+
+    @mock.patch.object(db, 'get_fields_by_id')
+    @mock.patch.object(db, 'conditional_update_returning',
+                       return_value=[{'status': 'running'}])
+    @mock.patch.object(db, 'update_returning_supported', return_value=True)
+    def test_conditional_update_returning(self, mock_supported,
+                                          mock_returning, mock_get_fields):
+        case = db.Case([(models.Workflow.status == 'pending', 'running')],
+                       else_='error')
+        self.assertTrue(self.obj.conditional_update(
+            {'status': case, 'resource_type': 'backup'},
+            {'status': 'pending'}))
+
+        self.assertEqual(['status'], mock_returning.call_args[0][4])
+        self.assertFalse(mock_get_fields.called)
+        self.assertEqual('running', self.obj.status)
+        self.assertEqual('backup', self.obj.resource_type)
+        self.assertEqual(set(), self.obj.obj_what_changed())
+
+    def test_condition_db_filter(self):
+        self._set_status(None)
+        self.assertTrue(db.conditional_update(
+            self.context, models.Workflow, {'status': 'pending'},
+            {'status': db.Not(['running', 'error'])}))
+        self.assertFalse(db.conditional_update(
+            self.context, models.Workflow, {'status': 'error'},
+            {'status': ('running', None)}))
+        self.assertTrue(db.conditional_update(
+            self.context, models.Workflow, {'status': 'error'},
+            {'status': ['pending', None]}))
+
+
+class WorkflowStatusTestCase(base.DBTestCase):
+    def setUp(self):
+        super(WorkflowStatusTestCase, self).setUp()
+        self.workflow = sqla_api.workflow_create(self.context, 'volume', '{}')
+
+    def _workflow(self):
+        return db.workflow_get(self.context, self.workflow.id)
+
+    def test_workflow_update_status(self):
+        self.assertTrue(db.workflow_update_status(
+            self.context, self.workflow.id, 'applying', expected='pending'))
+        workflow = self._workflow()
+        self.assertEqual('applying', workflow.status)
+        self.assertIsNotNone(workflow.updated_at)
+
+        self.assertFalse(db.workflow_update_status(
+            self.context, self.workflow.id, 'applied', expected='pending'))
+        self.assertTrue(db.workflow_update_status(
+            self.context, self.workflow.id, 'applied',
+            expected=['pending', 'applying']))
+        self.assertTrue(db.workflow_update_status(
+            self.context, self.workflow.id, 'error'))
+        self.assertEqual('error', self._workflow().status)
+        self.assertFalse(db.workflow_update_status(self.context, -1, 'error'))
+
+    def test_workflow_get_all_stale(self):
+        self.addCleanup(timeutils.clear_time_override)
+        timeutils.set_time_override()
+        applying = sqla_api.workflow_create(self.context, 'volume', '{}')
+        db.workflow_update_status(self.context, applying.id, 'applying')
+        before = timeutils.utcnow() + datetime.timedelta(seconds=1)
+        timeutils.advance_time_delta(datetime.timedelta(seconds=2))
+        sqla_api.workflow_create(self.context, 'volume', '{}')
+
+        stale = db.workflow_get_all_stale(self.context,
+                                          ['pending', 'applying'], before)
+        self.assertEqual([self.workflow.id, applying.id],
+                         [workflow.id for workflow in stale])
+        stale = db.workflow_get_all_stale(self.context, ['applying'], before)
+        self.assertEqual([applying.id], [workflow.id for workflow in stale])
+
+
+class DisposeEngineTestCase(base.DBTestCase):
+    def test_dispose_engine(self):
+        engine = sqla_api.get_engine()
+        pool = engine.pool
+        with mock.patch.object(engine.dialect, 'name', 'mysql'):
+            db.dispose_engine()
+        # Connections inherited from the parent process aren't reused
+        self.assertIsNot(pool, engine.pool)
+
+    def test_dispose_engine_sqlite(self):
+        # An in-memory database would be lost with its connection
+        workflow = sqla_api.workflow_create(self.context, 'volume', '{}')
+        pool = sqla_api.get_engine().pool
+        db.dispose_engine()
+        self.assertIs(pool, sqla_api.get_engine().pool)
+        self.assertEqual({'status': 'pending'},
+                         db.get_fields_by_id(self.context, models.Workflow,
+                                             workflow.id, ['status']))
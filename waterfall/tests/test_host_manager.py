@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_host_manager
+----------------------------------
+
+Tests for `waterfall.scheduler.host_manager`.
+"""
+
+import mock
+
+from waterfall.scheduler import host_manager
+from waterfall.tests import base
+
+
+class HostManagerTestCase(base.TestCase):
+    def setUp(self):
+        super(HostManagerTestCase, self).setUp()
+        self.host_manager = host_manager.HostManager()
+
+    def _capabilities(self, host='host1'):
+        states = self.host_manager.get_all_host_states('workflow')
+        return {state.host: state.capabilities for state in states}[host]
+
+    def test_merge_deltas(self):
+        update = self.host_manager.update_service_capabilities
+        update('workflow', 'host1', {'a': 1, 'b': 2}, 1)
+        update('workflow', 'host1', {'b': 3}, 2, full_sync=False)
+        update('workflow', 'host1', {'c': 4}, 3, full_sync=False,
+               removed=['a'])
+        self.assertEqual({'b': 3, 'c': 4}, self._capabilities())
+        self.assertEqual(1, self.host_manager.report()['full_syncs'])
+        self.assertEqual(2, self.host_manager.report()['deltas'])
+
+    def test_missed_delta_waits_for_full_sync(self):
+        update = self.host_manager.update_service_capabilities
+        update('workflow', 'host1', {'a': 1}, 7, full_sync=False)
+        self.assertEqual([], self.host_manager.get_all_host_states())
+
+        update('workflow', 'host1', {'a': 1}, 1)
+        update('workflow', 'host1', {'a': 3}, 3, full_sync=False)
+        update('workflow', 'host1', {'a': 4}, 4, full_sync=False)
+        self.assertEqual({'a': 1}, self._capabilities())
+
+        update('workflow', 'host1', {'a': 5}, 5)
+        self.assertEqual({'a': 5}, self._capabilities())
+        self.assertEqual(3, self.host_manager.report()['ignored'])
+
+    @mock.patch('time.time')
+    def test_expire(self, mock_time):
+        host_manager.CONF.set_override('host_state_max_age', 60)
+        self.addCleanup(host_manager.CONF.clear_override,
+                        'host_state_max_age')
+        mock_time.return_value = 1000
+        self.host_manager.update_service_capabilities('workflow', 'host1',
+                                                      {}, 1)
+        mock_time.return_value = 1061
+        self.assertEqual([], self.host_manager.get_all_host_states())
+        self.assertEqual(1, self.host_manager.report()['expired'])
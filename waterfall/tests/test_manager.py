@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_manager
+----------------------------------
+
+Tests for `waterfall.manager`.
+"""
+
+import fixtures
+import mock
+
+from waterfall.common import config  # noqa
+from waterfall import manager
+from waterfall import rpc
+from waterfall.tests import base
+
+
+class PublishCapabilitiesTestCase(base.DBTestCase):
+    def setUp(self):
+        super(PublishCapabilitiesTestCase, self).setUp()
+        # Nothing is sent, the RPC clients only need a transport
+        self.useFixture(fixtures.MockPatchObject(rpc, 'TRANSPORT'))
+        self.manager = manager.SchedulerDependentManager(
+            host='host', service_name='workflow')
+        self.manager.scheduler_rpcapi = mock.Mock()
+        self.update = self.manager.scheduler_rpcapi.update_service_capabilities
+
+    def _publish(self):
+        self.update.reset_mock()
+        self.manager._publish_service_capabilities(self.context)
+        if not self.update.called:
+            return None
+        return self.update.call_args[0][3]
+
+    def test_publish_load_alone(self):
+        self.assertEqual({'thread_pool': self.manager._tp.load()},
+                         self._publish())
+        self.assertTrue(self.update.call_args[1]['full_sync'])
+
+    def test_publish_deltas(self):
+        self.manager.update_service_capabilities({'a': 1, 'b': 2})
+        self.assertEqual(
+            {'a': 1, 'b': 2, 'thread_pool': self.manager._tp.load()},
+            self._publish())
+        self.assertTrue(self.update.call_args[1]['full_sync'])
+
+        # The load of the thread pool alone doesn't make an update
+        self.manager._tp.stats['active'] = 3
+        self.assertIsNone(self._publish())
+
+        self.manager.update_service_capabilities({'a': 1, 'b': 3})
+        capabilities = self._publish()
+        self.assertFalse(self.update.call_args[1]['full_sync'])
+        self.assertEqual(['b', 'thread_pool'], sorted(capabilities))
+        self.assertEqual(3, capabilities['thread_pool']['active'])
+
+    def test_publish_load_buckets(self):
+        self.manager.update_service_capabilities({'a': 1})
+        self._publish()
+        tp = self.manager._tp
+
+        # Within the first quarter of the queue, no update
+        self.useFixture(fixtures.MockPatchObject(tp, 'queued'))
+        tp.queued.return_value = tp.queue_size // 4 - 1
+        self.assertIsNone(self._publish())
+
+        # Half full, the load alone is sent
+        tp.queued.return_value = tp.queue_size // 2
+        capabilities = self._publish()
+        self.assertFalse(self.update.call_args[1]['full_sync'])
+        self.assertEqual({'thread_pool': tp.load()}, capabilities)
+        self.assertIsNone(self._publish())
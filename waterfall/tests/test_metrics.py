@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `waterfall.common.metrics`.
+"""
+
+import socket
+
+from waterfall.common import metrics
+from waterfall.tests import base
+
+
+class TimingsTestCase(base.TestCase):
+    def test_percentiles(self):
+        metrics.CONF.set_override('metrics_samples', 100)
+        self.addCleanup(metrics.CONF.clear_override, 'metrics_samples')
+        timings = metrics.Timings()
+        for duration in range(200):
+            timings.record('op', duration)
+        timings.record('cast')
+
+        report = timings.report()
+        self.assertEqual({'count': 1, 'errors': 0}, report['cast'])
+        self.assertEqual(200, report['op']['count'])
+        self.assertEqual(99.5, report['op']['avg'])
+        self.assertEqual(199, report['op']['max'])
+        # Over the last 100 durations only
+        self.assertEqual(150, report['op']['p50'])
+        self.assertEqual(199, report['op']['p99'])
+
+    def test_time_error(self):
+        timings = metrics.timings('test.timings')
+        self.addCleanup(metrics._SOURCES.pop, 'test.timings')
+
+        def fail():
+            with timings.time('op'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        report = metrics.collect()['test.timings']['op']
+        self.assertEqual(1, report['count'])
+        self.assertEqual(1, report['errors'])
+
+
+class StartServerTestCase(base.TestCase):
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def _start(self, port, count):
+        server = metrics.start_server(port, count)
+        if server is not None:
+            self.addCleanup(server.stop)
+        return server
+
+    def test_port_per_process(self):
+        port = self._free_port()
+        # Each worker process takes the next free port
+        self.assertEqual(port, self._start(port, 2).port)
+        self.assertEqual(port + 1, self._start(port, 2).port)
+        self.assertIsNone(self._start(port, 2))
+
+    def test_disabled(self):
+        self.assertIsNone(metrics.start_server())
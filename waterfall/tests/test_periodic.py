@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_periodic
+----------------------------------
+
+Tests for `waterfall.common.periodic`.
+"""
+
+import eventlet
+from oslo_config import cfg
+from oslo_service import periodic_task
+
+from waterfall.common import periodic
+from waterfall.tests import base
+
+
+class FakeManager(periodic_task.PeriodicTasks):
+    def __init__(self):
+        super(FakeManager, self).__init__(cfg.CONF)
+        self.fast_runs = 0
+        self.slow_runs = 0
+
+    @periodic_task.periodic_task(spacing=0.01, run_immediately=True)
+    def fast(self, context):
+        self.fast_runs += 1
+
+    @periodic_task.periodic_task(spacing=0.01, run_immediately=True)
+    def slow(self, context):
+        self.slow_runs += 1
+        eventlet.sleep(0.1)
+
+    @periodic_task.periodic_task(spacing=0.01, run_immediately=True)
+    def broken(self, context):
+        raise ValueError()
+
+
+class PeriodicSchedulerTestCase(base.TestCase):
+    def test_tasks_run_independently(self):
+        manager = FakeManager()
+        scheduler = periodic.PeriodicScheduler(manager, lambda: None)
+        scheduler.start()
+        eventlet.sleep(0.15)
+        for timer in scheduler.timers:
+            timer.stop()
+
+        stats = scheduler.report()
+        self.assertGreater(manager.fast_runs, 3)
+        self.assertIn(manager.slow_runs, (1, 2))
+        self.assertGreater(stats['slow']['overruns'], 3)
+        self.assertGreaterEqual(stats['slow']['max_duration'], 0.1)
+        self.assertEqual(stats['broken']['runs'], stats['broken']['failures'])
+        self.assertEqual(0, stats['fast']['overruns'])
@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_quota
+----------------------------------
+
+Tests for `waterfall.quota`.
+"""
+
+import datetime
+import uuid
+
+import fixtures
+import mock
+from oslo_db import exception as db_exc
+from oslo_utils import timeutils
+
+from waterfall import context
+from waterfall import coordination
+from waterfall import db
+from waterfall.db.sqlalchemy import api as sqla_api
+from waterfall.db.sqlalchemy import models
+from waterfall import exception
+from waterfall import quota
+from waterfall.tests import base
+
+
+class QuotaTestCase(base.DBTestCase):
+    driver = 'waterfall.quota.DbQuotaDriver'
+
+    def setUp(self):
+        super(QuotaTestCase, self).setUp()
+        self.project_id = 'fake_project'
+        for name, value in (('quota_workflows', 3), ('until_refresh', 0)):
+            quota.CONF.set_override(name, value)
+            self.addCleanup(quota.CONF.clear_override, name)
+
+    def _engine(self):
+        engine = quota.QuotaEngine(quota_driver_class=self.driver)
+        engine.register_resource(quota.ReservableResource(
+            'workflows', '_sync_workflows', 'quota_workflows'))
+        return engine
+
+    def _reserve(self, engine, delta, project_id=None):
+        # Every reservation is made for a request of its own
+        return engine.reserve(self.context.elevated(),
+                              project_id=project_id or self.project_id,
+                              workflows=delta)
+
+    def _usage(self, project_id=None):
+        usages = db.quota_usage_get_all_by_project(
+            self.context, project_id or self.project_id)
+        return usages['workflows']
+
+
+class CachedDbQuotaDriverTestCase(QuotaTestCase):
+    driver = 'waterfall.quota.CachedDbQuotaDriver'
+
+    def setUp(self):
+        super(CachedDbQuotaDriverTestCase, self).setUp()
+        for name, value in (('quota_workflows', 20),
+                            ('quota_cache_block_reservations', 5)):
+            quota.CONF.set_override(name, value)
+            self.addCleanup(quota.CONF.clear_override, name)
+        backend_url = 'file://%s' % self.useFixture(fixtures.TempDir()).path
+        coordination.CONF.set_override('backend_url', backend_url,
+                                       group='coordination')
+        self.addCleanup(coordination.CONF.clear_override, 'backend_url',
+                        group='coordination')
+        coordinator = coordination.Coordinator(prefix='waterfall-')
+        with mock.patch.object(coordination.eventlet, 'spawn'):
+            coordinator.start()
+        self.addCleanup(coordinator.stop)
+        self.useFixture(fixtures.MockPatchObject(coordination, 'COORDINATOR',
+                                                 coordinator))
+        self.useFixture(fixtures.MockPatchObject(
+            quota.loopingcall, 'FixedIntervalLoopingCall'))
+
+        # Two engines stand for two API or workflow processes, the first
+        # one to reserve for the project holds its lease
+        self.engine1 = self._engine()
+        self.engine2 = self._engine()
+        self.addCleanup(self._release, self.engine2)
+        self.addCleanup(self._release, self.engine1)
+
+    def _release(self, engine):
+        engine._driver.release(self.context)
+        # Leases of projects with reservations left pending are not given
+        # back, the process would keep them until it stops
+        for cache in engine._driver._projects.values():
+            cache.lease.release()
+
+    def _sync(self, engine):
+        engine._driver.sync_usages(self.context)
+
+    def test_block_reserved(self):
+        self._reserve(self.engine1, 2)
+        # The block is reserved, the other process sees it
+        self.assertEqual({'in_use': 0, 'reserved': 10}, self._usage())
+        self.assertRaises(exception.OverQuota, self._reserve, self.engine2,
+                          11)
+        self._reserve(self.engine2, 10)
+
+        # Taken out of the block without reserving again
+        for _i in range(4):
+            self._reserve(self.engine1, 2)
+        self.assertEqual({'in_use': 0, 'reserved': 20}, self._usage())
+        self.assertRaises(exception.OverQuota, self._reserve, self.engine1, 1)
+
+    def test_settled_at_flush(self):
+        committed = self._reserve(self.engine1, 2)
+        rolled_back = self._reserve(self.engine1, 3)
+        pending = self._reserve(self.engine1, 1)
+
+        # Settled by another process without touching the usage
+        self.engine2.commit(self.context, committed,
+                            project_id=self.project_id)
+        self.engine2.rollback(self.context, rolled_back,
+                              project_id=self.project_id)
+        self.assertEqual({'in_use': 0, 'reserved': 10}, self._usage())
+
+        self._sync(self.engine1)
+        self.assertEqual({'in_use': 2, 'reserved': 8}, self._usage())
+        # The project was used, its blocks are kept
+        self.assertTrue(self.engine1._driver._projects)
+
+        self.engine1.commit(self.context, pending,
+                            project_id=self.project_id)
+        # Not used since the last flush, the blocks are given back
+        self._sync(self.engine1)
+        self.assertEqual({'in_use': 3, 'reserved': 0}, self._usage())
+        self.assertFalse(self.engine1._driver._projects)
+
+        # And the other process can take the lease
+        self._reserve(self.engine2, 1)
+        self.assertIn(self.project_id, self.engine2._driver._projects)
+
+    def test_release_after_settled(self):
+        reservations = self._reserve(self.engine1, 2)
+        self._release(self.engine1)
+        # The blocks are given back once their reservations are settled
+        self.assertEqual({'in_use': 0, 'reserved': 2}, self._usage())
+        self.assertTrue(self.engine1._driver._projects)
+        self._reserve(self.engine1, 1)
+        self.assertEqual({'in_use': 0, 'reserved': 3}, self._usage())
+
+        self.engine1.commit(self.context, reservations,
+                            project_id=self.project_id)
+        self._release(self.engine1)
+        self.assertEqual({'in_use': 2, 'reserved': 1}, self._usage())
+        self.assertFalse(self.engine1._driver._projects)
+
+    def test_orphans_folded(self):
+        reservations = self._reserve(self.engine1, 2)
+        self.engine2.commit(self.context, reservations,
+                            project_id=self.project_id)
+        # The lease holder dies and its block expires
+        cache = self.engine1._driver._projects.pop(self.project_id)
+        cache.lease.release()
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        timeutils.advance_time_seconds(3600)
+        self.engine2.expire(self.context)
+        self.assertEqual({'in_use': 0, 'reserved': 0}, self._usage())
+
+        # The commit is applied by the next holder
+        self._reserve(self.engine2, 1)
+        self._sync(self.engine2)
+        self.assertEqual({'in_use': 2, 'reserved': 5}, self._usage())
+
+    def test_near_limit(self):
+        reservations = self._reserve(self.engine1, 2)
+        for _i in range(2):
+            self._reserve(self.engine1, 4)
+        self._reserve(self.engine2, 8)
+        # No room for another block, the DB takes over
+        self._reserve(self.engine1, 2)
+        self.assertEqual({'in_use': 0, 'reserved': 20}, self._usage())
+
+        # The unused part of the block is given back
+        self.engine1.rollback(self.context, reservations,
+                              project_id=self.project_id)
+        self.assertRaises(exception.OverQuota, self._reserve, self.engine2, 1)
+        self._sync(self.engine1)
+        self.assertEqual({'in_use': 0, 'reserved': 18}, self._usage())
+        self._reserve(self.engine2, 2)
+
+    def test_recount(self):
+        quota.CONF.set_override('until_refresh', 2)
+        reservations = self._reserve(self.engine1, 1)
+        self.engine1.commit(self.context, reservations,
+                            project_id=self.project_id)
+        self._reserve(self.engine1, 1)
+        # Workflows created without going through the quotas
+        project_context = context.RequestContext('fake_user', self.project_id,
+                                                 is_admin=True)
+        for _i in range(3):
+            db.workflow_create(project_context, 'volume', '{}')
+
+        self._sync(self.engine1)
+        self.assertEqual({'in_use': 3, 'reserved': 4}, self._usage())
+
+    def test_lease_lost(self):
+        self._reserve(self.engine1, 1)
+        cache = self.engine1._driver._projects[self.project_id]
+        self.engine1._driver._lease_lost(cache)
+
+        self._reserve(self.engine1, 1)
+        self.assertEqual({'in_use': 0, 'reserved': 6}, self._usage())
+        self.assertEqual(1, len(cache.granted))
+
+
+class QuotaLimitsTestCase(QuotaTestCase):
+    def setUp(self):
+        super(QuotaLimitsTestCase, self).setUp()
+        db.quota_create(self.context, self.project_id, 'workflows', 5)
+        db.quota_create(self.context, 'other_project', 'snapshots', 9)
+        for class_name, resource, limit in (('gold', 'workflows', 6),
+                                            ('gold', 'snapshots', 7),
+                                            ('default', 'snapshots', 8),
+                                            ('default', 'gigabytes', 100)):
+            db.quota_class_create(self.context, class_name, resource, limit)
+
+    def test_quota_limits_get(self):
+        self.assertEqual({'project': {'workflows': 5},
+                          'class': {'workflows': 6, 'snapshots': 7},
+                          'default': {'snapshots': 8, 'gigabytes': 100}},
+                         db.quota_limits_get(self.context, self.project_id,
+                                             quota_class='gold'))
+        self.assertEqual({'project': {}, 'class': {},
+                          'default': {'snapshots': 8}},
+                         db.quota_limits_get(self.context, self.project_id,
+                                             resources=['snapshots']))
+        self.assertEqual({'project': {'workflows': 5},
+                          'class': {'snapshots': 8, 'gigabytes': 100},
+                          'default': {}},
+                         db.quota_limits_get(self.context, self.project_id,
+                                             quota_class='default',
+                                             defaults=False))
+
+    def test_memo_missing_resources(self):
+        engine = self._engine()
+        for name in ('snapshots', 'gigabytes'):
+            engine.register_resource(quota.AbsoluteResource(
+                name, 'quota_%s' % name))
+        engine.limit_check(self.context, project_id=self.project_id,
+                           snapshots=8)
+        memo = engine._limits_memo[self.context][self.project_id][1]
+        self.assertEqual({'snapshots': 8}, memo)
+
+        # Resources missing from the memo are looked up when first checked
+        self.assertRaises(exception.OverQuota, engine.limit_check,
+                          self.context, project_id=self.project_id,
+                          gigabytes=101)
+        engine.reserve(self.context, project_id=self.project_id, workflows=5)
+        self.assertRaises(exception.OverQuota, engine.reserve, self.context,
+                          project_id=self.project_id, workflows=1)
+        self.assertEqual({'snapshots': 8, 'gigabytes': 100, 'workflows': 5},
+                         memo)
+
+    def test_memo_invalidated(self):
+        engine = self._engine()
+        engine.reserve(self.context, project_id=self.project_id, workflows=5)
+        db.quota_update(self.context, self.project_id, 'workflows', 6)
+        self.assertRaises(exception.OverQuota, engine.reserve, self.context,
+                          project_id=self.project_id, workflows=1)
+
+        engine.invalidate_limits(self.context, self.project_id)
+        engine.reserve(self.context, project_id=self.project_id, workflows=1)
+
+        db.quota_update(self.context, self.project_id, 'workflows', 7)
+        engine.invalidate_limits()
+        engine.reserve(self.context, project_id=self.project_id, workflows=1)
+        self.assertEqual({'in_use': 0, 'reserved': 7}, self._usage())
+
+    def test_memo_lifetime(self):
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        engine = self._engine()
+        engine.reserve(self.context, project_id=self.project_id, workflows=5)
+        db.quota_update(self.context, self.project_id, 'workflows', 6)
+
+        # A context kept longer than a request sees the change
+        timeutils.advance_time_seconds(quota.LIMITS_MEMO_LIFETIME + 1)
+        engine.reserve(self.context, project_id=self.project_id, workflows=1)
+        self.assertEqual({'in_use': 0, 'reserved': 6}, self._usage())
+
+
+class WorkflowTypeQuotaEngineTestCase(QuotaTestCase):
+    def setUp(self):
+        super(WorkflowTypeQuotaEngineTestCase, self).setUp()
+        quota.CONF.set_override('quota_resources_cache_ttl', 60)
+        self.addCleanup(quota.CONF.clear_override,
+                        'quota_resources_cache_ttl')
+        self.addCleanup(timeutils.clear_time_override)
+        self.engine = quota.WorkflowTypeQuotaEngine()
+        self.load = self.useFixture(fixtures.MockPatchObject(
+            self.engine, '_load_resources')).mock
+        self.load.side_effect = lambda: {'workflows': mock.sentinel.res}
+
+    def test_resources_cached(self):
+        timeutils.set_time_override()
+        self.assertEqual({'workflows': mock.sentinel.res},
+                         self.engine.resources)
+        self.assertIn('workflows', self.engine)
+        self.assertEqual(1, self.load.call_count)
+
+        timeutils.advance_time_delta(datetime.timedelta(seconds=61))
+        self.engine.resources
+        self.assertEqual(2, self.load.call_count)
+
+    def test_resources_not_cached(self):
+        quota.CONF.set_override('quota_resources_cache_ttl', 0)
+        self.engine.resources
+        self.engine.resources
+        self.assertEqual(2, self.load.call_count)
+
+    def test_invalidate_resources(self):
+        self.engine.resources
+        self.engine.invalidate_resources()
+        self.engine.resources
+        self.assertEqual(2, self.load.call_count)
+
+    def test_invalidated_while_loading(self):
+        def load():
+            # A workflow type is created while the resources are loaded
+            self.engine.invalidate_resources()
+            return {}
+
+        self.load.side_effect = load
+        self.engine.resources
+        self.engine.resources
+        self.assertEqual(2, self.load.call_count)
+
+    def test_update_quota_resource(self):
+        db.quota_create(self.context, self.project_id, 'workflows_old', 5)
+        db.quota_class_create(self.context, 'default', 'workflows_old', 6)
+        session = sqla_api.get_session()
+        with session.begin():
+            sqla_api._quota_usage_create(self.context, self.project_id,
+                                         'workflows_old', 1, 0, None,
+                                         session=session)
+        self.engine.resources
+
+        self.engine.update_quota_resource(self.context, 'old', 'new')
+        self.assertEqual(5, db.quota_get(self.context, self.project_id,
+                                         'workflows_new').hard_limit)
+        self.assertEqual(6, db.quota_class_get_default(
+            self.context)['workflows_new'])
+        self.assertEqual({'in_use': 1, 'reserved': 0},
+                         db.quota_usage_get_all_by_project(
+                             self.context, self.project_id)['workflows_new'])
+        self.engine.resources
+        self.assertEqual(2, self.load.call_count)
+
+
+class ReservationSettleTestCase(QuotaTestCase):
+    def setUp(self):
+        super(ReservationSettleTestCase, self).setUp()
+        self.engine = self._engine()
+
+    def test_commit_many(self):
+        reservations = {'project1': self._reserve(self.engine, 2, 'project1'),
+                        'project2': self._reserve(self.engine, 1, 'project2')}
+        db.reservation_commit_many(self.context, reservations)
+        self.assertEqual({'in_use': 2, 'reserved': 0},
+                         self._usage('project1'))
+        self.assertEqual({'in_use': 1, 'reserved': 0},
+                         self._usage('project2'))
+
+        # Already settled reservations are ignored
+        db.reservation_commit_many(self.context, reservations)
+        db.reservation_rollback_many(self.context, reservations)
+        self.assertEqual({'in_use': 2, 'reserved': 0},
+                         self._usage('project1'))
+
+    def test_rollback_many(self):
+        committed = self._reserve(self.engine, 1, 'project1')
+        reservations = {'project1': self._reserve(self.engine, 2, 'project1'),
+                        'project2': self._reserve(self.engine, 3, 'project2')}
+        db.reservation_commit(self.context, committed, 'project1')
+
+        db.reservation_rollback_many(self.context, reservations)
+        self.assertEqual({'in_use': 1, 'reserved': 0},
+                         self._usage('project1'))
+        self.assertEqual({'in_use': 0, 'reserved': 0},
+                         self._usage('project2'))
+
+    def test_settle_wrong_project(self):
+        reservations = self._reserve(self.engine, 2, 'project1')
+        db.reservation_commit_many(self.context, {'project2': reservations})
+        db.reservation_commit(self.context, reservations, 'project2')
+        self.assertEqual({'in_use': 0, 'reserved': 2},
+                         self._usage('project1'))
+
+    def test_settle_nothing(self):
+        self._reserve(self.engine, 2, 'project1')
+        db.reservation_commit_many(self.context, {})
+        db.reservation_rollback_many(self.context, {'project1': []})
+        db.reservation_commit(self.context, [], 'project1')
+        self.assertEqual({'in_use': 0, 'reserved': 2},
+                         self._usage('project1'))
+
+
+class ReservationExpireTestCase(QuotaTestCase):
+    def setUp(self):
+        super(ReservationExpireTestCase, self).setUp()
+        quota.CONF.set_override('quota_workflows', 10)
+        self.engine = self._engine()
+        for _i in range(5):
+            self.engine.reserve(self.context.elevated(), expire=-60,
+                                project_id=self.project_id, workflows=1)
+        self.engine.reserve(self.context.elevated(),
+                            project_id=self.project_id, workflows=2)
+
+    def test_expire_in_batches(self):
+        with mock.patch.object(sqla_api, '_reservation_expire_batch',
+                               wraps=sqla_api._reservation_expire_batch) as \
+                expire_batch:
+            self.assertEqual(5, db.reservation_expire(self.context,
+                                                      batch_size=2))
+        self.assertEqual(3, expire_batch.call_count)
+        self.assertEqual({'in_use': 0, 'reserved': 2}, self._usage())
+        self.assertEqual(0, db.reservation_expire(self.context,
+                                                  batch_size=2))
+
+    def test_expire_unbatched(self):
+        self.assertEqual(5, db.reservation_expire(self.context))
+        self.assertEqual({'in_use': 0, 'reserved': 2}, self._usage())
+
+    @mock.patch.object(sqla_api, '_reservations_settle_many', return_value=0)
+    def test_expire_skips_unsettled(self, mock_settle):
+        # Reservations that could not be rolled back are not picked again
+        self.assertEqual(0, db.reservation_expire(self.context,
+                                                  batch_size=2))
+        self.assertEqual(3, mock_settle.call_count)
+        uuids = [uuid for call in mock_settle.call_args_list
+                 for uuid in call[0][1][self.project_id]]
+        self.assertEqual(5, len(set(uuids)))
+
+
+class StripedUsageTestCase(QuotaTestCase):
+    def setUp(self):
+        super(StripedUsageTestCase, self).setUp()
+        for name, value in (('quota_workflows', 100),
+                            ('quota_usage_stripes', 4)):
+            quota.CONF.set_override(name, value)
+            self.addCleanup(quota.CONF.clear_override, name)
+        self.engine = self._engine()
+        # Reservation uuids 0, 1, 2... are made against stripes 0, 1, 2...
+        # The first reservation of a project falls back to the regular path
+        # after taking a uuid and creates stripe 0 with the next one.
+        self.uuids = iter(range(100))
+        uuid4 = self.useFixture(fixtures.MockPatchObject(
+            sqla_api.uuid, 'uuid4')).mock
+        uuid4.side_effect = lambda: uuid.UUID(int=next(self.uuids))
+
+    def _stripes(self, project_id=None):
+        rows = sqla_api.model_query(self.context, models.QuotaUsage,
+                                    read_deleted="no").\
+            filter_by(project_id=project_id or self.project_id).\
+            all()
+        return {row.stripe: (row.in_use, row.reserved) for row in rows}
+
+    def test_reserve_creates_stripes(self):
+        reservations = [self._reserve(self.engine, 1) for _i in range(5)]
+        self.assertEqual({0: (0, 2), 1: (0, 1), 2: (0, 1), 3: (0, 1)},
+                         self._stripes())
+        self.assertEqual({'in_use': 0, 'reserved': 5}, self._usage())
+
+        for reservation in reservations:
+            self.engine.commit(self.context, reservation,
+                               project_id=self.project_id)
+        self.assertEqual({'in_use': 5, 'reserved': 0}, self._usage())
+
+    def test_duplicate_stripe_retried(self):
+        create = sqla_api._quota_usage_create
+        calls = []
+
+        def racing_create(*args, **kwargs):
+            calls.append(kwargs.get('stripe'))
+            if len(calls) == 1:
+                # Another reservation creates the same stripe first
+                create(*args, **kwargs)
+            return create(*args, **kwargs)
+
+        self._reserve(self.engine, 1)
+        with mock.patch.object(sqla_api, '_quota_usage_create',
+                               side_effect=racing_create):
+            self._reserve(self.engine, 1)
+        # The retry makes the reservation against another stripe
+        self.assertEqual([2, 3], calls)
+        self.assertEqual({0: (0, 1), 3: (0, 1)}, self._stripes())
+
+    def test_duplicate_stripe_refused(self):
+        def create():
+            session = sqla_api.get_session()
+            with session.begin():
+                sqla_api._quota_usage_create(self.context, self.project_id,
+                                             'workflows', 0, 0, None,
+                                             session=session, stripe=1)
+
+        create()
+        self.assertRaises(db_exc.DBDuplicateEntry, create)
+
+    def test_destroyed_usages_free_stripes(self):
+        self._reserve(self.engine, 1)
+        sqla_api.quota_destroy_all_by_project(self.context, self.project_id)
+        self._reserve(self.engine, 2)
+        self.assertEqual({0: (0, 2)}, self._stripes())
+
+    def test_reconcile_usages(self):
+        reservations = [self._reserve(self.engine, 1) for _i in range(3)]
+        for reservation in reservations[:2]:
+            self.engine.commit(self.context, reservation,
+                               project_id=self.project_id)
+        self._reserve(self.engine, 1, 'other_project')
+
+        self.assertEqual(1, self.engine.reconcile_usages(self.context))
+        # Reserved counts stay with the stripes the reservations refer to
+        self.assertEqual({0: (2, 0), 2: (0, 0), 3: (0, 1)}, self._stripes())
+        self.assertEqual({0: (0, 1)}, self._stripes('other_project'))
+        self.assertEqual(0, db.quota_usage_reconcile(self.context))
+
+        self.engine.commit(self.context, reservations[2],
+                           project_id=self.project_id)
+        self.assertEqual({'in_use': 3, 'reserved': 0}, self._usage())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_quota_utils
+----------------------------------
+
+Tests for `waterfall.quota_utils`.
+"""
+
+import datetime
+
+import mock
+from oslo_utils import timeutils
+import webob
+
+from waterfall import context
+from waterfall import quota
+from waterfall import quota_utils
+from waterfall.tests import base
+from waterfall.tests import fake_keystone
+
+
+class ProjectHierarchyCacheTestCase(base.TestCase):
+    def setUp(self):
+        super(ProjectHierarchyCacheTestCase, self).setUp()
+        self.keystone = self.useFixture(fake_keystone.FakeKeystoneFixture(
+            {'root': None, 'a': 'root', 'b': 'root', 'a1': 'a'})).client
+        self.context = context.get_admin_context()
+        self.addCleanup(timeutils.clear_time_override)
+
+    def _parents(self, project_id):
+        return quota_utils.get_project_hierarchy(
+            self.context, project_id, parents_as_ids=True).parents
+
+    def _subtree(self, project_id):
+        return quota_utils.get_project_hierarchy(
+            self.context, project_id, subtree_as_ids=True).subtree
+
+    def test_cache_hit(self):
+        self.assertEqual({'a': {'root': None}}, self._parents('a1'))
+        self.assertEqual({'a': {'root': None}}, self._parents('a1'))
+        self.assertEqual('a', quota_utils.get_parent_project_id(self.context,
+                                                                'a1'))
+        # The parents and the parent id are different entries
+        self.assertEqual(2, self.keystone.calls)
+
+        project = quota_utils.get_project_hierarchy(self.context, 'a1',
+                                                    is_admin_project=True)
+        self.assertTrue(project.is_admin_project)
+        self.assertFalse(quota_utils.get_project_hierarchy(
+            self.context, 'a1').is_admin_project)
+
+    def test_expiry(self):
+        quota_utils.CONF.set_override('project_hierarchy_cache_ttl', 60)
+        self.addCleanup(quota_utils.CONF.clear_override,
+                        'project_hierarchy_cache_ttl')
+        timeutils.set_time_override()
+        self._parents('a1')
+        timeutils.advance_time_delta(datetime.timedelta(seconds=59))
+        self._parents('a1')
+        self.assertEqual(1, self.keystone.calls)
+
+        timeutils.advance_time_delta(datetime.timedelta(seconds=2))
+        self._parents('a1')
+        self.assertEqual(2, self.keystone.calls)
+
+    def test_disabled(self):
+        quota_utils.CONF.set_override('project_hierarchy_cache_ttl', 0)
+        self.addCleanup(quota_utils.CONF.clear_override,
+                        'project_hierarchy_cache_ttl')
+        self._parents('a1')
+        self._parents('a1')
+        self.assertEqual(2, self.keystone.calls)
+
+    def test_invalidate_moved_project(self):
+        self.assertEqual({'a1': None}, self._subtree('a'))
+        self.assertEqual({'a': {'a1': None}, 'b': None},
+                         self._subtree('root'))
+        self._subtree('b')
+
+        self.keystone.projects_by_id['a1'].parent_id = 'b'
+        # The new parent doesn't mention the project yet
+        quota_utils.invalidate_project_hierarchy('a1')
+        quota_utils.invalidate_project_hierarchy('b')
+        self.assertIsNone(self._subtree('a'))
+        self.assertEqual({'a1': None}, self._subtree('b'))
+        self.assertEqual({'a': None, 'b': {'a1': None}},
+                         self._subtree('root'))
+
+    def test_invalidate_deleted_project(self):
+        self.assertEqual({'a1': None}, self._subtree('a'))
+        self.assertEqual(['root'],
+                         quota_utils.get_all_root_project_ids(self.context))
+
+        del self.keystone.projects_by_id['a1']
+        self.assertRaises(webob.exc.HTTPNotFound, self._parents, 'a1')
+        self.assertIsNone(self._subtree('a'))
+        self.assertEqual(3, len(quota_utils.get_all_projects(self.context)))
+
+    @mock.patch('waterfall.quota.DbQuotaDriver.destroy_by_project')
+    def test_destroy_by_project(self, mock_destroy):
+        self.assertEqual({'a1': None}, self._subtree('a'))
+        quota.QuotaEngine().destroy_by_project(self.context, 'a1')
+
+        mock_destroy.assert_called_once_with(self.context, 'a1')
+        self.keystone.projects_by_id.pop('a1')
+        self.assertIsNone(self._subtree('a'))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_rpc
+----------------------------------
+
+Tests for `waterfall.rpc`.
+"""
+
+import mock
+from oslo_utils import timeutils
+
+from waterfall import context
+from waterfall import rpc
+from waterfall.tests import base
+
+
+class FakeEndpoint(object):
+    target = 'target'
+
+    def apply(self, ctxt, n):
+        return n * 2
+
+    def fail(self, ctxt):
+        raise ValueError()
+
+    def _private(self, ctxt):
+        pass
+
+
+class RPCMetricsTestCase(base.TestCase):
+    def setUp(self):
+        super(RPCMetricsTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.addCleanup(setattr, rpc._MESSAGE, 'queue_delay', None)
+        # The timings are shared by the process, each test uses its topic
+        self.topic = self.id()
+
+    def _stats(self, timings, method):
+        return timings.report().get('%s.%s' % (self.topic, method))
+
+    def test_endpoint(self):
+        fake = FakeEndpoint()
+        endpoint = rpc._Endpoint(fake, self.topic)
+        self.assertEqual('target', endpoint.target)
+        self.assertEqual(fake._private, endpoint._private)
+        self.assertEqual('apply', endpoint.apply.__name__)
+
+        rpc._MESSAGE.queue_delay = 2.0
+        self.assertEqual(6, endpoint.apply(self.context, 3))
+        self.assertIsNone(rpc._MESSAGE.queue_delay)
+        self.assertEqual(1,
+                         self._stats(rpc.DISPATCH_TIMINGS, 'apply')['count'])
+        self.assertEqual(2.0, self._stats(rpc.QUEUE_DELAYS, 'apply')['max'])
+
+        self.assertRaises(ValueError, endpoint.fail, self.context)
+        self.assertEqual(1,
+                         self._stats(rpc.DISPATCH_TIMINGS, 'fail')['errors'])
+        self.assertIsNone(self._stats(rpc.QUEUE_DELAYS, 'fail'))
+
+    def test_queue_delay(self):
+        serializer = rpc.RequestContextSerializer(None)
+        sent = serializer.serialize_context(self.context)
+        self.assertIn('sent_at', sent)
+
+        sent['sent_at'] -= 5
+        received = serializer.deserialize_context(sent)
+        self.assertIsInstance(received, context.RequestContext)
+        self.assertGreaterEqual(rpc._MESSAGE.queue_delay, 5)
+
+    def test_notifier_context(self):
+        serializer = rpc.RequestContextSerializer(rpc.JsonPayloadSerializer(),
+                                                  sent_at=False)
+        self.assertNotIn('sent_at', serializer.serialize_context(self.context))
+
+    def _call_context(self):
+        serializer = rpc.RequestContextSerializer(None)
+        cctxt = mock.Mock()
+
+        def send(ctxt, method, **kwargs):
+            for value in kwargs.values():
+                serializer.serialize_entity(ctxt, value)
+        cctxt.cast.side_effect = send
+        return rpc._CallContext(cctxt, self.topic)
+
+    def test_method_stats(self):
+        cctxt = self._call_context()
+        cctxt.cast(self.context, 'apply', workflow={'id': 1})
+        cctxt.cast(self.context, 'apply', workflow={'id': 2})
+        cctxt.call(self.context, 'get')
+
+        self.assertEqual(2, self._stats(rpc.CAST_TIMINGS, 'apply')['count'])
+        self.assertEqual(1, self._stats(rpc.CALL_TIMINGS, 'get')['count'])
+        # Only measured on demand
+        self.assertIsNone(self._stats(rpc.PAYLOAD_SIZES, 'apply'))
+
+    def test_payload_size(self):
+        rpc.CONF.set_override('rpc_measure_payload_size', True)
+        self.addCleanup(rpc.CONF.clear_override, 'rpc_measure_payload_size')
+        cctxt = self._call_context()
+        cctxt.cast(self.context, 'apply', workflow={'id': 1})
+        self.assertEqual(len(b'{"id": 1}'),
+                         self._stats(rpc.PAYLOAD_SIZES, 'apply')['max'])
+
+        # Sent anyway when it can't be measured
+        cctxt.cast(self.context, 'fail', workflow=object())
+        self.assertEqual(1, self._stats(rpc.CAST_TIMINGS, 'fail')['count'])
+        self.assertIsNone(self._stats(rpc.PAYLOAD_SIZES, 'fail'))
+        self.assertIsNone(rpc._MESSAGE.payload_size)
+
+
+class CompactContextTestCase(base.TestCase):
+    def setUp(self):
+        super(CompactContextTestCase, self).setUp()
+        self.context = context.RequestContext(
+            'user', 'project', is_admin=False, roles=['member'],
+            auth_token='token',
+            service_catalog=[{'type': 'identity'}], overwrite=False)
+        self.serializer = rpc.RequestContextSerializer(None, compact=True)
+
+    def _count(self):
+        return rpc.CONTEXT_SIZES.report().get('compact', {}).get('count', 0)
+
+    def test_to_rpc_dict(self):
+        sent = self.context.to_rpc_dict()
+        self.assertNotIn('service_catalog', sent)
+
+        received = context.RequestContext.from_dict(sent)
+        for field in context.RPC_FIELDS:
+            self.assertEqual(getattr(self.context, field),
+                             getattr(received, field))
+        self.assertEqual('token', received.auth_token)
+        self.assertEqual(self.context.timestamp,
+                         timeutils.normalize_time(received.timestamp))
+
+        # Forwarded without parsing the timestamp
+        forwarded = context.RequestContext.from_dict(sent).to_rpc_dict()
+        self.assertEqual(sent['timestamp'], forwarded['timestamp'])
+
+    def test_cache_dropped_on_setattr(self):
+        self.serializer.serialize_context(self.context)
+        self.assertIn('rpc_cache', self.context.__dict__)
+
+        self.context.project_name = 'name'
+        self.assertNotIn('rpc_cache', self.context.__dict__)
+        self.assertEqual(
+            'name', self.serializer.serialize_context(self.context)[
+                'project_name'])
+
+    def test_roles_changed_in_place(self):
+        self.serializer.serialize_context(self.context)
+        self.context.roles.append('reader')
+        self.assertEqual(
+            ['member', 'reader'],
+            self.serializer.serialize_context(self.context)['roles'])
+
+    def test_context_sizes(self):
+        count = self._count()
+        self.serializer.serialize_context(self.context)
+        self.assertEqual(count, self._count())
+
+        rpc.CONF.set_override('rpc_measure_payload_size', True)
+        self.addCleanup(rpc.CONF.clear_override, 'rpc_measure_payload_size')
+        self.context.project_name = 'name'
+        self.serializer.serialize_context(self.context)
+        self.serializer.serialize_context(self.context)
+        # Measured once per compact form
+        self.assertEqual(count + 1, self._count())
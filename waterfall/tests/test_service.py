@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_service
+----------------------------------
+
+Tests for `waterfall.service`.
+"""
+
+import fixtures
+import mock
+from oslo_db import exception as db_exc
+
+from waterfall import db
+from waterfall import service
+from waterfall.tests import base
+
+
+class FakeService(object):
+    report_interval = 10
+
+    def __init__(self, context, reporting=True):
+        self.reporting = reporting
+        self._create_service_ref(context)
+
+    def _create_service_ref(self, context):
+        self.service_id = db.service_create(context, {'host': 'host'}).id
+
+    def is_reporting(self):
+        return self.reporting
+
+
+class ServiceHeartbeatTestCase(base.DBTestCase):
+    def setUp(self):
+        super(ServiceHeartbeatTestCase, self).setUp()
+        self.heartbeat = service.ServiceHeartbeat()
+        self.timer = self.useFixture(fixtures.MockPatchObject(
+            service.loopingcall, 'FixedIntervalLoopingCall')).mock
+
+    def _report_count(self, svc):
+        return db.service_get(self.context, svc.service_id).report_count
+
+    def test_add_remove(self):
+        first = FakeService(self.context)
+        second = FakeService(self.context)
+        self.heartbeat.add(first)
+        self.heartbeat.add(second)
+        self.timer.assert_called_once_with(self.heartbeat.report)
+        self.timer.return_value.start.assert_called_once_with(
+            interval=10, initial_delay=10)
+
+        self.heartbeat.remove(first)
+        self.assertFalse(self.timer.return_value.stop.called)
+        self.heartbeat.remove(second)
+        self.timer.return_value.stop.assert_called_once_with()
+
+    @mock.patch.object(db, 'service_heartbeat', wraps=db.service_heartbeat)
+    def test_report_batched(self, mock_heartbeat):
+        services = [FakeService(self.context) for _i in range(3)]
+        services.append(FakeService(self.context, reporting=False))
+        for svc in services:
+            self.heartbeat.add(svc)
+
+        self.heartbeat.report()
+        self.heartbeat.report()
+        self.assertEqual(2, mock_heartbeat.call_count)
+        self.assertEqual([2, 2, 2, 0],
+                         [self._report_count(svc) for svc in services])
+
+    def test_report_recreates_missing(self):
+        kept = FakeService(self.context)
+        gone = FakeService(self.context)
+        gone_id = gone.service_id
+        self.heartbeat.add(kept)
+        self.heartbeat.add(gone)
+        db.service_destroy(self.context, gone_id)
+
+        self.heartbeat.report()
+        self.assertNotEqual(gone_id, gone.service_id)
+        self.assertEqual({kept.service_id: kept, gone.service_id: gone},
+                         self.heartbeat.services)
+        self.assertEqual(1, self._report_count(kept))
+
+        self.heartbeat.report()
+        self.assertEqual(1, self._report_count(gone))
+
+    def test_report_db_error(self):
+        svc = FakeService(self.context)
+        self.heartbeat.add(svc)
+        with mock.patch.object(db, 'service_heartbeat',
+                               side_effect=db_exc.DBConnectionError()):
+            self.heartbeat.report()
+        self.assertTrue(svc.model_disconnected)
+
+        self.heartbeat.report()
+        self.assertFalse(svc.model_disconnected)
+        self.assertEqual(1, self._report_count(svc))
+
+
+class ServiceHeartbeatDBTestCase(base.DBTestCase):
+    def test_service_heartbeat(self):
+        ids = [db.service_create(self.context, {'host': host}).id
+               for host in ('host1', 'host2')]
+        self.assertEqual(set(), db.service_heartbeat(self.context, ids,
+                                                     availability_zone='az'))
+        for service_id in ids:
+            svc = db.service_get(self.context, service_id)
+            self.assertEqual(1, svc.report_count)
+            self.assertEqual('az', svc.availability_zone)
+            self.assertIsNotNone(svc.updated_at)
+
+        db.service_destroy(self.context, ids[0])
+        self.assertEqual({ids[0], -1},
+                         db.service_heartbeat(self.context, ids + [-1]))
+        svc = db.service_get(self.context, ids[1])
+        self.assertEqual(2, svc.report_count)
+        self.assertEqual('az', svc.availability_zone)
+
+    def test_service_heartbeat_nothing(self):
+        self.assertEqual(set(), db.service_heartbeat(self.context, []))
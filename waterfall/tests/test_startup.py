@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_startup
+----------------------------------
+
+Tests for `waterfall.common.startup`.
+"""
+
+import json
+import os
+import sys
+
+import fixtures
+import mock
+from six.moves import builtins
+
+from waterfall.common import startup
+from waterfall.tests import base
+
+ENTRY_POINT = """
+import fake_startup_dep
+from waterfall.common import startup
+
+
+def main():
+    startup.mark('imports')
+    startup.mark('services')
+    startup.ready()
+    raise AssertionError('Serving')
+"""
+
+
+class StartupProfileTestCase(base.TestCase):
+    def setUp(self):
+        super(StartupProfileTestCase, self).setUp()
+        self.profile = startup.StartupProfile()
+        self.useFixture(fixtures.MockPatchObject(startup, 'PROFILE',
+                                                 self.profile))
+
+    def test_ready(self):
+        startup.mark('config')
+        startup.ready()
+        self.assertEqual(['config', 'ready'],
+                         [phase for phase, _seconds in self.profile.phases])
+
+        self.profile.enabled = True
+        self.assertRaises(startup.StartupComplete, startup.ready)
+
+    def test_profile_main(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(path, 'fake_startup_cmd.py'), 'w') as f:
+            f.write(ENTRY_POINT)
+        with open(os.path.join(path, 'fake_startup_dep.py'), 'w') as f:
+            f.write('')
+        output = os.path.join(path, 'report.json')
+
+        self.useFixture(fixtures.MonkeyPatch('sys.path', [path] + sys.path))
+        for module in ('fake_startup_cmd', 'fake_startup_dep'):
+            self.addCleanup(sys.modules.pop, module, None)
+        self.useFixture(fixtures.MockPatchObject(
+            startup, 'BINARIES', {'fake': 'fake_startup_cmd'}))
+        argv = ['-c', output, 'fake', '--config-file', 'waterfall.conf']
+
+        with mock.patch.object(sys, 'argv', argv):
+            self.assertEqual(0, startup.profile_main())
+            self.assertEqual(['fake', '--config-file', 'waterfall.conf'],
+                             sys.argv)
+        self.assertNotEqual(self.profile._timed_import, builtins.__import__)
+
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual('fake', report['binary'])
+        self.assertEqual(['imports', 'services', 'ready'],
+                         [phase for phase, _seconds in report['phases']])
+        modules = [entry['module'] for entry in report['imports']]
+        self.assertEqual('fake_startup_cmd', modules[0])
+        self.assertIn('fake_startup_dep', modules)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_threadpool
+----------------------------------
+
+Tests for `waterfall.common.threadpool`.
+"""
+
+import eventlet
+
+from waterfall.common import threadpool
+from waterfall import exception
+from waterfall.tests import base
+
+
+class BoundedGreenPoolTestCase(base.TestCase):
+    def setUp(self):
+        super(BoundedGreenPoolTestCase, self).setUp()
+        self.running = 0
+        self.max_running = 0
+        self.done = []
+
+    def _task(self, n):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        eventlet.sleep(0.01)
+        self.running -= 1
+        self.done.append(n)
+
+    def test_bounded_concurrency(self):
+        pool = threadpool.BoundedGreenPool('test', size=2, queue_size=10)
+        for n in range(6):
+            pool.spawn_n(self._task, n)
+        self.assertEqual({'active': 0, 'queued': 6, 'size': 2,
+                          'queue_size': 10}, pool.load())
+        eventlet.sleep(0.1)
+
+        self.assertEqual(list(range(6)), self.done)
+        self.assertEqual(2, self.max_running)
+        report = pool.report()
+        self.assertEqual(6, report['completed'])
+        self.assertEqual(0, report['queued'])
+        self.assertGreater(report['wait_max'], 0)
+
+    def test_reject(self):
+        pool = threadpool.BoundedGreenPool('test', size=1, queue_size=2,
+                                           rejection=threadpool.REJECT)
+        pool.spawn_n(self._task, 0)
+        pool.spawn_n(self._task, 1)
+        self.assertRaises(exception.ThreadPoolFull, pool.spawn_n,
+                          self._task, 2)
+        eventlet.sleep(0.05)
+        self.assertEqual([0, 1], self.done)
+        self.assertEqual(1, pool.report()['rejected'])
+
+    def test_caller_runs(self):
+        pool = threadpool.BoundedGreenPool('test', size=1, queue_size=1,
+                                           rejection=threadpool.CALLER_RUNS)
+        pool.spawn_n(self._task, 0)
+        pool.spawn_n(self._task, 1)
+        self.assertEqual([1], self.done)
+        eventlet.sleep(0.05)
+        self.assertEqual([1, 0], self.done)
+        self.assertEqual(1, pool.report()['caller_runs'])
+
+    def test_block(self):
+        pool = threadpool.BoundedGreenPool('test', size=1, queue_size=1,
+                                           rejection=threadpool.BLOCK)
+        for n in range(3):
+            pool.spawn_n(self._task, n)
+        eventlet.sleep(0.05)
+        self.assertEqual([0, 1, 2], self.done)
+        self.assertEqual(0, pool.report()['rejected'])
+
+    def test_block_reentrant(self):
+        pool = threadpool.BoundedGreenPool('test', size=1, queue_size=1,
+                                           rejection=threadpool.BLOCK)
+
+        def submit(n):
+            # The queue is full, waiting for room would never return
+            pool.spawn_n(self._task, n)
+            pool.spawn_n(self._task, n + 1)
+            self.done.append(n - 1)
+
+        pool.spawn_n(submit, 1)
+        eventlet.sleep(0.05)
+        self.assertEqual([2, 0, 1], self.done)
+        self.assertEqual(1, pool.report()['caller_runs'])
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_workflow_manager
+----------------------------------
+
+Tests for `waterfall.workflow.manager`.
+"""
+
+import datetime
+
+import eventlet
+import fixtures
+import mock
+from oslo_utils import timeutils
+
+from waterfall import coordination
+from waterfall import db
+from waterfall.db.sqlalchemy import models
+from waterfall.objects import fields
+from waterfall import rpc
+from waterfall.tests import base
+from waterfall.workflow import manager
+
+
+class WorkflowManagerTestCase(base.DBTestCase):
+    def setUp(self):
+        super(WorkflowManagerTestCase, self).setUp()
+        backend_url = 'file://%s' % self.useFixture(fixtures.TempDir()).path
+        coordination.CONF.set_override('backend_url', backend_url,
+                                       group='coordination')
+        self.addCleanup(coordination.CONF.clear_override, 'backend_url',
+                        group='coordination')
+        self.coordinator = self._coordinator()
+        self.useFixture(fixtures.MockPatchObject(coordination, 'COORDINATOR',
+                                                 self.coordinator))
+
+        # Nothing is sent, the RPC clients only need a transport
+        self.useFixture(fixtures.MockPatchObject(rpc, 'TRANSPORT'))
+
+        self.manager = manager.WorkflowManager(host='host')
+        self.workflow = self._create_workflow()
+
+    def _coordinator(self):
+        coordinator = coordination.Coordinator(prefix='waterfall-')
+        # No heartbeat thread, nothing here depends on it
+        with mock.patch.object(coordination.eventlet, 'spawn'):
+            coordinator.start()
+        self.addCleanup(coordinator.stop)
+        return coordinator
+
+    def _create_workflow(self, status=fields.WorkflowStatus.PENDING):
+        workflow = db.workflow_create(self.context, 'volume', '{}')
+        db.workflow_update_status(self.context, workflow.id, status)
+        return {'id': workflow.id}
+
+    def _status(self, workflow=None):
+        return db.get_fields_by_id(self.context, models.Workflow,
+                                   (workflow or self.workflow)['id'],
+                                   ['status'])['status']
+
+    def _lock(self, workflow=None, coordinator=None):
+        return coordination.LeaseLock(manager.WORKFLOW_LOCK,
+                                      workflow or self.workflow,
+                                      coordinator=coordinator)
+
+    def test_init_host_capabilities(self):
+        self.manager.init_host()
+        self.assertEqual({'driver_name': 'SimpleDriver',
+                          'workflow_backend_name': 'SimpleDriver'},
+                         self.manager.last_capabilities)
+
+    def test_apply(self):
+        self.manager.apply(self.context, self.workflow)
+        self.assertEqual(fields.WorkflowStatus.APPLIED, self._status())
+        # The lock was released
+        lock = self._lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_apply_locked_elsewhere(self):
+        lock = self._lock(coordinator=self._coordinator())
+        self.assertTrue(lock.acquire(blocking=False))
+        self.addCleanup(lock.release)
+        with mock.patch.object(self.manager.service, 'apply') as apply:
+            self.manager.apply(self.context, self.workflow)
+        self.assertFalse(apply.called)
+        self.assertEqual(fields.WorkflowStatus.PENDING, self._status())
+
+    def test_apply_error(self):
+        with mock.patch.object(self.manager.service, 'apply',
+                               side_effect=ValueError()):
+            self.assertRaises(ValueError, self.manager.apply, self.context,
+                              self.workflow)
+        self.assertEqual(fields.WorkflowStatus.ERROR, self._status())
+        lock = self._lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_drain(self):
+        applying = self._create_workflow(fields.WorkflowStatus.APPLYING)
+        finishing = self._create_workflow(fields.WorkflowStatus.APPLYING)
+        self.manager._applying = {applying['id']: self.context,
+                                  finishing['id']: self.context}
+        eventlet.spawn_after(0.05, self.manager._applying.pop,
+                             finishing['id'])
+
+        self.manager.drain(0.2)
+        self.assertEqual(fields.WorkflowStatus.PENDING, self._status(applying))
+        self.assertEqual(fields.WorkflowStatus.APPLYING,
+                         self._status(finishing))
+
+    def test_drain_waits_for_dispatched(self):
+        acquire = coordination.LeaseLock.acquire
+
+        def slow_acquire(lock, *args, **kwargs):
+            eventlet.sleep(0.05)
+            return acquire(lock, *args, **kwargs)
+
+        with mock.patch.object(coordination.LeaseLock, 'acquire',
+                               slow_acquire):
+            thread = eventlet.spawn(self.manager.apply, self.context,
+                                    self.workflow)
+            eventlet.sleep(0)
+            self.manager.drain(1)
+            self.assertEqual(fields.WorkflowStatus.APPLIED, self._status())
+        thread.wait()
+
+    def test_drain_timeout_still_applied(self):
+        done = eventlet.event.Event()
+        with mock.patch.object(self.manager.service, 'apply',
+                               side_effect=lambda: done.wait()):
+            thread = eventlet.spawn(self.manager.apply, self.context,
+                                    self.workflow)
+            self.manager.drain(0.05)
+            self.assertEqual(fields.WorkflowStatus.PENDING, self._status())
+
+            # Finished before the process stopped, it won't be resent
+            done.send()
+            thread.wait()
+        self.assertEqual(fields.WorkflowStatus.APPLIED, self._status())
+
+    def test_drain_nothing_applying(self):
+        with mock.patch.object(self.manager.db,
+                               'workflow_update_status') as update:
+            self.manager.drain(10)
+        self.assertFalse(update.called)
+
+    @mock.patch('waterfall.workflow.rpcapi.WorkflowAPI.apply_workflow')
+    def test_recover_stale_workflows(self, mock_apply):
+        self.addCleanup(timeutils.clear_time_override)
+        timeutils.set_time_override()
+        db.workflow_update_status(self.context, self.workflow['id'],
+                                  fields.WorkflowStatus.APPLIED)
+        crashed = self._create_workflow(fields.WorkflowStatus.APPLYING)
+        running = self._create_workflow(fields.WorkflowStatus.APPLYING)
+        lost = self._create_workflow(fields.WorkflowStatus.PENDING)
+        applied = self._create_workflow(fields.WorkflowStatus.APPLIED)
+        timeutils.advance_time_delta(datetime.timedelta(seconds=601))
+        recent = self._create_workflow(fields.WorkflowStatus.APPLYING)
+
+        lock = self._lock(running, self._coordinator())
+        self.assertTrue(lock.acquire(blocking=False))
+        self.addCleanup(lock.release)
+        with mock.patch.object(self.coordinator, 'is_leader',
+                               return_value=True):
+            self.manager._recover_stale_workflows(self.context)
+
+        self.assertEqual([crashed['id'], lost['id']],
+                         [call[0][1].id for call in mock_apply.call_args_list])
+        self.assertEqual(
+            [fields.WorkflowStatus.PENDING, fields.WorkflowStatus.APPLYING,
+             fields.WorkflowStatus.PENDING, fields.WorkflowStatus.APPLIED,
+             fields.WorkflowStatus.APPLYING],
+            [self._status(workflow)
+             for workflow in (crashed, running, lost, applied, recent)])
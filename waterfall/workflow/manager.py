@@ -33,17 +33,24 @@ Volume workflows can be created, restored, deleted and listed.
 
 """
 
+import datetime
+import time
+
+import eventlet
 from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
 from oslo_service import periodic_task
 from oslo_utils import excutils
 from oslo_utils import importutils
+from oslo_utils import timeutils
 import six
 
 from waterfall.workflow import driver
 from waterfall.workflow import rpcapi as workflow_rpcapi
+from waterfall.common import metrics
 from waterfall import context
+from waterfall import coordination
 from waterfall import exception
 from waterfall.i18n import _, _LE, _LI, _LW
 from waterfall import manager
@@ -55,10 +62,34 @@ from waterfall import utils
 
 LOG = logging.getLogger(__name__)
 
+QUOTAS = quota.QUOTAS
+
+# Coordination group of the workflow managers, its leader runs the periodic
+# tasks that must not run once per replica.
+LEADER_GROUP = workflow_rpcapi.WorkflowAPI.GROUP
+
+# Duration of the apply calls of the drivers, per driver
+DRIVER_TIMINGS = metrics.timings('workflow.driver_apply')
+
+# Held by the manager applying a workflow
+WORKFLOW_LOCK = 'workflow-{id}'
+
 workflow_manager_opts = [
     cfg.StrOpt('workflow_driver',
                default='waterfall.workflow.drivers.simple.SimpleDriver',
                help='Driver to use for workflows.',),
+    cfg.IntOpt('workflow_workers',
+               default=1,
+               min=1,
+               help='Number of waterfall-workflow worker processes on this '
+                    'host. They share the RPC topic and a worker that dies '
+                    'is restarted.'),
+    cfg.IntOpt('workflow_stale_timeout',
+               default=600,
+               min=1,
+               help='Number of seconds after which a workflow still pending '
+                    'or applying, and whose lock is not held by any '
+                    'manager, is sent to the managers again.'),
 ]
 
 
@@ -75,9 +106,12 @@ class WorkflowManager(manager.SchedulerDependentManager):
 
     def __init__(self, service_name=None, *args, **kwargs):
         self.service = importutils.import_object(self.driver_name)
+        # Workflows being applied, id -> context of the request
+        self._applying = {}
         self.workflow_rpcapi = workflow_rpcapi.WorkflowAPI()
         super(WorkflowManager, self).__init__(service_name='workflow',
                                             *args, **kwargs)
+        metrics.register_source('workflow_manager', self._load)
 
     @property
     def driver_name(self):
@@ -85,13 +119,186 @@ class WorkflowManager(manager.SchedulerDependentManager):
 
         return CONF.workflow_driver
 
+    def init_host(self):
+        coordination.COORDINATOR.join_group(LEADER_GROUP,
+                                            capabilities={'host': self.host})
+        driver_name = self.service.__class__.__name__
+        self.update_service_capabilities({
+            'driver_name': driver_name,
+            'workflow_backend_name': (CONF.workflow_backend_name or
+                                      driver_name)})
+
     @periodic_task.periodic_task(spacing=60)
+    @coordination.leader_only(LEADER_GROUP)
     def period_test(self, context):
         LOG.debug("period task debuging")
 
+    @periodic_task.periodic_task(spacing=60)
+    @coordination.leader_only(LEADER_GROUP)
+    def _expire_reservations(self, context):
+        """Roll back quota reservations that have outlived their expiry."""
+        start = timeutils.utcnow()
+        try:
+            count = QUOTAS.expire(context)
+        except Exception:
+            LOG.exception(_LE("Failed to expire quota reservations."))
+            return
+
+        elapsed = timeutils.delta_seconds(start, timeutils.utcnow())
+        if count:
+            LOG.info(_LI("Expired %(count)d quota reservations in "
+                         "%(elapsed).2f seconds."),
+                     {'count': count, 'elapsed': elapsed})
+        else:
+            LOG.debug("No expired quota reservations found.")
+
+    @periodic_task.periodic_task(spacing=300)
+    @coordination.leader_only(LEADER_GROUP)
+    def _reconcile_quota_usages(self, context):
+        """Fold striped quota usages back into a single row."""
+        if CONF.quota_usage_stripes <= 1:
+            return
+        try:
+            count = QUOTAS.reconcile_usages(context)
+        except Exception:
+            LOG.exception(_LE("Failed to reconcile quota usages."))
+            return
+        LOG.debug("Reconciled %d striped quota usages.", count)
+
+    @periodic_task.periodic_task(spacing=60)
+    @coordination.leader_only(LEADER_GROUP)
+    def _recover_stale_workflows(self, context):
+        """Send again the workflows left behind by a manager that died.
+
+        Workflows applying while nobody holds their lock were being applied
+        by a manager that crashed.  Pending ones may have lost their
+        message, or been set back to pending by a manager that stopped.
+        Sending a workflow twice is harmless, it is only applied once.
+        """
+        updated_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.workflow_stale_timeout)
+        try:
+            stale = self.db.workflow_get_all_stale(
+                context, [fields.WorkflowStatus.PENDING,
+                          fields.WorkflowStatus.APPLYING], updated_before)
+        except Exception:
+            LOG.exception(_LE("Failed to look for stale workflows."))
+            return
+
+        recovered = 0
+        for workflow in stale:
+            if workflow.status == fields.WorkflowStatus.APPLYING:
+                lock = coordination.Lock(WORKFLOW_LOCK, {'id': workflow.id})
+                if not lock.acquire(blocking=False):
+                    # Still being applied
+                    continue
+                try:
+                    reset = self.db.workflow_update_status(
+                        context, workflow.id, fields.WorkflowStatus.PENDING,
+                        expected=fields.WorkflowStatus.APPLYING)
+                finally:
+                    lock.release()
+                if not reset:
+                    continue
+            try:
+                self.workflow_rpcapi.apply_workflow(context, workflow)
+            except Exception:
+                LOG.exception(_LE("Failed to send workflow %s again."),
+                              workflow.id)
+                continue
+            recovered += 1
+
+        if recovered:
+            LOG.warning(_LW("Sent %d stale workflows to the managers again."),
+                        recovered)
+
     def apply(self, context, workflow):
         """Apply resource"""
+        workflow_id = workflow['id']
+        # Tracked from dispatch on, so drain() waits for it as well
+        tracked = workflow_id not in self._applying
+        if tracked:
+            self._applying[workflow_id] = context
+        try:
+            # Held while the workflow is applied, the backend releases it
+            # when this process dies and its lease isn't renewed anymore
+            lock = coordination.LeaseLock(WORKFLOW_LOCK, {'id': workflow_id},
+                                          on_lost=[self._lease_lost])
+            if not lock.acquire(blocking=False):
+                LOG.info(_LI("Workflow %s is being applied elsewhere, not "
+                             "applying it."), workflow_id)
+                return
+            try:
+                self._apply(context, workflow)
+            finally:
+                lock.release()
+        finally:
+            if tracked:
+                self._applying.pop(workflow_id, None)
+
+    def _apply(self, context, workflow):
+        workflow_id = workflow['id']
+        # A message redelivered after a restart must not apply it twice
+        if not self.db.workflow_update_status(
+                context, workflow_id, fields.WorkflowStatus.APPLYING,
+                expected=fields.WorkflowStatus.PENDING):
+            LOG.info(_LI("Workflow %s is not pending, not applying it."),
+                     workflow_id)
+            return
+
         LOG.debug(workflow)
         LOG.debug("apply is called")
         LOG.debug(self.service)
-        self.service.apply()
+        # drain() sets the workflow back to pending if it outlives the
+        # timeout.  The workflow is done when it still finishes, so it
+        # must not be applied again.
+        running = [fields.WorkflowStatus.APPLYING,
+                   fields.WorkflowStatus.PENDING]
+        try:
+            with DRIVER_TIMINGS.time(self.service.__class__.__name__):
+                self.service.apply()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.db.workflow_update_status(context, workflow_id,
+                                               fields.WorkflowStatus.ERROR,
+                                               expected=running)
+        else:
+            self.db.workflow_update_status(
+                context, workflow_id, fields.WorkflowStatus.APPLIED,
+                expected=running)
+
+    @staticmethod
+    def _lease_lost(lock):
+        # Drivers can't be interrupted, the workflow finishes regardless
+        LOG.error(_LE("Lease of lock %s lost while applying the workflow, "
+                      "it may be applied twice."), lock.lock_name)
+
+    def _load(self):
+        return {'applying': len(self._applying),
+                'queued': self._tp.queued()}
+
+    def drain(self, timeout):
+        """Wait for the workflows dispatched to this manager.
+
+        The ones still running after `timeout` seconds are set back to
+        pending, so they are applied again if this process stops before
+        they finish.  Those finishing before it stops are still marked
+        applied or failed, and are not applied again.
+        """
+        start = time.time()
+        while self._applying and time.time() - start < timeout:
+            eventlet.sleep(0.1)
+
+        unfinished = list(self._applying.items())
+        for workflow_id, ctxt in unfinished:
+            try:
+                self.db.workflow_update_status(
+                    ctxt, workflow_id, fields.WorkflowStatus.PENDING,
+                    expected=fields.WorkflowStatus.APPLYING)
+            except Exception:
+                LOG.exception(_LE("Failed to set workflow %s back to "
+                                  "pending."), workflow_id)
+
+        if unfinished:
+            LOG.warning(_LW("%d unfinished workflows set back to pending."),
+                        len(unfinished))
@@ -21,7 +21,9 @@ Client side of the volume workflow RPC API.
 from oslo_config import cfg
 import oslo_messaging as messaging
 from oslo_log import log as logging
+import six
 
+from waterfall import coordination
 from waterfall import rpc
 from waterfall.objects import base as objects_base
 
@@ -36,6 +38,8 @@ class WorkflowAPI(object):
     RPC_API_VERSION = '1.0'
     TOPIC = CONF.workflow_topic
     BINARY = 'waterfall-workflow'
+    # Coordination group joined by the workflow managers
+    GROUP = 'workflow-manager'
 
     def __init__(self):
         super(WorkflowAPI, self).__init__()
@@ -51,12 +55,31 @@ class WorkflowAPI(object):
         else:
             return legacy
 
+    def _prepare(self, resource_key):
+        """Prepare a client targeting the manager owning a resource key.
+
+        Managers are placed on a consistent hash ring, so all the work on a
+        given key goes to the same host as long as it stays in the group.
+        Without coordination, or managers, the message goes to the topic.
+        """
+        ring = coordination.COORDINATOR.get_hash_ring(self.GROUP)
+        server = ring.get_node(resource_key) if ring else None
+        if server is None:
+            return self.client.prepare()
+        return self.client.prepare(server=server)
+
+    @staticmethod
+    def _resource_key(workflow):
+        # Spread the workflows of a project over the managers, nothing a
+        # manager keeps in memory is shared by the workflows of a project.
+        return six.text_type(workflow.id)
+
     def apply_workflow(self, ctxt, workflow):
         #cctxt = self.client.prepare()
         #return cctxt.cast(context, 'plan_delete', plan_id=id)
 
         LOG.debug("Calling workflow id %s", workflow.id)
-        cctxt = self.client.prepare()
+        cctxt = self._prepare(self._resource_key(workflow))
         return cctxt.cast(ctxt, 'apply', workflow=workflow)
     #    LOG.debug("create_workflow in rpcapi workflow_id %s", workflow.id)
     #def create_workflow(self, ctxt, workflow):